@@ -1,83 +1,629 @@
+import os
+import argparse
 import sys
+import contextlib
+import functools
 import json
 import math
-from dataclasses import asdict, dataclass
-from typing import List, cast
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, Iterable, Iterator, List, Optional, Set, TextIO, Tuple, cast
 from PySide6 import QtCore, QtWidgets, QtGui
+from core import (NODE_POSITIONS, ArrowData, BinaryFormat, DiagramCache, DiagramData, LayeredLayout, OrthogonalRouter, SegmentIndex,
+                  Serializer, ShapeData, SpatialGrid, new_shape_id, profiler, segment_intersects_rect)
+
+
+class Journal:
+    # Append-only log of the edits made to a document, kept next to it so work can
+    # be recovered after a crash. Every line is one JSON encoded operation, the first
+    # one names the snapshot the others apply to, or null for the document itself.
+    # Compaction writes a new snapshot and atomically replaces the log, so the log
+    # always refers to a complete snapshot
+    extension = ".journal"
+    compact_interval = 1000  # Operations logged before compacting
+
+    def __init__(self, document_path: str):
+        self.document_path = document_path
+        self.path = document_path + self.extension
+        self.file: Optional[TextIO] = None
+        self.generation = 0
+        self.count = 0
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def snapshot_path(self, generation: int) -> str:
+        return f"{self.document_path}.{generation}.snapshot{BinaryFormat.extension}"
+
+    def append(self, operation: dict) -> bool:
+        # Returns True once the log is due for compaction
+        self.file.write(json.dumps(operation, separators=(",", ":")) + "\n")
+        self.file.flush()
+        self.count += 1
+        return self.count >= self.compact_interval
+
+    def compact(self, diagram_data: Optional[DiagramData] = None) -> bool:
+        # Starts a new log on top of a snapshot of diagram_data, or on top of the
+        # document when there is nothing newer than it
+        generation = self.generation + 1
+        snapshot = None
+        if diagram_data is not None:
+            snapshot = self.snapshot_path(generation)
+            if not Serializer.save_to_file(diagram_data, snapshot):
+                return False
+        self.close()
+        temp_path = self.path + ".tmp"
+        try:
+            with open(temp_path, "w") as file:
+                header = {"op": "base", "generation": generation, "snapshot": snapshot and os.path.basename(snapshot)}
+                file.write(json.dumps(header) + "\n")
+            os.replace(temp_path, self.path)
+            self.remove_snapshot(self.generation)
+            self.file = open(self.path, "a")
+        except IOError as e:
+            print(f"Error compacting journal: {e}")
+            return False
+        self.generation = generation
+        self.count = 0
+        return True
+
+    def read(self) -> Optional[Tuple[DiagramData, List[dict]]]:
+        # Returns the base diagram and the operations logged on top of it,
+        # a line torn by a crash ends the log
+        try:
+            operations = []
+            with open(self.path, "r") as file:
+                header = json.loads(file.readline())
+                for line in file:
+                    try:
+                        operations.append(json.loads(line))
+                    except ValueError:
+                        break
+            self.generation = header["generation"]
+            if header["snapshot"]:
+                base_path = os.path.join(os.path.dirname(self.path), header["snapshot"])
+            else:
+                base_path = self.document_path
+            if os.path.exists(base_path):
+                diagram_data = Serializer.load_from_file(base_path)
+            else:
+                diagram_data = DiagramData(shapes=[], arrows=[])
+            return (diagram_data, operations) if diagram_data else None
+        except (IOError, ValueError, KeyError) as e:
+            print(f"Error reading journal: {e}")
+            return None
 
+    def discard(self) -> None:
+        # Removes the log and its snapshot, once the document is saved or abandoned
+        self.close()
+        if self.exists():
+            try:
+                with open(self.path, "r") as file:
+                    self.generation = json.loads(file.readline())["generation"]
+            except (ValueError, KeyError):
+                pass  # Torn header, there is no snapshot to remove
+            os.remove(self.path)
+        self.remove_snapshot(self.generation)
+
+    def remove_snapshot(self, generation: int) -> None:
+        try:
+            if os.path.exists(self.snapshot_path(generation)):
+                BinaryFormat.close(self.snapshot_path(generation))
+                os.remove(self.snapshot_path(generation))
+        except OSError as e:
+            print(f"Error removing snapshot: {e}")
 
-@dataclass
-class ShapeData:
-    shape_type: str
-    x: int
-    y: int
-    width: int
-    height: int
-    text: str
+    def close(self) -> None:
+        if self.file:
+            self.file.close()
+            self.file = None
 
 
-@dataclass
-class ArrowData:
-    start_shape_index: int
-    start_node_index: int
-    end_shape_index: int
-    end_node_index: int
+class Command:
+    # A reversible edit holding only what it changed, applied through the edit
+    # methods of Area so undo and redo are journaled like any other edit
+    shape_size = 1024  # Rough memory held per shape record, shapes removed from the area live on in commands
+    arrow_size = 128
+    delta_size = 64
 
+    def undo(self, area: 'Area') -> None:
+        raise NotImplementedError
 
-@dataclass
-class DiagramData:
-    shapes: List[ShapeData]
-    arrows: List[ArrowData]
+    def redo(self, area: 'Area') -> None:
+        raise NotImplementedError
 
+    def memory(self) -> int:
+        return self.delta_size
 
-class Serializer:
-    @staticmethod
-    def save_to_file(diagram_data: DiagramData, file_path: str) -> None:
-        try:
-            with open(file_path, "w") as file:
-                json.dump(asdict(diagram_data), file, indent=4)
-        except IOError as e:
-            print(f"Error saving file: {e}")
+    def merge(self, command: 'Command') -> bool:
+        # Folds a following command into this one, returns False if they don't combine
+        return False
 
-    @staticmethod
-    def load_from_file(file_path: str) -> DiagramData:
+
+class MoveCommand(Command):
+    def __init__(self, offsets: Dict['Shape', Tuple[int, int]]):
+        self.offsets = offsets
+
+    def undo(self, area: 'Area') -> None:
+        area.place_shapes({shape: (shape.x() - dx, shape.y() - dy) for shape, (dx, dy) in self.offsets.items()})
+
+    def redo(self, area: 'Area') -> None:
+        area.place_shapes({shape: (shape.x() + dx, shape.y() + dy) for shape, (dx, dy) in self.offsets.items()})
+
+    def memory(self) -> int:
+        return self.delta_size * len(self.offsets)
+
+    def merge(self, command: Command) -> bool:
+        # Consecutive drags of the same shapes are undone as one
+        if not isinstance(command, MoveCommand) or command.offsets.keys() != self.offsets.keys():
+            return False
+        for shape, (dx, dy) in command.offsets.items():
+            x, y = self.offsets[shape]
+            self.offsets[shape] = (x + dx, y + dy)
+        return True
+
+
+class AddCommand(Command):
+    # Keeps the shape and arrow objects themselves, so undoing is proportional to
+    # their number and never reloads the diagram
+    def __init__(self, shapes: List['Shape'], arrows: List['Arrow']):
+        self.shapes = shapes
+        self.arrows = arrows
+
+    def undo(self, area: 'Area') -> None:
+        with area.batch_reroute():
+            for arrow in self.arrows:
+                if arrow in area.arrows:  # Also removed along with its shapes
+                    area.delete_arrow(arrow)
+            for shape in self.shapes:
+                area.delete_shape(shape)
+
+    def redo(self, area: 'Area') -> None:
+        with area.batch_reroute():
+            for shape in self.shapes:
+                area.create_shape(shape)
+            for arrow in self.arrows:
+                area.insert_arrow(arrow)
+
+    def memory(self) -> int:
+        return self.shape_size * len(self.shapes) + self.arrow_size * len(self.arrows)
+
+
+class RemoveCommand(AddCommand):
+    # arrows must include every arrow attached to the removed shapes
+    def undo(self, area: 'Area') -> None:
+        AddCommand.redo(self, area)
+
+    def redo(self, area: 'Area') -> None:
+        AddCommand.undo(self, area)
+
+
+class TextCommand(Command):
+    def __init__(self, shape: 'Shape', old_text: str, new_text: str):
+        self.shape = shape
+        self.old_text = old_text
+        self.new_text = new_text
+
+    def undo(self, area: 'Area') -> None:
+        area.set_shape_text(self.shape, self.old_text)
+
+    def redo(self, area: 'Area') -> None:
+        area.set_shape_text(self.shape, self.new_text)
+
+    def memory(self) -> int:
+        return self.delta_size + len(self.old_text) + len(self.new_text)
+
+
+class ChildCommand(Command):
+    def __init__(self, shape: 'Shape', old_child: Optional[str], new_child: Optional[str]):
+        self.shape = shape
+        self.old_child = old_child
+        self.new_child = new_child
+
+    def undo(self, area: 'Area') -> None:
+        area.set_shape_child(self.shape, self.old_child)
+
+    def redo(self, area: 'Area') -> None:
+        area.set_shape_child(self.shape, self.new_child)
+
+    def memory(self) -> int:
+        return self.delta_size + len(self.old_child or "") + len(self.new_child or "")
+
+
+class UndoStack:
+    # The oldest commands are dropped once the estimated memory exceeds memory_limit
+    def __init__(self, memory_limit: int = 16 * 1024 * 1024):
+        self.memory_limit = memory_limit
+        self.undo_commands: Deque[Command] = deque()
+        self.redo_commands: List[Command] = []
+        self.memory = 0
+        self.last_pushed: Optional[Command] = None
+
+    def push(self, command: Command) -> None:
+        self.redo_commands.clear()
+        if self.undo_commands and self.undo_commands[-1] is self.last_pushed and self.last_pushed.merge(command):
+            return
+        self.undo_commands.append(command)
+        self.memory += command.memory()
+        self.last_pushed = command
+        self.trim()
+
+    def undo(self, area: 'Area') -> None:
+        if self.undo_commands:
+            command = self.undo_commands.pop()
+            self.memory -= command.memory()
+            command.undo(area)
+            self.redo_commands.append(command)
+            self.last_pushed = None
+
+    def redo(self, area: 'Area') -> None:
+        if self.redo_commands:
+            command = self.redo_commands.pop()
+            command.redo(area)
+            self.undo_commands.append(command)
+            self.memory += command.memory()
+            self.last_pushed = None
+
+    def trim(self) -> None:
+        while self.memory > self.memory_limit and len(self.undo_commands) > 1:
+            self.memory -= self.undo_commands.popleft().memory()
+
+    def clear(self) -> None:
+        self.undo_commands.clear()
+        self.redo_commands.clear()
+        self.memory = 0
+        self.last_pushed = None
+
+
+class TaskCancelled(Exception):
+    pass
+
+
+class BackgroundTask(QtCore.QObject):
+    # Runs a function on the global thread pool. The function receives a progress
+    # callback, which raises TaskCancelled once the task has been cancelled.
+    # Signals are delivered on the GUI thread, finished carries None on failure
+    progress = QtCore.Signal(int)
+    finished = QtCore.Signal(object)
+
+    def __init__(self, function: Callable[[Callable[[int, int], None]], object]):
+        super().__init__()
+        self.function = function
+        self.cancelled = False
+        self.percent = -1
+
+    def start(self) -> None:
+        QtCore.QThreadPool.globalInstance().start(self.run)
+
+    def cancel(self) -> None:
+        self.cancelled = True
+
+    def report(self, done: int, total: int) -> None:
+        if self.cancelled:
+            raise TaskCancelled()
+        # Only changes of the percentage cross over to the GUI thread
+        percent = done * 100 // total if total else 100
+        if percent != self.percent:
+            self.percent = percent
+            self.progress.emit(percent)
+
+    def run(self) -> None:
         try:
-            with open(file_path, "r") as file:
-                data = json.load(file)
-            return DiagramData(
-                shapes=[ShapeData(**shape_data) for shape_data in data['shapes']],
-                arrows=[ArrowData(**arrow_data) for arrow_data in data['arrows']]
-            )
-        except (IOError, json.JSONDecodeError) as e:
-            print(f"Error loading file: {e}")
-            return None
+            result = self.function(self.report)
+        except TaskCancelled:
+            result = None
+        except Exception as e:
+            # Reported as a failure, otherwise the editor would wait for the task forever
+            print(f"Error in background task: {e!r}")
+            result = None
+        self.finished.emit(result)
 
 
 class FlowchartEditor:
     def __init__(self):
         self.window = None
+        self.task: Optional[BackgroundTask] = None
+        self.progress_dialog: Optional[QtWidgets.QProgressDialog] = None
+        self.journal: Optional[Journal] = None
+        self.document: Optional[str] = None  # Shown document, None until saved, see Serializer.split_document
+        # Diagrams the shown one was opened from, outermost first. Each keeps its unsaved state as
+        # (document, diagram data, journal, modified), its journal stays open for recovery
+        self.parents: List[Tuple[Optional[str], DiagramData, Optional[Journal], bool]] = []
+        self.cache = DiagramCache()
         self.run()
 
     def run(self):
         self.window = Window(self)
-        self.window.setWindowTitle("Flowchart Proof of Concept")
+        self.update_title()
         self.window.show()
+        # Edits to a diagram that was never saved are journaled in the application data directory
+        if not self.open_journal(Journal(self.get_untitled_path())):
+            self.set_journal(Journal(self.get_untitled_path()))
+
+    @staticmethod
+    def get_untitled_path() -> str:
+        directory = QtCore.QStandardPaths.writableLocation(QtCore.QStandardPaths.AppDataLocation)
+        os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, "untitled.json")
+
+    def update_title(self) -> None:
+        # The path through the hierarchy down to the shown diagram
+        documents = [document for document, _, _, _ in self.parents] + [self.document]
+        names = " > ".join(os.path.basename(document) if document else "Untitled" for document in documents)
+        self.window.setWindowTitle(f"Flowchart Proof of Concept - {names}")
+
+    def set_document(self, document: Optional[str]) -> None:
+        # A document opened from the toolbar starts a new hierarchy
+        for _, _, journal, _ in self.parents:
+            if journal:
+                journal.discard()
+        self.parents.clear()
+        self.document = document
+        self.update_title()
+
+    def open_journal(self, journal: Journal) -> bool:
+        # A journal left behind by a crash is offered for recovery, returns True if it was recovered
+        if not journal.exists():
+            return False
+        answer = QtWidgets.QMessageBox.question(self.window, "Recover",
+                                                f"Unsaved changes to {os.path.basename(journal.document_path)} were found. Recover them?")
+        recovered = journal.read() if answer == QtWidgets.QMessageBox.Yes else None
+        if not recovered:
+            journal.discard()
+            return False
+        area = self.window.flowchart_area
+        diagram_data, operations = recovered
+        area.load_from_diagram_data(diagram_data)
+        area.replay(operations)
+        # Compacted right away, so the recovered state doesn't depend on the old log
+        self.set_journal(journal, area.save_to_diagram_data())
+        return True
+
+    def set_journal(self, journal: Journal, diagram_data: Optional[DiagramData] = None) -> None:
+        # Logging starts over the document, or over a snapshot of diagram_data
+        if self.journal and self.journal is not journal:
+            self.journal.discard()
+        journal.compact(diagram_data)
+        self.journal = journal
+        self.window.flowchart_area.journal = journal
+
+    def handle_close(self) -> None:
+        # Nothing to recover after a clean exit
+        if self.journal:
+            self.journal.discard()
+        for _, _, journal, _ in self.parents:
+            if journal:
+                journal.discard()
 
     def handle_save(self, diagram_data: DiagramData) -> None:
-        file_path, _ = QtWidgets.QFileDialog.getSaveFileName(self.window, "Save Flowchart", "", "JSON Files (*.json)")
-        if file_path:
-            Serializer.save_to_file(diagram_data, file_path)
-
-    def handle_load(self) -> DiagramData:
-        file_path, _ = QtWidgets.QFileDialog.getOpenFileName(self.window, "Load Flowchart", "", "JSON Files (*.json)")
-        if file_path:
-            diagram_data = Serializer.load_from_file(file_path)
-            if diagram_data:
-                return diagram_data
-            else:
-                QtWidgets.QMessageBox.warning(self.window, "Error", "Failed to load file. Please check the format.")
+        # diagram_data is a snapshot of the area, so it is written in the background. A sub-diagram
+        # is written back to the document it was opened from
+        if self.parents:
+            document = self.document
+            self.start_task("Saving sub-diagram...",
+                            lambda progress: Serializer.save_document(diagram_data, document, progress=progress),
+                            lambda saved: self.handle_saved(saved, document))
+            return
+        file_path, _ = QtWidgets.QFileDialog.getSaveFileName(self.window, "Save Flowchart", "", "JSON Files (*.json);;Binary Flowcharts (*.fcb)")
+        if not file_path:
+            return
+        if self.document:
+            # The sections of the loaded file go along with the diagram
+            source = self.document
+            self.start_task("Saving flowchart...",
+                            lambda progress: Serializer.save_document(diagram_data, file_path, progress=progress, source=source),
+                            lambda saved: self.handle_saved(saved, file_path))
+        else:
+            self.start_task("Saving flowchart...",
+                            lambda progress: Serializer.save_to_file(diagram_data, file_path, progress=progress),
+                            lambda saved: self.handle_saved(saved, file_path))
+
+    def handle_saved(self, saved: bool, document: str) -> None:
+        if saved:
+            # The saved document is the new base of the journal
+            journal = Journal(document)
+            journal.discard()
+            self.set_journal(journal)
+            self.cache.discard(Serializer.split_document(document)[0])
+            self.window.flowchart_area.modified = False
+            self.document = document
+            self.update_title()
+        elif not self.task.cancelled:
+            QtWidgets.QMessageBox.warning(self.window, "Error", "Failed to save file.")
+        self.finish_task()
+
+    def handle_load(self) -> None:
+        file_path, _ = QtWidgets.QFileDialog.getOpenFileName(self.window, "Load Flowchart", "", "JSON Files (*.json);;Binary Flowcharts (*.fcb)")
+        if not file_path or self.task:
+            return
+        if self.open_journal(Journal(file_path)):
+            self.set_document(file_path)
+        else:
+            self.start_task("Loading flowchart...", lambda progress: self.load_diagram_data(file_path, progress),
+                            lambda diagram_data: self.handle_loaded(diagram_data, lambda: self.handle_load_finished(file_path)))
+
+    def handle_open_child(self, shape: 'Shape') -> None:
+        # Drills into the sub-diagram of the shape. The shown diagram is kept with its unsaved
+        # changes, and the sub-diagram is loaded only now, through the cache
+        if self.task:
+            return
+        try:
+            document = Serializer.resolve_reference(self.document, shape.child)
+        except ValueError as e:
+            QtWidgets.QMessageBox.warning(self.window, "Error", f"Failed to open sub-diagram: {e}.")
+            return
+        if document in [self.document] + [parent for parent, _, _, _ in self.parents]:
+            QtWidgets.QMessageBox.warning(self.window, "Error", f"{os.path.basename(document)} is already open.")
+            return
+        area = self.window.flowchart_area
+        self.parents.append((self.document, area.save_to_diagram_data(), self.journal, area.modified))
+        self.journal = None
+        area.journal = None
+        if self.open_journal(Journal(document)):
+            self.document = document
+            self.update_title()
+            return
+        self.start_task("Opening sub-diagram...", lambda progress: self.load_child(document),
+                        lambda diagram_data: self.handle_child_loaded(diagram_data, document))
+
+    def load_child(self, document: str) -> Optional[DiagramData]:
+        # Runs on a worker thread, like load_diagram_data. A sub-diagram that doesn't exist yet
+        # starts empty and is created when it is saved
+        file_path, section = Serializer.split_document(document)
+        if not os.path.exists(file_path):
+            return DiagramData(shapes=[], arrows=[])
+        if section is not None:
+            root = self.cache.get(file_path)
+            if root is not None and section not in root.sections:
+                return DiagramData(shapes=[], arrows=[])
+        diagram_data = self.cache.get(document)
+        if diagram_data and Serializer.validate(diagram_data):
+            return diagram_data
+        return None
+
+    def handle_child_loaded(self, diagram_data: Optional[DiagramData], document: str) -> None:
+        if diagram_data is None or self.task.cancelled:
+            # The parent is still shown, logging goes on in its journal
+            _, _, journal, _ = self.parents.pop()
+            self.journal = journal
+            self.window.flowchart_area.journal = journal
+        self.handle_loaded(diagram_data, lambda: self.handle_child_opened(document))
+
+    def handle_child_opened(self, document: str) -> None:
+        self.set_journal(Journal(document))
+        self.document = document
+        self.update_title()
+        self.finish_task()
+
+    def handle_up(self) -> None:
+        # Back to the diagram the shown one was opened from, the changes made to the shown one are saved first
+        if not self.parents or self.task:
+            return
+        area = self.window.flowchart_area
+        if not area.modified:
+            self.return_to_parent()
+            return
+        diagram_data = area.save_to_diagram_data()
+        document = self.document
+        self.start_task("Saving sub-diagram...",
+                        lambda progress: Serializer.save_document(diagram_data, document, progress=progress),
+                        lambda saved: self.handle_child_saved(saved, document))
+
+    def handle_child_saved(self, saved: bool, document: str) -> None:
+        if saved:
+            self.cache.discard(Serializer.split_document(document)[0])
+        elif not self.task.cancelled:
+            QtWidgets.QMessageBox.warning(self.window, "Error", "Failed to save sub-diagram.")
+        self.finish_task()
+        if saved:
+            self.return_to_parent()
+
+    def return_to_parent(self) -> None:
+        if self.journal:
+            self.journal.discard()
+        self.journal = None
+        self.window.flowchart_area.journal = None
+        parent = self.parents.pop()
+        self.start_task("Returning to flowchart...", lambda progress: parent[1],
+                        lambda diagram_data: self.handle_parent_loaded(diagram_data, parent))
+
+    def handle_parent_loaded(self, diagram_data: DiagramData, parent: Tuple[Optional[str], DiagramData, Optional[Journal], bool]) -> None:
+        if self.task.cancelled:
+            # Still in the sub-diagram, whose changes were saved
+            self.parents.append(parent)
+            self.set_journal(Journal(self.document))
+            self.finish_task()
+            return
+        document, _, journal, modified = parent
+        self.handle_loaded(diagram_data, lambda: self.handle_parent_restored(document, journal, modified))
+
+    def handle_parent_restored(self, document: Optional[str], journal: Optional[Journal], modified: bool) -> None:
+        # Its journal already holds the restored state, so logging just goes on
+        area = self.window.flowchart_area
+        self.journal = journal
+        area.journal = journal
+        area.modified = modified
+        self.document = document
+        self.update_title()
+        self.finish_task()
+
+    @staticmethod
+    def load_diagram_data(file_path: str, progress: Callable[[int, int], None]) -> Optional[DiagramData]:
+        # Runs on a worker thread, the streaming parser keeps the GUI thread responsive
+        diagram_data = Serializer.load_from_file(file_path, streaming=True, progress=progress)
+        if diagram_data and Serializer.validate(diagram_data):
+            return diagram_data
         return None
 
+    def handle_loaded(self, diagram_data: Optional[DiagramData], finished: Callable[[], None]) -> None:
+        # finished is called once all shapes were added
+        if self.task.cancelled:
+            self.finish_task()
+        elif diagram_data:
+            # Shapes are handed to the area in chunks from the event loop
+            self.progress_dialog.setLabelText("Adding shapes...")
+            self.progress_dialog.canceled.connect(self.handle_load_cancelled)
+            self.window.flowchart_area.load_incrementally(diagram_data, self.handle_load_progress, finished)
+        else:
+            self.finish_task()
+            QtWidgets.QMessageBox.warning(self.window, "Error", "Failed to load file. Please check the format.")
+
+    def handle_load_finished(self, file_path: str) -> None:
+        self.set_journal(Journal(file_path))
+        self.set_document(file_path)
+        self.finish_task()
+
+    def handle_load_cancelled(self) -> None:
+        # The area is left empty, like a new diagram. The hierarchy is left, with the journals
+        # of its diagrams kept for recovery
+        self.window.flowchart_area.cancel_loading()
+        for _, _, journal, _ in self.parents:
+            if journal:
+                journal.close()
+        self.parents.clear()
+        self.set_journal(Journal(self.get_untitled_path()))
+        self.document = None
+        self.update_title()
+        self.finish_task()
+
+    def handle_load_progress(self, done: int, total: int) -> None:
+        self.progress_dialog.setValue(done * 100 // total if total else 100)
+
+    def handle_auto_layout(self) -> None:
+        # Computed in the background from a snapshot, the dialog keeps the area from being edited meanwhile
+        area = self.window.flowchart_area
+        shapes = list(area.shapes)
+        diagram_data = area.save_to_diagram_data()
+        self.start_task("Laying out flowchart...", lambda progress: LayeredLayout().layout(diagram_data, progress),
+                        lambda positions: self.handle_laid_out(shapes, positions))
+
+    def handle_laid_out(self, shapes: List['Shape'], positions: Optional[List[Tuple[int, int]]]) -> None:
+        if positions is not None and not self.task.cancelled:
+            self.window.flowchart_area.move_shapes(shapes, positions)
+        elif not self.task.cancelled:
+            QtWidgets.QMessageBox.warning(self.window, "Error", "Failed to lay out flowchart.")
+        self.finish_task()
+
+    def start_task(self, label: str, function: Callable[[Callable[[int, int], None]], object],
+                   finished: Callable[[object], None]) -> None:
+        if self.task:
+            return  # Only one load or save at a time
+        self.progress_dialog = QtWidgets.QProgressDialog(label, "Cancel", 0, 100, self.window)
+        self.progress_dialog.setWindowModality(QtCore.Qt.WindowModal)
+        self.progress_dialog.setAutoReset(False)
+        self.progress_dialog.setMinimumDuration(500)
+        self.task = BackgroundTask(function)
+        self.task.progress.connect(self.progress_dialog.setValue)
+        self.task.finished.connect(finished)
+        self.progress_dialog.canceled.connect(self.task.cancel)
+        self.task.start()
+
+    def finish_task(self) -> None:
+        # Not closed first, closing a progress dialog emits canceled
+        self.progress_dialog.deleteLater()
+        self.progress_dialog = None
+        self.task = None
+
 
 class Window(QtWidgets.QMainWindow):
     def __init__(self, editor: FlowchartEditor):
@@ -95,20 +641,34 @@ class Window(QtWidgets.QMainWindow):
         layout.addWidget(self.flowchart_area, stretch=5)
         layout.addWidget(self.toolbar, stretch=1)
 
+        QtGui.QShortcut(QtGui.QKeySequence.Undo, self, self.handle_undo)
+        QtGui.QShortcut(QtGui.QKeySequence.Redo, self, self.handle_redo)
+        QtGui.QShortcut(QtGui.QKeySequence("F3"), self, self.flowchart_area.toggle_profiler_overlay)
+        QtGui.QShortcut(QtGui.QKeySequence.ZoomIn, self, self.handle_zoom_in)
+        QtGui.QShortcut(QtGui.QKeySequence("Ctrl+="), self, self.handle_zoom_in)
+        QtGui.QShortcut(QtGui.QKeySequence.ZoomOut, self, self.handle_zoom_out)
+        QtGui.QShortcut(QtGui.QKeySequence("Ctrl+0"), self, self.handle_reset_zoom)
+        QtGui.QShortcut(QtGui.QKeySequence("Ctrl+9"), self, self.handle_zoom_to_fit)
+        QtGui.QShortcut(QtGui.QKeySequence.SelectAll, self, self.flowchart_area.select_all)
+        QtGui.QShortcut(QtGui.QKeySequence("Escape"), self, self.flowchart_area.clear_selection)
+        QtGui.QShortcut(QtGui.QKeySequence.Delete, self, self.handle_delete)
+        QtGui.QShortcut(QtGui.QKeySequence("Alt+Up"), self, self.handle_up)
+        self.flowchart_area.child_requested.connect(self.handle_open_child)
+
     def handle_add_process(self) -> None:
-        new_shape = Process(self.flowchart_area)
+        new_shape = Process()
         self.flowchart_area.add_shape(new_shape)
 
     def handle_add_decision(self) -> None:
-        new_shape = Decision(self.flowchart_area)
+        new_shape = Decision()
         self.flowchart_area.add_shape(new_shape)
 
     def handle_add_terminator(self) -> None:
-        new_shape = Terminator(self.flowchart_area)
+        new_shape = Terminator()
         self.flowchart_area.add_shape(new_shape)
 
     def handle_add_io(self) -> None:
-        new_shape = IO(self.flowchart_area)
+        new_shape = IO()
         self.flowchart_area.add_shape(new_shape)
 
     def handle_save(self) -> None:
@@ -116,9 +676,56 @@ class Window(QtWidgets.QMainWindow):
         self.editor.handle_save(diagram_data)
 
     def handle_load(self) -> None:
-        diagram_data = self.editor.handle_load()
-        if diagram_data:
-            self.flowchart_area.load_from_diagram_data(diagram_data)
+        self.editor.handle_load()
+
+    def handle_auto_layout(self) -> None:
+        self.editor.handle_auto_layout()
+
+    def handle_link_child(self) -> None:
+        # Links the selected process to a sub-diagram, an empty reference unlinks it
+        shapes = list(self.flowchart_area.selection)
+        if len(shapes) != 1 or not isinstance(shapes[0], Process):
+            QtWidgets.QMessageBox.information(self, "Sub-diagram", "Select a single process to link it to a sub-diagram.")
+            return
+        shape = shapes[0]
+        reference, ok = QtWidgets.QInputDialog.getText(self, "Sub-diagram", "File, #section of this file or file#section:",
+                                                       text=shape.child or "")
+        if ok:
+            self.flowchart_area.link_child(shape, reference.strip() or None)
+
+    def handle_open_child(self, shape: 'Shape') -> None:
+        self.editor.handle_open_child(shape)
+
+    def handle_up(self) -> None:
+        self.editor.handle_up()
+
+    def handle_zoom_in(self) -> None:
+        self.flowchart_area.zoom_by(Area.zoom_step)
+
+    def handle_zoom_out(self) -> None:
+        self.flowchart_area.zoom_by(1 / Area.zoom_step)
+
+    def handle_reset_zoom(self) -> None:
+        self.flowchart_area.reset_zoom()
+
+    def handle_zoom_to_fit(self) -> None:
+        self.flowchart_area.zoom_to_fit()
+
+    def handle_delete(self) -> None:
+        self.flowchart_area.delete_selection()
+
+    def handle_align(self, alignment: str) -> None:
+        self.flowchart_area.align_selection(alignment)
+
+    def handle_undo(self) -> None:
+        self.flowchart_area.undo()
+
+    def handle_redo(self) -> None:
+        self.flowchart_area.redo()
+
+    def closeEvent(self, event):
+        self.editor.handle_close()
+        super().closeEvent(event)
 
 
 class Toolbar(QtWidgets.QWidget):
@@ -131,6 +738,14 @@ class Toolbar(QtWidgets.QWidget):
         btn_add_io = QtWidgets.QPushButton("Add I/O", self)
         btn_save = QtWidgets.QPushButton("Save", self)
         btn_load = QtWidgets.QPushButton("Load", self)
+        btn_auto_layout = QtWidgets.QPushButton("Auto Layout", self)
+        btn_link_child = QtWidgets.QPushButton("Sub-diagram", self)
+        btn_up = QtWidgets.QPushButton("Up", self)
+        btn_zoom_to_fit = QtWidgets.QPushButton("Zoom to Fit", self)
+        btn_align = QtWidgets.QPushButton("Align", self)
+        btn_delete = QtWidgets.QPushButton("Delete", self)
+        btn_undo = QtWidgets.QPushButton("Undo", self)
+        btn_redo = QtWidgets.QPushButton("Redo", self)
 
         window_parent = cast(Window, self.parent())
         btn_add_process.clicked.connect(window_parent.handle_add_process)
@@ -139,6 +754,18 @@ class Toolbar(QtWidgets.QWidget):
         btn_add_io.clicked.connect(window_parent.handle_add_io)
         btn_save.clicked.connect(window_parent.handle_save)
         btn_load.clicked.connect(window_parent.handle_load)
+        btn_auto_layout.clicked.connect(window_parent.handle_auto_layout)
+        btn_link_child.clicked.connect(window_parent.handle_link_child)
+        btn_up.clicked.connect(window_parent.handle_up)
+        btn_zoom_to_fit.clicked.connect(window_parent.handle_zoom_to_fit)
+        btn_delete.clicked.connect(window_parent.handle_delete)
+        # The selected shapes are aligned through a menu of the button
+        align_menu = QtWidgets.QMenu(btn_align)
+        for alignment in ("left", "center", "right", "top", "middle", "bottom"):
+            align_menu.addAction(f"Align {alignment.capitalize()}", functools.partial(window_parent.handle_align, alignment))
+        btn_align.setMenu(align_menu)
+        btn_undo.clicked.connect(window_parent.handle_undo)
+        btn_redo.clicked.connect(window_parent.handle_redo)
 
         layout.addWidget(btn_add_process)
         layout.addWidget(btn_add_decision)
@@ -146,135 +773,541 @@ class Toolbar(QtWidgets.QWidget):
         layout.addWidget(btn_add_io)
         layout.addWidget(btn_save)
         layout.addWidget(btn_load)
+        layout.addWidget(btn_auto_layout)
+        layout.addWidget(btn_link_child)
+        layout.addWidget(btn_up)
+        layout.addWidget(btn_zoom_to_fit)
+        layout.addWidget(btn_align)
+        layout.addWidget(btn_delete)
+        layout.addWidget(btn_undo)
+        layout.addWidget(btn_redo)
 
 class Area(QtWidgets.QWidget):
+    arrow_color = QtGui.QColor('black')
+    arrow_width = 3
+    scroll_step = 2  # Wheel angle delta per scrolled pixel
+    zoom_step = 1.25  # Zoom factor per wheel notch or shortcut
+    min_zoom = 0.01
+    max_zoom = 4.0
+    fit_margin = 20  # View pixels around the diagram when zooming to fit
+    # Level of detail: text, nodes, the cross and arrowheads are drawn from detail_zoom on. Below
+    # overview_zoom shapes are plain rectangles, drawn with the arrows into a cached pixmap
+    detail_zoom = 0.5
+    overview_zoom = 0.15
+    overview_color = QtGui.QColor(120, 120, 120)
+    overview_dirty_limit = 500  # Invalidated rectangles above which the overview is rendered again as a whole
+    drag_detail_limit = 50  # Dragged shapes above which arrows passing by are only rerouted on drop
+    load_chunk_size = 50  # Records added between checks of the load step budget
+    load_step_budget = 0.01  # Seconds spent loading per event loop iteration
+    child_requested = QtCore.Signal(object)  # A shape whose sub-diagram is to be opened
+
+    # Shapes are lightweight records drawn by the area itself, only the ones
+    # intersecting the repainted part of the view are touched when painting
     def __init__(self, parent: Window):
         super().__init__(parent)
-        self.shape_mapping = {
-            'Process': Process,
-            'Decision': Decision,
-            'Terminator': Terminator,
-            'IO': IO
-        }
-        self.arrow_color = QtGui.QColor('black')
-        self.arrow_width = 3
+        self.shape_mapping = SHAPE_CLASSES
+        QtGui.QPixmapCache.setCacheLimit(max(QtGui.QPixmapCache.cacheLimit(), Shape.pixmap_cache_limit))
         self.arrow_start = None
         self.arrow_end = None
-        self.shapes: List[Shape] = []
-        self.arrows: List[Shape] = []
+        # Insertion ordered dicts used as sets, so removal doesn't scan
+        self.shapes: Dict[Shape, None] = {}
+        self.arrows: Dict[Arrow, None] = {}
+        # Adjacency between shapes, nodes and arrows, kept in sync by add_arrow and remove_arrow
+        self.node_arrows: Dict[Node, Set[Arrow]] = {}
+        self.shape_arrows: Dict[Shape, Set[Arrow]] = {}
+        # Position of each shape in save order, rebuilt lazily after removals and restacking
+        self.shape_indices: Optional[Dict[Shape, int]] = {}
         self.active_shape = None
+        self.hovered_shape = None
+        self.selection: Dict[Shape, None] = {}  # Ordered set, like shapes
+        # Positions of the selected shapes when a drag started, and the scene position it started at
+        self.dragged_shapes: Optional[Dict[Shape, Tuple[int, int]]] = None
+        self.drag_start: Optional[QtCore.QPoint] = None
+        # Corners of the rectangle selecting the shapes within it, in scene coordinates
+        self.band_start: Optional[QtCore.QPoint] = None
+        self.band_end: Optional[QtCore.QPoint] = None
+        self.shape_index = SpatialGrid()
+        self.node_index = SpatialGrid()
+        self.arrow_index = SegmentIndex()  # Holds the route of every arrow
+        self.router = OrthogonalRouter(self.shape_index)
+        self.pending_reroute: Optional[Set[Arrow]] = None  # Collected during a batch of edits
+        # Arrows moved along with the shapes being dragged and the bounds of their routes,
+        # which are ahead of the arrow index
+        self.shifted_arrows: Dict[Arrow, QtCore.QRect] = {}
+        self.z_counter = 0
+        # Edits are logged to the journal, shapes are referred to by shape_id there
+        self.journal: Optional[Journal] = None
+        self.modified = False  # Edited since loaded or saved, see FlowchartEditor.handle_up
+        self.undo_stack = UndoStack()
+        # Scene position shown at the top left corner of the area, and view pixels per scene pixel
+        self.view_offset = QtCore.QPoint(0, 0)
+        self.zoom = 1.0
+        self.pan_start: Optional[Tuple[QtCore.QPoint, QtCore.QPoint]] = None  # Mouse position and view offset
+        # Zoomed out view, see paint_overview: (zoom level, pixel ratio, scene rect, pixmap), the
+        # scene rects invalidated since it was rendered and the drawing primitives it is made of
+        self.overview: Optional[Tuple[float, float, QtCore.QRect, QtGui.QPixmap]] = None
+        self.overview_dirty: List[QtCore.QRect] = []
+        self.shape_rects: Dict[Shape, QtCore.QRect] = {}
+        self.arrow_lines: Dict[Arrow, List[QtCore.QLine]] = {}
+        # Incremental loading state, see load_incrementally
+        self.loader: Optional[Iterator[Tuple[int, int]]] = None
+        self.load_progress = None
+        self.load_finished = None
+        self.load_timer = QtCore.QTimer(self)
+        self.load_timer.timeout.connect(self.handle_load_step)
+        # Mouse moves waiting for the next display frame, see mouseMoveEvent
+        self.pending_mouse_pos: Optional[QtCore.QPoint] = None
+        self.last_frame_time = 0.0
+        self.frame_timer = QtCore.QTimer(self)
+        self.frame_timer.setSingleShot(True)
+        self.frame_timer.setTimerType(QtCore.Qt.PreciseTimer)
+        self.frame_timer.timeout.connect(self.handle_frame)
+        self.connector_layer = ConnectorLayer(self)
+        self.profiler_overlay = ProfilerOverlay(self) if profiler.enabled else None
         self.setMouseTracking(True)
+
+    def resizeEvent(self, event):
+        # Keep the connector layer covering the whole area
+        self.connector_layer.resize(self.size())
+        super().resizeEvent(event)
+
+    @profiler.timed("Area.paintEvent")
+    def paintEvent(self, event):
+        if self.zoom < self.overview_zoom:
+            self.paint_overview()
+            return
+        self.overview = None
+
+        # Draw the shapes intersecting the repainted region, bottom to top, with one painter
+        shapes = set()
+        for rect in event.region():
+            shapes.update(self.shapes_in_rect(self.to_scene_rect(rect)))
+
+        ratio = self.devicePixelRatioF()
+        detailed = self.is_detailed()
+        with QtGui.QPainter(self) as painter:
+            self.apply_view_transform(painter)
+            for shape in sorted(shapes, key=lambda shape: shape.z_order):
+                shape.paint(painter, ratio * self.zoom, detailed)
+
+    def paint_overview(self) -> None:
+        # The view and a quarter of it around are rendered at the next power of two zoom. The
+        # pixmap is scaled while zooming within a factor of two and moved while panning, edits
+        # render only the parts they invalidated again
+        visible = self.get_visible_scene_rect()
+        level = 2 ** math.ceil(math.log2(self.zoom))
+        ratio = self.devicePixelRatioF()
+        if self.overview is None or self.overview[:2] != (level, ratio) or not self.overview[2].contains(visible) \
+                or len(self.overview_dirty) > self.overview_dirty_limit:
+            margin_x, margin_y = visible.width() // 4, visible.height() // 4
+            scene_rect = visible.adjusted(-margin_x, -margin_y, margin_x, margin_y)
+            self.overview = (level, ratio, scene_rect, self.render_overview(level, ratio, scene_rect))
+            self.overview_dirty = []
+        elif self.overview_dirty:
+            self.update_overview()
+
+        _, _, scene_rect, pixmap = self.overview
+        with QtGui.QPainter(self) as painter:
+            painter.setRenderHint(QtGui.QPainter.SmoothPixmapTransform)
+            self.apply_view_transform(painter)
+            painter.drawPixmap(QtCore.QRectF(scene_rect), pixmap, QtCore.QRectF(pixmap.rect()))
+
+    @profiler.timed("Area.render_overview")
+    def render_overview(self, level: float, ratio: float, scene_rect: QtCore.QRect) -> QtGui.QPixmap:
+        pixmap = QtGui.QPixmap(max(1, math.ceil(scene_rect.width() * level * ratio)),
+                               max(1, math.ceil(scene_rect.height() * level * ratio)))
+        pixmap.setDevicePixelRatio(ratio)
+        pixmap.fill(QtCore.Qt.transparent)
+        with QtGui.QPainter(pixmap) as painter:
+            painter.scale(level, level)
+            painter.translate(-scene_rect.left(), -scene_rect.top())
+            self.draw_overview(painter, self.shapes_in_rect(scene_rect), set(self.shifted_arrows).union(self.arrows_in_rect(scene_rect)))
+        return pixmap
+
+    def update_overview(self) -> None:
+        level, _, scene_rect, pixmap = self.overview
+        dirty, self.overview_dirty = self.overview_dirty, []
+        region = QtGui.QRegion()
+        shapes, arrows = set(), set(self.shifted_arrows)
+        padding = math.ceil(1 / level)  # A pixel, so rounding leaves nothing stale
+        for rect in dirty:
+            rect = rect.adjusted(-padding, -padding, padding, padding).intersected(scene_rect)
+            if not rect.isEmpty():
+                region += rect
+                shapes.update(self.shapes_in_rect(rect))
+                arrows.update(self.arrows_in_rect(rect))
+        with QtGui.QPainter(pixmap) as painter:
+            painter.scale(level, level)
+            painter.translate(-scene_rect.left(), -scene_rect.top())
+            painter.setClipRegion(region)
+            painter.setCompositionMode(QtGui.QPainter.CompositionMode_Source)
+            painter.fillRect(region.boundingRect(), QtCore.Qt.transparent)
+            painter.setCompositionMode(QtGui.QPainter.CompositionMode_SourceOver)
+            self.draw_overview(painter, shapes, arrows)
+
+    def draw_overview(self, painter: QtGui.QPainter, shapes: Iterable['Shape'], arrows: Iterable['Arrow']) -> None:
+        # A single call each, arrows on top with a cosmetic one pixel pen. The rectangles and
+        # lines are kept until the shape or arrow changes
+        shapes, arrows = list(shapes), list(arrows)
+        for shape in shapes:
+            if shape not in self.shape_rects:
+                self.shape_rects[shape] = shape.geometry()
+        for arrow in arrows:
+            if arrow not in self.arrow_lines:
+                self.arrow_lines[arrow] = [QtCore.QLine(x1, y1, x2, y2) for (x1, y1), (x2, y2) in zip(arrow.route, arrow.route[1:])]
+        painter.setPen(QtCore.Qt.NoPen)
+        painter.setBrush(self.overview_color)
+        painter.drawRects([self.shape_rects[shape] for shape in shapes if not shape.selected])
+        painter.setBrush(Shape.selection_color)
+        painter.drawRects([self.shape_rects[shape] for shape in shapes if shape.selected])
+        painter.setPen(QtGui.QPen(self.arrow_color, 0))
+        painter.drawLines([line for arrow in arrows for line in self.arrow_lines[arrow]])
+
+    def apply_view_transform(self, painter: QtGui.QPainter) -> None:
+        painter.scale(self.zoom, self.zoom)
+        painter.translate(-self.view_offset.x(), -self.view_offset.y())
+
+    def is_detailed(self) -> bool:
+        # Nodes and the cross are only shown, and usable, from this zoom on
+        return self.zoom >= self.detail_zoom
+
+    def wheelEvent(self, event):
+        # Scroll the view, shift scrolls horizontally and control zooms around the mouse
+        delta = event.angleDelta()
+        if event.modifiers() & QtCore.Qt.ControlModifier:
+            if delta.y():
+                self.zoom_at(event.position().toPoint(), self.zoom_step ** (delta.y() / 120))
+            return
+        dx, dy = delta.x() / self.scroll_step, delta.y() / self.scroll_step
+        if event.modifiers() & QtCore.Qt.ShiftModifier and not dx:
+            dx, dy = dy, 0
+        self.view_offset -= QtCore.QPoint(round(dx / self.zoom), round(dy / self.zoom))
+        self.update()
+
+    def zoom_at(self, pos: QtCore.QPoint, factor: float) -> None:
+        # The scene point under pos stays in place
+        zoom = min(self.max_zoom, max(self.min_zoom, self.zoom * factor))
+        scene_x = self.view_offset.x() + pos.x() / self.zoom
+        scene_y = self.view_offset.y() + pos.y() / self.zoom
+        self.zoom = zoom
+        self.view_offset = QtCore.QPoint(round(scene_x - pos.x() / zoom), round(scene_y - pos.y() / zoom))
+        self.update()
+
+    def zoom_by(self, factor: float) -> None:
+        self.zoom_at(self.rect().center(), factor)
+
+    def reset_zoom(self) -> None:
+        self.zoom_by(1 / self.zoom)
+
+    def zoom_to_fit(self) -> None:
+        # Show the whole diagram, never zooming in past 100%
+        if not self.shapes:
+            self.reset_zoom()
+            return
+        bounds = QtCore.QRect()
+        for shape in self.shapes:
+            bounds = bounds.united(shape.geometry())
+        width, height = max(1, self.width() - 2 * self.fit_margin), max(1, self.height() - 2 * self.fit_margin)
+        self.zoom = min(1.0, self.max_zoom, max(self.min_zoom, min(width / bounds.width(), height / bounds.height())))
+        center = bounds.center()
+        self.view_offset = QtCore.QPoint(round(center.x() - self.width() / 2 / self.zoom),
+                                         round(center.y() - self.height() / 2 / self.zoom))
+        self.update()
+
+    def leaveEvent(self, event):
+        self.flush_mouse_move()
+        self.set_hovered_shape(None)
+
+    def toggle_profiler_overlay(self) -> None:
+        if self.profiler_overlay:
+            self.profiler_overlay.toggle()
     
     def mouseMoveEvent(self, event):
-        mouse_pos = event.pos()
-        # Handle moving of shape or creation of arrow
-        if self.active_shape and not self.active_shape.locked:
-            delta = mouse_pos - self.drag_start
-            new_pos = self.shape_start_pos + delta
-            self.active_shape.move(new_pos)
+        # Mice may report moves far more often than the screen refreshes, so only the latest
+        # position is applied, at most once per display frame. The first move after a pause
+        # is applied on the next event loop iteration, the latency stays within a frame
+        self.pending_mouse_pos = event.pos()
+        if not self.frame_timer.isActive():
+            wait = self.last_frame_time + self.get_frame_interval() - time.perf_counter()
+            self.frame_timer.start(max(0, math.ceil(wait * 1000)))
+
+    def get_frame_interval(self) -> float:
+        # In seconds, of the screen the area is on
+        screen = self.screen()
+        return 1 / ((screen.refreshRate() if screen else 0) or 60)
+
+    def handle_frame(self) -> None:
+        if self.pending_mouse_pos is not None:
+            pos, self.pending_mouse_pos = self.pending_mouse_pos, None
+            self.last_frame_time = time.perf_counter()
+            self.apply_mouse_move(pos)
+
+    def flush_mouse_move(self) -> None:
+        # Clicks act on the position of the last move
+        self.frame_timer.stop()
+        self.handle_frame()
+
+    @profiler.timed("Area.apply_mouse_move")
+    def apply_mouse_move(self, pos: QtCore.QPoint) -> None:
+        if self.pan_start:
+            start_pos, start_offset = self.pan_start
+            delta = pos - start_pos
+            self.view_offset = start_offset - QtCore.QPoint(round(delta.x() / self.zoom), round(delta.y() / self.zoom))
+            self.update()
+            return
+
+        mouse_pos = self.to_scene(pos)
+        # Handle moving of the selected shapes, creation of an arrow or selecting with a rectangle
+        # Only the regions that actually change are repainted. Hovering is left alone while
+        # dragging shapes or a rectangle, and updated once they are released
+        if self.dragged_shapes:
+            self.handle_drag(mouse_pos)
+            return
         elif self.arrow_start:
+            self.invalidate_rubber_band()
             self.arrow_end = mouse_pos
-
-        # Handle hovering over nodes
+            self.invalidate_rubber_band()
+        elif self.band_start:
+            self.invalidate_selection_band()
+            self.band_end = mouse_pos
+            self.invalidate_selection_band()
+            return
+        self.update_hover(mouse_pos)
+
+    def update_hover(self, mouse_pos: QtCore.QPoint) -> None:
+        # Handle hovering over nodes, the topmost shape under the mouse wins
+        x, y = mouse_pos.x(), mouse_pos.y()
+        hovered_node = self.node_at(x, y) if self.is_detailed() else None
         self.active_shape = None
-        for shape in self.shapes:
-            if shape.geometry().contains(mouse_pos):
-                self.active_shape = shape
-                shape.has_active_node(mouse_pos)
-
-        self.update()
+        for shape in sorted(self.shape_index.query_point(x, y), key=lambda shape: shape.z_order):
+            self.active_shape = shape
+            active_node = hovered_node if hovered_node and hovered_node.parent is shape else None
+            if shape.active_node is not active_node:
+                shape.active_node = active_node
+                self.invalidate_shape(shape)
+        self.set_hovered_shape(self.active_shape)
         
     def mousePressEvent(self, event):
+        self.flush_mouse_move()
+        if event.button() == QtCore.Qt.MiddleButton:
+            self.pan_start = (event.pos(), QtCore.QPoint(self.view_offset))
+            return
         if event.button() != QtCore.Qt.LeftButton:
-            return  # Only process left mouse clicks
+            return  # Otherwise only process left mouse clicks
 
+        mouse_pos = self.to_scene(event.pos())
+        extend = bool(event.modifiers() & QtCore.Qt.ShiftModifier)
         if self.active_shape:
-            mouse_pos = event.pos()
-
-            if self.active_shape.on_cross(mouse_pos):
-                self.handle_shape_deletion()
+            if self.is_detailed() and self.active_shape.on_cross(mouse_pos):
+                command = RemoveCommand([self.active_shape], list(self.shape_arrows[self.active_shape]))
+                command.redo(self)
+                self.undo_stack.push(command)
+                self.active_shape = None
                 return
 
             if self.active_shape.active_node:
                 self.handle_arrow_creation(mouse_pos)
                 return
 
+            if extend:
+                # Shift-click adds the shape to the selection or takes it out
+                self.set_selected([self.active_shape], not self.active_shape.selected)
+                return
             self.handle_shape_movement(mouse_pos)
+            return
 
-        self.update()
-
-
+        # Dragging on empty space selects with a rectangle, shift keeps the current selection
+        if not extend:
+            self.clear_selection()
+        self.band_start = mouse_pos
+        self.band_end = mouse_pos
 
     def mouseDoubleClickEvent(self, event):
-        # Handle removal of arrows on double-click
-        mouse_pos = event.pos()
-        arrows_to_remove = []
-
-        for arrow in self.arrows:
-            if arrow.is_mouse_on_line(mouse_pos):
-                arrows_to_remove.append(arrow)
-        for arrow in arrows_to_remove:
-            self.arrows.remove(arrow)
-            arrow.deleteLater()
-
-        self.update()
+        # Handle opening the sub-diagram or editing the text of a shape, or removal of arrows on
+        # double-click. Shift edits the text of a shape with a sub-diagram
+        self.flush_mouse_move()
+        mouse_pos = self.to_scene(event.pos())
+        shape = self.shape_at(mouse_pos.x(), mouse_pos.y())
+        if shape:
+            if event.button() == QtCore.Qt.LeftButton and shape.child is not None and not event.modifiers() & QtCore.Qt.ShiftModifier:
+                self.child_requested.emit(shape)
+            elif event.button() == QtCore.Qt.LeftButton:
+                text, ok = QtWidgets.QInputDialog.getText(self, "Set Text", "Enter text for the shape:")
+                if ok and text:
+                    command = TextCommand(shape, shape.text, text)
+                    command.redo(self)
+                    self.undo_stack.push(command)
+            return
+
+        # Zoomed out arrows are too close together to pick one
+        arrows_to_remove = self.arrow_index.query_point(mouse_pos.x(), mouse_pos.y(), Arrow.pick_threshold) if self.is_detailed() else None
+        if arrows_to_remove:
+            command = RemoveCommand([], list(arrows_to_remove))
+            command.redo(self)
+            self.undo_stack.push(command)
 
     def mouseReleaseEvent(self, event):
+        self.flush_mouse_move()
+        if event.button() == QtCore.Qt.MiddleButton:
+            self.pan_start = None
+            return
+
         # Handle creation of arrow between two nodes
         if self.arrow_start and self.active_shape and self.active_shape.active_node:
             if self.active_shape.active_node != self.arrow_start:
-                arrow = Arrow(self, self.arrow_start, self.active_shape.active_node)
-                self.arrows.append(arrow)
-                arrow.show()
+                arrow = self.create_arrow(self.arrow_start, self.active_shape.active_node)
+                self.undo_stack.push(AddCommand([], [arrow]))
 
         # Reset arrow and shape states
+        if self.arrow_start:
+            self.invalidate_rubber_band()
         self.arrow_start = None
         self.arrow_end = None
-        if self.active_shape:
-            self.drag_start = None
-            self.shape_start_pos = None
-            self.active_shape.locked = True
-            
-        self.update()
-
-    def paintEvent(self, event):
-        super().paintEvent(event)
-        # Render arrows
-        with QtGui.QPainter(self) as painter:
-            pen = QtGui.QPen(self.arrow_color, self.arrow_width)
-            painter.setPen(pen)
-            
-            if self.arrow_start and self.arrow_end:
-                start_pos = self.arrow_start.get_global_position()
-                painter.drawLine(start_pos, self.arrow_end)
-
-            for arrow in self.arrows:
-                arrow.update()
-                
-    def handle_shape_deletion(self) -> None:
-        self.shapes.remove(self.active_shape)
-        self.active_shape.deleteLater()
-
-        # Collect and delete arrows connected to the shape
-        arrows_to_delete = [arrow for arrow in self.arrows if any(arrow.contains_node(node) for node in self.active_shape.nodes)]
-
-        for arrow in arrows_to_delete:
-            arrow.deleteLater()
-            self.arrows.remove(arrow)
-
-        self.active_shape = None
+        if self.band_start:
+            self.invalidate_selection_band()
+            band = self.get_selection_band()
+            self.set_selected([shape for shape in self.shapes_in_rect(band) if band.contains(shape.geometry())], True)
+            self.band_start = None
+            self.band_end = None
+            self.update_hover(self.to_scene(event.pos()))
+        if self.dragged_shapes:
+            self.finish_drag()
+            self.update_hover(self.to_scene(event.pos()))
+
+    def handle_drag(self, mouse_pos: QtCore.QPoint) -> None:
+        # Every frame of a drag moves the selected shapes as one batch
+        delta = mouse_pos - self.drag_start
+        dx, dy = delta.x(), delta.y()
+        positions = {shape: (x + dx, y + dy) for shape, (x, y) in self.dragged_shapes.items()}
+        if any(position != (shape.x(), shape.y()) for shape, position in positions.items()):
+            self.move_shapes_to(positions, dragging=True)
+
+    def finish_drag(self) -> None:
+        # The whole drag is logged as one move of each shape and undone in one step. The arrows
+        # of the dragged shapes, and those that went around them, are properly routed now
+        offsets = {}
+        arrows = set()
+        margin = self.router.margin
+        for shape, (x, y) in self.dragged_shapes.items():
+            if shape in self.shapes and (shape.x(), shape.y()) != (x, y):
+                offsets[shape] = (shape.x() - x, shape.y() - y)
+                arrows.update(self.arrow_index.query_rect(x - margin, y - margin, x + shape.width() - 1 + margin,
+                                                          y + shape.height() - 1 + margin))
+                self.record({"op": "move", "id": shape.shape_id, "x": shape.x(), "y": shape.y()})
+        arrows.update(self.shifted_arrows)
+        self.shifted_arrows = {}
+        self.dragged_shapes = None
+        self.drag_start = None
+        if offsets:
+            self.move_shapes_to({shape: (shape.x(), shape.y()) for shape in offsets}, arrows)
+            self.undo_stack.push(MoveCommand(offsets))
+
+    def set_hovered_shape(self, shape: Optional['Shape']) -> None:
+        # Show the cross on the shape under the mouse, reset the one it left
+        if shape is self.hovered_shape:
+            return
+        if self.hovered_shape:
+            self.hovered_shape.active_node = None
+            self.hovered_shape.show_cross = False
+            self.invalidate_shape(self.hovered_shape)
+        self.hovered_shape = shape
+        if shape:
+            shape.show_cross = True
+            self.invalidate_shape(shape)
 
     def handle_arrow_creation(self, mouse_pos) -> None:
         self.arrow_start = self.active_shape.active_node
         self.arrow_end = mouse_pos  # Set temporary end position
 
     def handle_shape_movement(self, mouse_pos) -> None:
+        # Clicking a shape outside the selection selects only it, then the selection is dragged
+        if not self.active_shape.selected:
+            self.clear_selection()
+            self.set_selected([self.active_shape], True)
         self.drag_start = mouse_pos
-        self.shape_start_pos = self.active_shape.pos()
-        self.active_shape.locked = False
-        self.active_shape.raise_()  # Bring the shape to the front
-        self.shapes.remove(self.active_shape)
-        self.shapes.append(self.active_shape)
+        self.dragged_shapes = {shape: (shape.x(), shape.y()) for shape in self.selection}
+        self.raise_shapes(list(self.selection))
+
+    # Selection
+
+    def set_selected(self, shapes: Iterable['Shape'], selected: bool) -> None:
+        changed = [shape for shape in shapes if shape.selected != selected]
+        for shape in changed:
+            shape.selected = selected
+            if selected:
+                self.selection[shape] = None
+            else:
+                del self.selection[shape]
+        if changed:
+            self.invalidate_scene_rect(self.get_shapes_rect(changed))
+
+    def clear_selection(self) -> None:
+        self.set_selected(list(self.selection), False)
+
+    def select_all(self) -> None:
+        self.set_selected(self.shapes, True)
+
+    def delete_selection(self) -> None:
+        if not self.selection:
+            return
+        shapes = list(self.selection)
+        arrows = {arrow for shape in shapes for arrow in self.shape_arrows[shape]}
+        command = RemoveCommand(shapes, list(arrows))
+        command.redo(self)
+        self.undo_stack.push(command)
+        self.active_shape = None
+
+    def link_child(self, shape: 'Shape', child: Optional[str]) -> None:
+        # Links the shape to a sub-diagram, None unlinks it
+        if child != shape.child:
+            command = ChildCommand(shape, shape.child, child)
+            command.redo(self)
+            self.undo_stack.push(command)
+
+    def align_selection(self, alignment: str) -> None:
+        # Lines the selected shapes up with the outermost one, or centers them on the selection,
+        # along one axis: left, center, right, top, middle or bottom
+        if len(self.selection) < 2:
+            return
+        shapes = list(self.selection)
+        bounds = self.get_shapes_rect(shapes)
+        if alignment == "left":
+            positions = [(bounds.left(), shape.y()) for shape in shapes]
+        elif alignment == "center":
+            positions = [(bounds.center().x() - shape.width() // 2, shape.y()) for shape in shapes]
+        elif alignment == "right":
+            positions = [(bounds.right() + 1 - shape.width(), shape.y()) for shape in shapes]
+        elif alignment == "top":
+            positions = [(shape.x(), bounds.top()) for shape in shapes]
+        elif alignment == "middle":
+            positions = [(shape.x(), bounds.center().y() - shape.height() // 2) for shape in shapes]
+        elif alignment == "bottom":
+            positions = [(shape.x(), bounds.bottom() + 1 - shape.height()) for shape in shapes]
+        else:
+            raise ValueError(f"unknown alignment {alignment}")
+        self.move_shapes(shapes, positions)
+
+    @staticmethod
+    def get_shapes_rect(shapes: Iterable['Shape']) -> QtCore.QRect:
+        left = top = math.inf
+        right = bottom = -math.inf
+        for shape in shapes:
+            left, top = min(left, shape.x()), min(top, shape.y())
+            right, bottom = max(right, shape.x() + shape.width() - 1), max(bottom, shape.y() + shape.height() - 1)
+        if left == math.inf:
+            return QtCore.QRect()
+        return QtCore.QRect(QtCore.QPoint(left, top), QtCore.QPoint(right, bottom))
+
+    def get_selection_band(self) -> QtCore.QRect:
+        return QtCore.QRect(self.band_start, self.band_end).normalized()
+
+    def invalidate_selection_band(self) -> None:
+        # Only the outline is drawn, so only its edges are repainted
+        band = self.get_selection_band()
+        margin = math.ceil(2 / self.zoom)  # The pen is a view pixel wide
+        for edge in (QtCore.QRect(band.left(), band.top(), band.width(), 1), QtCore.QRect(band.left(), band.bottom(), band.width(), 1),
+                     QtCore.QRect(band.left(), band.top(), 1, band.height()), QtCore.QRect(band.right(), band.top(), 1, band.height())):
+            self.invalidate_scene_rect(edge.adjusted(-margin, -margin, margin, margin))
 
     def save_to_diagram_data(self) -> DiagramData:
         shapes_data = []
@@ -284,74 +1317,613 @@ class Area(QtWidgets.QWidget):
         for shape in self.shapes:
             shape_data = ShapeData(
                 shape_type=shape.__class__.__name__,
-                x=shape.pos().x(),
-                y=shape.pos().y(),
+                x=shape.x(),
+                y=shape.y(),
                 width=shape.width(),
                 height=shape.height(),
-                text=shape.text
+                text=shape.text,
+                shape_id=shape.shape_id,
+                child=shape.child
             )
             shapes_data.append(shape_data)
         
         # Collect data for arrows
+        shape_indices = self.get_shape_indices()
         for arrow in self.arrows:
-            start_shape_index = self.shapes.index(arrow.start.parent)
-            start_node_index = arrow.start.parent.nodes.index(arrow.start)
-            end_shape_index = self.shapes.index(arrow.end.parent)
-            end_node_index = arrow.end.parent.nodes.index(arrow.end)
-            
             arrow_data = ArrowData(
-                start_shape_index=start_shape_index,
-                start_node_index=start_node_index,
-                end_shape_index=end_shape_index,
-                end_node_index=end_node_index
+                start_shape_index=shape_indices[arrow.start.parent],
+                start_node_index=arrow.start.index,
+                end_shape_index=shape_indices[arrow.end.parent],
+                end_node_index=arrow.end.index
             )
             arrows_data.append(arrow_data)
         
         return DiagramData(shapes=shapes_data, arrows=arrows_data)
     
     def load_from_diagram_data(self, diagram_data: DiagramData) -> None:
+        for _ in self.iter_loading(diagram_data):
+            pass
+
+    def load_incrementally(self, diagram_data: DiagramData, progress: Callable[[int, int], None] = None,
+                           finished: Callable[[], None] = None) -> None:
+        # Loads one chunk per event loop iteration, so input and painting go on meanwhile
+        self.cancel_loading()
+        self.loader = self.iter_loading(diagram_data)
+        self.load_progress = progress
+        self.load_finished = finished
+        self.load_timer.start()
+
+    def cancel_loading(self) -> None:
+        # Drops the partially loaded diagram
+        if self.loader:
+            self.load_timer.stop()
+            self.loader.close()
+            self.loader = None
+            self.clear_all_shapes_and_arrows()
+
+    def handle_load_step(self) -> None:
+        # Loads chunks until the step budget is used up, then yields to the event loop
+        deadline = time.perf_counter() + self.load_step_budget
+        try:
+            while True:
+                done, total = next(self.loader)
+                if time.perf_counter() >= deadline:
+                    break
+        except StopIteration:
+            self.load_timer.stop()
+            self.loader = None
+            if self.load_finished:
+                self.load_finished()
+            return
+        if self.load_progress:
+            self.load_progress(done, total)
+
+    def iter_loading(self, diagram_data: DiagramData) -> Iterator[Tuple[int, int]]:
+        # Builds the diagram, yielding (records done, total records) after every chunk
         self.clear_all_shapes_and_arrows()
+        loaded_shapes = []
+        loaded_ids = set()
+        total = len(diagram_data.shapes) + len(diagram_data.arrows)
+        done = 0
+        chunk_rect = QtCore.QRect()  # Scene covered by the chunk, only tracked for the zoomed out view
         
-        # Create shapes from diagram data
+        # Create shapes from diagram data, as plain records nothing is drawn until it is in view
         for shape_data in diagram_data.shapes:
             shape_class = self.shape_mapping.get(shape_data.shape_type)
             if shape_class:
-                new_shape = shape_class(self)
-                self.add_shape(new_shape)
+                new_shape = shape_class()
                 new_shape.move(shape_data.x, shape_data.y)
-                new_shape.resize(shape_data.width, shape_data.height)
                 new_shape.text = shape_data.text
+                new_shape.child = shape_data.child
+                if shape_data.shape_id not in loaded_ids:  # Duplicates get a new id
+                    new_shape.shape_id = shape_data.shape_id
+                    loaded_ids.add(shape_data.shape_id)
+                self.insert_shape(new_shape)
+                loaded_shapes.append(new_shape)
+                if self.overview:
+                    chunk_rect = chunk_rect.united(new_shape.geometry())
+            else:
+                print(f"Error loading shape: unknown type {shape_data.shape_type}")
+                loaded_shapes.append(None)  # Keeps the indices of the following shapes
+            done += 1
+            if done % self.load_chunk_size == 0:
+                chunk_rect = self.invalidate_loaded(chunk_rect)
+                yield done, total
         
         # Create arrows from diagram data
         for arrow_data in diagram_data.arrows:
-            start_shape = self.shapes[arrow_data.start_shape_index]
-            start_node = start_shape.nodes[arrow_data.start_node_index]
-            end_shape = self.shapes[arrow_data.end_shape_index]
-            end_node = end_shape.nodes[arrow_data.end_node_index]
-            
-            new_arrow = Arrow(self, start_node, end_node)
-            self.arrows.append(new_arrow)
-            new_arrow.show()
-        
-    def add_shape(self, shape: QtWidgets.QWidget) -> None:
-        shape.move(self.width() // 2 - shape.width() // 2, self.height() // 2 - shape.height() // 2)  # Center the shape on area
-        self.shapes.append(shape)
-        shape.show()
+            start_node = self.get_loaded_node(loaded_shapes, arrow_data.start_shape_index, arrow_data.start_node_index)
+            end_node = self.get_loaded_node(loaded_shapes, arrow_data.end_shape_index, arrow_data.end_node_index)
+            if start_node and end_node:
+                arrow = Arrow(start_node, end_node)
+                self.add_arrow(arrow)
+                if self.overview:
+                    chunk_rect = chunk_rect.united(self.get_route_rect(arrow.route))
+            else:
+                print(f"Error loading arrow: no node {arrow_data.start_node_index} of shape {arrow_data.start_shape_index} "
+                      f"or node {arrow_data.end_node_index} of shape {arrow_data.end_shape_index}")
+            done += 1
+            if done % self.load_chunk_size == 0:
+                chunk_rect = self.invalidate_loaded(chunk_rect)
+                yield done, total
+
+        self.invalidate_loaded(chunk_rect)
+        yield total, total
+
+    def invalidate_loaded(self, chunk_rect: QtCore.QRect) -> QtCore.QRect:
+        # Repaints after a loaded chunk, returns the empty rect of the next one
+        if self.overview and not chunk_rect.isEmpty():
+            self.overview_dirty.append(chunk_rect)
         self.update()
+        return QtCore.QRect()
+
+    @staticmethod
+    def get_route_rect(route: List[Tuple[int, int]]) -> QtCore.QRect:
+        xs, ys = [x for x, _ in route], [y for _, y in route]
+        return QtCore.QRect(QtCore.QPoint(min(xs), min(ys)), QtCore.QPoint(max(xs), max(ys)))
+
+    @staticmethod
+    def get_loaded_node(loaded_shapes: List[Optional['Shape']], shape_index: int, node_index: int) -> Optional['Node']:
+        # None when the indices are out of range or the shape could not be loaded
+        if not 0 <= shape_index < len(loaded_shapes) or loaded_shapes[shape_index] is None:
+            return None
+        nodes = loaded_shapes[shape_index].nodes
+        return nodes[node_index] if 0 <= node_index < len(nodes) else None
+
+    def add_shape(self, shape: 'Shape') -> None:
+        # Centered on the view, or at the closest free spot when something is already there
+        center = self.get_visible_scene_rect().center()
+        x, y = LayeredLayout().find_free_position(self.shape_index, center.x() - shape.width() // 2,
+                                                  center.y() - shape.height() // 2, shape.width(), shape.height())
+        shape.move(x, y)
+        self.create_shape(shape)
+        self.undo_stack.push(AddCommand([shape], []))
+
+    def move_shapes(self, shapes: List['Shape'], positions: List[Tuple[int, int]]) -> None:
+        # Moves the shapes still in the area to their positions, undone in one step
+        offsets = {shape: (x - shape.x(), y - shape.y()) for shape, (x, y) in zip(shapes, positions)
+                   if shape in self.shapes and (x, y) != (shape.x(), shape.y())}
+        if offsets:
+            command = MoveCommand(offsets)
+            command.redo(self)
+            self.undo_stack.push(command)
+
+    def undo(self) -> None:
+        self.undo_stack.undo(self)
+
+    def redo(self) -> None:
+        self.undo_stack.redo(self)
+
+    # Edits, each one is logged to the journal
+
+    def create_shape(self, shape: 'Shape') -> None:
+        self.insert_shape(shape)
+        self.invalidate_shape(shape)
+        self.reroute_arrows(self.get_arrows_near(shape))
+        self.record({"op": "add_shape", "id": shape.shape_id, "shape_type": shape.__class__.__name__,
+                     "x": shape.x(), "y": shape.y(), "text": shape.text, "child": shape.child})
+
+    def delete_shape(self, shape: 'Shape') -> None:
+        self.record({"op": "remove_shape", "id": shape.shape_id})
+        # Delete arrows connected to the shape
+        for arrow in list(self.shape_arrows[shape]):
+            self.invalidate_arrow(arrow)
+            self.remove_arrow(arrow)
+
+        arrows = self.get_arrows_near(shape)
+        del self.shapes[shape]
+        del self.shape_arrows[shape]
+        for node in shape.nodes:
+            del self.node_arrows[node]
+        self.shape_indices = None
+        self.unindex_shape(shape)
+        self.invalidate_shape(shape)
+        self.reroute_arrows(arrows)  # Arrows going around the shape may take a shorter way now
+        if self.hovered_shape is shape:
+            self.hovered_shape = None
+        if shape.selected:
+            self.set_selected([shape], False)
+        shape.show_cross = False  # The shape may be restored by undo
+        shape.active_node = None
+
+    def place_shapes(self, positions: Dict['Shape', Tuple[int, int]]) -> None:
+        # Same as dragging the shapes from their current positions to their (x, y), all at once
+        self.raise_shapes(list(positions))
+        self.move_shapes_to(positions)
+        for shape, (x, y) in positions.items():
+            self.record({"op": "move", "id": shape.shape_id, "x": x, "y": y})
+
+    def move_shapes_to(self, positions: Dict['Shape', Tuple[int, int]], arrows: Iterable['Arrow'] = (),
+                       dragging: bool = False) -> None:
+        # Moves the shapes as one batch: what they and their arrows covered before and after is
+        # repainted once, and the arrows near them and the given ones are rerouted once.
+        # While dragging, arrows between shapes moved by the same offset are shifted along
+        # without reindexing them, see shifted_arrows, and the others get quick routes. Dragging
+        # many shapes also leaves their nodes and the arrows only passing by for finish_drag
+        detailed = not dragging or len(positions) <= self.drag_detail_limit
+        offsets = {}
+        dirty = self.get_shapes_rect(positions)
+        arrows = set(arrows)
+        for shape, (x, y) in positions.items():
+            arrows.update(self.get_arrows_near(shape) if detailed else self.shape_arrows[shape])  # Old position
+            offsets[shape] = (x - shape.x(), y - shape.y())
+            shape.move(x, y)
+            self.index_shape(shape, detailed)
+        if len(set(offsets.values())) == 1:
+            dirty = dirty.united(dirty.translated(*next(iter(offsets.values()))))  # Dragged together
+        else:
+            dirty = dirty.united(self.get_shapes_rect(positions))
+        if detailed:
+            for shape in positions:
+                arrows.update(self.get_arrows_near(shape))
+        if self.pending_reroute is not None:
+            self.pending_reroute.update(arrows)
+            arrows = set()
+
+        shifted = False
+        for arrow in arrows:
+            offset = offsets.get(arrow.start.parent)
+            if dragging and offset is not None and offsets.get(arrow.end.parent) == offset:
+                dx, dy = offset
+                bounds = self.shifted_arrows.get(arrow) or self.get_route_rect(arrow.route)
+                arrow.route = [(x + dx, y + dy) for x, y in arrow.route]
+                self.arrow_lines.pop(arrow, None)
+                self.shifted_arrows[arrow] = bounds.translated(dx, dy)
+                shifted = True
+                continue
+            dirty = dirty.united(self.get_route_rect(arrow.route))
+            self.index_arrow(arrow, quick=dragging)
+            dirty = dirty.united(self.get_route_rect(arrow.route))
+        if shifted:
+            # Routes between two shapes stay within the search margin around them
+            padding = self.router.search_margin + self.router.margin
+            dirty.adjust(-padding, -padding, padding, padding)
+        margin = Arrow.arrow_size + self.arrow_width
+        self.invalidate_scene_rect(dirty.adjusted(-margin, -margin, margin, margin))
+
+    def raise_shapes(self, shapes: List['Shape']) -> None:
+        # Bring the shapes to the front in their order, they are also saved last
+        for shape in shapes:
+            self.z_counter += 1
+            shape.z_order = self.z_counter
+            del self.shapes[shape]
+            self.shapes[shape] = None
+        self.shape_indices = None
+        self.invalidate_scene_rect(self.get_shapes_rect(shapes))
+
+    def set_shape_text(self, shape: 'Shape', text: str) -> None:
+        shape.text = text
+        self.invalidate_shape(shape)
+        self.record({"op": "set_text", "id": shape.shape_id, "text": text})
+
+    def set_shape_child(self, shape: 'Shape', child: Optional[str]) -> None:
+        shape.child = child
+        self.invalidate_shape(shape)
+        self.record({"op": "set_child", "id": shape.shape_id, "child": child})
+
+    def create_arrow(self, start: 'Node', end: 'Node') -> 'Arrow':
+        return self.insert_arrow(Arrow(start, end))
+
+    def insert_arrow(self, arrow: 'Arrow') -> 'Arrow':
+        self.add_arrow(arrow)
+        self.invalidate_arrow(arrow)
+        self.record({"op": "add_arrow", "start": [arrow.start.parent.shape_id, arrow.start.index],
+                     "end": [arrow.end.parent.shape_id, arrow.end.index]})
+        return arrow
+
+    def delete_arrow(self, arrow: 'Arrow') -> None:
+        self.record({"op": "remove_arrow", "start": [arrow.start.parent.shape_id, arrow.start.index],
+                     "end": [arrow.end.parent.shape_id, arrow.end.index]})
+        self.invalidate_arrow(arrow)
+        self.remove_arrow(arrow)
+
+    def record(self, operation: dict) -> None:
+        # Appending costs the size of the edit, the full snapshot is only rewritten
+        # every Journal.compact_interval operations
+        self.modified = True
+        if self.journal and self.journal.append(operation):
+            self.journal.compact(self.save_to_diagram_data())
+
+    def replay(self, operations: Iterable[dict]) -> bool:
+        # Applies journal operations on top of the loaded base, with logging turned off
+        journal, self.journal = self.journal, None
+        shapes = {shape.shape_id: shape for shape in self.shapes}
+        try:
+            for operation in operations:
+                kind = operation["op"]
+                if kind == "add_shape":
+                    shape = self.shape_mapping[operation["shape_type"]]()
+                    shape.shape_id = operation["id"]
+                    shape.move(operation["x"], operation["y"])
+                    shape.text = operation["text"]
+                    shape.child = operation.get("child")  # Not logged before sub-diagrams
+                    self.create_shape(shape)
+                    shapes[shape.shape_id] = shape
+                elif kind == "remove_shape":
+                    self.delete_shape(shapes.pop(operation["id"]))
+                elif kind == "move":
+                    self.place_shapes({shapes[operation["id"]]: (operation["x"], operation["y"])})
+                elif kind == "set_text":
+                    self.set_shape_text(shapes[operation["id"]], operation["text"])
+                elif kind == "set_child":
+                    self.set_shape_child(shapes[operation["id"]], operation["child"])
+                elif kind == "add_arrow":
+                    start_id, start_index = operation["start"]
+                    end_id, end_index = operation["end"]
+                    self.create_arrow(shapes[start_id].nodes[start_index], shapes[end_id].nodes[end_index])
+                elif kind == "remove_arrow":
+                    start_id, start_index = operation["start"]
+                    end_id, end_index = operation["end"]
+                    start, end = shapes[start_id].nodes[start_index], shapes[end_id].nodes[end_index]
+                    self.delete_arrow(next(arrow for arrow in self.node_arrows[start] if arrow.start is start and arrow.end is end))
+                else:
+                    raise ValueError(f"unknown operation {kind}")
+            return True
+        except (KeyError, IndexError, TypeError, ValueError, StopIteration) as e:
+            print(f"Error replaying journal: {e}")
+            return False
+        finally:
+            self.journal = journal
+
+    def insert_shape(self, shape: 'Shape') -> None:
+        self.shapes[shape] = None
+        if self.shape_indices is not None:
+            self.shape_indices[shape] = len(self.shape_indices)
+        self.shape_arrows[shape] = set()
+        for node in shape.nodes:
+            self.node_arrows[node] = set()
+        self.z_counter += 1
+        shape.z_order = self.z_counter
+        if shape.shape_id is None:
+            shape.shape_id = new_shape_id()
+        self.index_shape(shape)
+
+    def index_shape(self, shape: 'Shape', nodes: bool = True) -> None:
+        # Insert or refresh the shape and its nodes in the spatial indexes
+        self.shape_rects.pop(shape, None)
+        right, bottom = shape.x() + shape.width() - 1, shape.y() + shape.height() - 1
+        self.shape_index.update(shape, shape.x(), shape.y(), right, bottom)
+        if not nodes:
+            return
+        radius = shape.node_radius
+        for node in shape.nodes:
+            x, y = node.get_global_coordinates()
+            self.node_index.update(node, x - radius, y - radius, x + radius, y + radius)
+
+    def unindex_shape(self, shape: 'Shape') -> None:
+        self.shape_rects.pop(shape, None)
+        self.shape_index.remove(shape)
+        for node in shape.nodes:
+            self.node_index.remove(node)
+
+    def add_arrow(self, arrow: 'Arrow') -> None:
+        self.arrows[arrow] = None
+        for node in (arrow.start, arrow.end):
+            self.node_arrows[node].add(arrow)
+            self.shape_arrows[node.parent].add(arrow)
+        self.index_arrow(arrow)
+
+    def remove_arrow(self, arrow: 'Arrow') -> None:
+        del self.arrows[arrow]
+        for node in (arrow.start, arrow.end):
+            self.node_arrows[node].discard(arrow)
+            self.shape_arrows[node.parent].discard(arrow)
+        self.arrow_index.remove(arrow)
+        self.arrow_lines.pop(arrow, None)
+
+    def get_shape_indices(self) -> Dict['Shape', int]:
+        if self.shape_indices is None:
+            self.shape_indices = {shape: index for index, shape in enumerate(self.shapes)}
+        return self.shape_indices
+
+    def index_arrow(self, arrow: 'Arrow', route: Optional[List[Tuple[int, int]]] = None, quick: bool = False) -> None:
+        # The route is cached on the arrow and in the index until a shape moves close to it
+        arrow.route = route or self.router.route(arrow.start.get_global_coordinates(), arrow.start.get_direction(),
+                                                 arrow.end.get_global_coordinates(), arrow.end.get_direction(), quick)
+        self.arrow_index.update(arrow, *(coordinate for point in arrow.route for coordinate in point))
+        self.arrow_lines.pop(arrow, None)
+
+    def get_arrows_near(self, shape: 'Shape') -> Set['Arrow']:
+        # Arrows attached to the shape, or routed close enough to go around it
+        margin = self.router.margin
+        arrows = set(self.shape_arrows.get(shape, ()))
+        arrows.update(self.arrow_index.query_rect(shape.x() - margin, shape.y() - margin,
+                                                  shape.x() + shape.width() - 1 + margin, shape.y() + shape.height() - 1 + margin))
+        return arrows
+
+    @contextlib.contextmanager
+    def batch_reroute(self) -> Iterator[None]:
+        # Edits of many shapes reroute each arrow near them once, at the end
+        if self.pending_reroute is not None:
+            yield
+            return
+        self.pending_reroute = set()
+        try:
+            yield
+        finally:
+            arrows, self.pending_reroute = self.pending_reroute, None
+            self.reroute_arrows(arrow for arrow in arrows if arrow in self.arrows)
+
+    def reroute_arrows(self, arrows: Iterable['Arrow']) -> None:
+        if self.pending_reroute is not None:
+            self.pending_reroute.update(arrows)
+            return
+        for arrow in arrows:
+            self.invalidate_arrow(arrow)  # Old route
+            self.index_arrow(arrow)
+            self.invalidate_arrow(arrow)  # New route
+
+    def invalidate_arrow(self, arrow: 'Arrow') -> None:
+        # Repaint the area covered by the arrow as currently indexed, including its arrowhead
+        # Long segments are split in pieces so the dirty region hugs the line instead of its bounding box
+        # Parts outside of the view are skipped, they are repainted when scrolled into view anyway
+        # The zoomed out view also keeps the parts around the view
+        margin = Arrow.arrow_size + self.arrow_width
+        visible = (self.overview[2] if self.overview else self.get_visible_scene_rect()).adjusted(-margin, -margin, margin, margin)
+        left, top, right, bottom = visible.left(), visible.top(), visible.right(), visible.bottom()
+        for x1, y1, x2, y2 in SegmentIndex.iter_segments(self.arrow_index.segments[arrow]):
+            if not segment_intersects_rect(x1, y1, x2, y2, left, top, right, bottom):
+                continue
+            pieces = max(1, int(math.hypot(x2 - x1, y2 - y1) // self.arrow_index.cell_size))
+            for piece in range(pieces):
+                start_x, start_y = x1 + (x2 - x1) * piece // pieces, y1 + (y2 - y1) * piece // pieces
+                end_x, end_y = x1 + (x2 - x1) * (piece + 1) // pieces, y1 + (y2 - y1) * (piece + 1) // pieces
+                if max(start_x, end_x) < left or min(start_x, end_x) > right or max(start_y, end_y) < top or min(start_y, end_y) > bottom:
+                    continue
+                rect = QtCore.QRect(QtCore.QPoint(min(start_x, end_x), min(start_y, end_y)), QtCore.QPoint(max(start_x, end_x), max(start_y, end_y)))
+                self.invalidate_scene_rect(rect.adjusted(-margin, -margin, margin, margin))
+
+    def invalidate_rubber_band(self) -> None:
+        if self.arrow_start and self.arrow_end:
+            margin = self.arrow_width
+            self.invalidate_scene_rect(QtCore.QRect(self.arrow_start.get_global_position(), self.arrow_end).normalized().adjusted(-margin, -margin, margin, margin))
+
+    def invalidate_shape(self, shape: 'Shape') -> None:
+        self.invalidate_scene_rect(shape.geometry())
+
+    def invalidate_scene_rect(self, rect: QtCore.QRect) -> None:
+        if self.overview:
+            self.overview_dirty.append(rect)
+        self.update(self.to_view_rect(rect))
+
+    def to_scene(self, pos: QtCore.QPoint) -> QtCore.QPoint:
+        return QtCore.QPoint(math.floor(pos.x() / self.zoom), math.floor(pos.y() / self.zoom)) + self.view_offset
+
+    def to_scene_rect(self, rect: QtCore.QRect) -> QtCore.QRect:
+        # Smallest scene rectangle covering the view rectangle
+        top_left = self.to_scene(rect.topLeft())
+        right = math.ceil((rect.right() + 1) / self.zoom) - 1 + self.view_offset.x()
+        bottom = math.ceil((rect.bottom() + 1) / self.zoom) - 1 + self.view_offset.y()
+        return QtCore.QRect(top_left, QtCore.QPoint(right, bottom))
+
+    def to_view_rect(self, rect: QtCore.QRect) -> QtCore.QRect:
+        # Smallest view rectangle covering the scene rectangle
+        x, y = self.view_offset.x(), self.view_offset.y()
+        return QtCore.QRect(QtCore.QPoint(math.floor((rect.left() - x) * self.zoom), math.floor((rect.top() - y) * self.zoom)),
+                            QtCore.QPoint(math.ceil((rect.right() + 1 - x) * self.zoom) - 1, math.ceil((rect.bottom() + 1 - y) * self.zoom) - 1))
+
+    def get_visible_scene_rect(self) -> QtCore.QRect:
+        return self.to_scene_rect(self.rect())
+
+    def shapes_in_rect(self, rect: QtCore.QRect) -> Iterable['Shape']:
+        # Zoomed far out a query would visit more grid cells than there are shapes
+        cell_size = self.shape_index.cell_size
+        if (rect.width() // cell_size + 1) * (rect.height() // cell_size + 1) > len(self.shapes):
+            return self.shapes
+        return self.shape_index.query_rect(rect.left(), rect.top(), rect.right(), rect.bottom())
+
+    def arrows_in_rect(self, rect: QtCore.QRect) -> Iterable['Arrow']:
+        cell_size = self.arrow_index.cell_size
+        if (rect.width() // cell_size + 1) * (rect.height() // cell_size + 1) > len(self.arrows):
+            return self.arrows
+        return self.arrow_index.query_rect(rect.left(), rect.top(), rect.right(), rect.bottom())
+
+    def shape_at(self, x: int, y: int) -> Optional['Shape']:
+        # Topmost shape under the point
+        return max(self.shape_index.query_point(x, y), key=lambda shape: shape.z_order, default=None)
+
+    def node_at(self, x: int, y: int) -> 'Node':
+        for node in self.node_index.query_point(x, y):
+            node_x, node_y = node.get_global_coordinates()
+            if math.hypot(x - node_x, y - node_y) < node.parent.node_radius:
+                return node
+        return None
         
     def clear_all_shapes_and_arrows(self) -> None:
-        for shape in self.shapes:
-            shape.deleteLater()
-        for arrow in self.arrows:
-            arrow.deleteLater()
         self.shapes.clear()
         self.arrows.clear()
+        self.node_arrows.clear()
+        self.shape_arrows.clear()
+        self.shape_indices = {}
+        self.undo_stack.clear()
+        self.active_shape = None
+        self.hovered_shape = None
+        self.selection.clear()
+        self.dragged_shapes = None
+        self.shifted_arrows.clear()
+        self.shape_index.clear()
+        self.node_index.clear()
+        self.arrow_index.clear()
+        self.shape_rects.clear()
+        self.arrow_lines.clear()
+        self.overview = None
+        self.modified = False
         self.update()
 
+class ConnectorLayer(QtWidgets.QWidget):
+    # Single transparent widget that draws every arrow of the area in one pass,
+    # so the widget count stays constant no matter how many arrows exist
+    def __init__(self, parent: Area):
+        super().__init__(parent)
+        self.pen = QtGui.QPen(parent.arrow_color, parent.arrow_width)
+        self.setAttribute(QtCore.Qt.WA_TransparentForMouseEvents)
+        self.resize(parent.size())
+
+    @profiler.timed("ConnectorLayer.paintEvent")
+    def paintEvent(self, event):
+        area = cast(Area, self.parent())
+
+        # Batch the arrows crossing the repainted region into a single path. Zoomed out they
+        # have no heads, and far out the area draws them itself
+        margin = Arrow.arrow_size + area.arrow_width
+        arrows = set()
+        if area.zoom >= area.overview_zoom:
+            for rect in event.region():
+                arrows.update(area.arrows_in_rect(area.to_scene_rect(rect).adjusted(-margin, -margin, margin, margin)))
+            bounds = area.to_scene_rect(event.region().boundingRect()).adjusted(-margin, -margin, margin, margin)
+            arrows.update(arrow for arrow, route_rect in area.shifted_arrows.items() if bounds.intersects(route_rect))
+        path = QtGui.QPainterPath()
+        detailed = area.is_detailed()
+        for arrow in arrows:
+            arrow.add_to_path(path, detailed)
+
+        # Arrow currently being dragged out of a node
+        if area.arrow_start and area.arrow_end:
+            path.moveTo(area.arrow_start.get_global_position())
+            path.lineTo(area.arrow_end)
+
+        with QtGui.QPainter(self) as painter:
+            area.apply_view_transform(painter)
+            painter.setPen(self.pen)
+            painter.drawPath(path)
+            if area.band_start:
+                painter.setPen(QtGui.QPen(Shape.selection_color, 0, QtCore.Qt.DashLine))
+                painter.drawRect(area.get_selection_band())
+
+class ProfilerOverlay(QtWidgets.QWidget):
+    # Rolling latency percentiles and call rates over the top left corner of the area.
+    # Opaque, so refreshing it doesn't repaint the diagram below and skew the numbers
+    refresh_interval = 500  # In milliseconds
+    padding = 6
+    measurements = ("Area.paintEvent", "Area.render_overview", "ConnectorLayer.paintEvent", "Shape.paint", "Area.apply_mouse_move",
+                    "Serializer.load_from_file", "Serializer.save_to_file", "Serializer.convert")
+    background_color = QtGui.QColor(40, 40, 40)
+    text_color = QtGui.QColor(230, 230, 230)
+
+    def __init__(self, parent: Area):
+        super().__init__(parent)
+        self.setAttribute(QtCore.Qt.WA_TransparentForMouseEvents)
+        self.setAttribute(QtCore.Qt.WA_OpaquePaintEvent)
+        self.text_font = QtGui.QFontDatabase.systemFont(QtGui.QFontDatabase.FixedFont)
+        metrics = QtGui.QFontMetrics(self.text_font)
+        self.resize(metrics.horizontalAdvance(self.format_line("", 0, 0, 0, 0)) + self.padding * 2,
+                    metrics.lineSpacing() * (len(self.measurements) + 1) + self.padding * 2)
+        self.refresh_timer = QtCore.QTimer(self)
+        self.refresh_timer.timeout.connect(self.update)
+        self.hide()
+
+    @staticmethod
+    def format_line(name: str, p50: float, p95: float, p99: float, rate: int) -> str:
+        return f"{name:<28}{p50:>8.2f}{p95:>8.2f}{p99:>8.2f}{rate:>6}"
+
+    def toggle(self) -> None:
+        if self.isVisible():
+            self.refresh_timer.stop()
+            self.hide()
+        else:
+            self.raise_()
+            self.show()
+            self.refresh_timer.start(self.refresh_interval)
+
+    def paintEvent(self, event):
+        metrics = QtGui.QFontMetrics(self.text_font)
+        lines = [f"{'ms':<28}{'p50':>8}{'p95':>8}{'p99':>8}{'/s':>6}"]
+        for name in self.measurements:
+            p50, p95, p99 = profiler.percentiles(name)
+            lines.append(self.format_line(name, p50 * 1000, p95 * 1000, p99 * 1000, profiler.rate(name)))
+
+        with QtGui.QPainter(self) as painter:
+            painter.fillRect(self.rect(), self.background_color)
+            painter.setPen(self.text_color)
+            painter.setFont(self.text_font)
+            for number, line in enumerate(lines):
+                painter.drawText(self.padding, self.padding + metrics.ascent() + number * metrics.lineSpacing(), line)
+
 class Node:
-    def __init__(self, parent: QtWidgets.QWidget, qpoint: QtCore.QPoint):
+    def __init__(self, parent: 'Shape', qpoint: QtCore.QPoint, index: int):
         self.parent = parent
         self.qpoint = qpoint
+        self.index = index  # Position within the parent's nodes
         
     def get_parent_position(self) -> QtCore.QPoint:
         return self.qpoint + QtCore.QPoint(self.parent.width() // 2, self.parent.height() // 2)
@@ -359,284 +1931,292 @@ class Node:
     def get_global_position(self) -> QtCore.QPoint:
         return self.qpoint + QtCore.QPoint(self.parent.width() // 2, self.parent.height() // 2) + self.parent.pos()
 
-class Shape(QtWidgets.QWidget):
-    def __init__(self, parent: QtWidgets.QWidget, width: int, height: int, node_positions: List[QtCore.QPoint], node_radius: int):
-        super().__init__(parent)
-        self.locked = True
+    def get_global_coordinates(self) -> Tuple[int, int]:
+        # Same as get_global_position but without allocating QPoints
+        return (self.parent.x() + self.parent.width() // 2 + self.qpoint.x(),
+                self.parent.y() + self.parent.height() // 2 + self.qpoint.y())
+
+    def get_direction(self) -> Tuple[int, int]:
+        # Side of the shape the node is on, arrows leave and enter the node that way
+        return OrthogonalRouter.get_direction(self.qpoint.x(), self.qpoint.y())
+
+class Shape:
+    pen_color = QtGui.QColor('black')
+    pen_width = 2
+    background_color = QtGui.QColor(255, 255, 255)
+    text_type = "Arial"
+    text_color = QtGui.QColor('black')
+    text_size = 12
+    text_pen_size = 2
+    cross_pen = QtGui.QPen(QtGui.QColor('red'), 2)
+    cross_rect = QtCore.QRect(1, 1, 10, 10)  # Define the cross as a QRect, relative to the shape
+    active_node_brush = QtGui.QBrush(QtGui.QColor(255, 255, 0))
+    selection_color = QtGui.QColor(0, 120, 215)
+    pixmap_cache_limit = 64 * 1024  # In KB, room for a few hundred distinct shape bodies
+
+    # Lightweight record of a shape on the area, it is drawn by the area and
+    # mirrors the geometry accessors of QWidget
+    def __init__(self, width: int, height: int, node_positions: List[QtCore.QPoint], node_radius: int):
+        self.left = 0
+        self.top = 0
+        self.shape_width = width + node_radius * 2
+        self.shape_height = height + node_radius * 2
+        self.selected = False
+        self.z_order = 0
+        self.shape_id: Optional[str] = None  # Stable across saves, assigned when added to an area
         self.active_node: Node = None
         self.nodes: List[Node] = []
-        for node_position in node_positions:
-            self.nodes.append(Node(self, node_position))
+        for index, node_position in enumerate(node_positions):
+            self.nodes.append(Node(self, node_position, index))
         self.text = ""
+        self.child: Optional[str] = None  # Sub-diagram opened on double-click, see Serializer.resolve_reference
         self.node_radius = node_radius
         self.show_cross = False
-        self.text_type = "Arial"
-        self.text_color = QtGui.QColor('black')
-        self.text_size = 12
-        self.text_pen_size = 2
-        self.cross_color = QtGui.QColor('red')
-        self.cross_pen_size = 2
-        self.cross_rect = QtCore.QRect(1, 1, 10, 10)  # Define the cross as a QRect
-        self.setFixedSize(width + node_radius * 2, height + node_radius * 2)
-        self.setMouseTracking(True)
 
-    def paintEvent(self, event):
-        self.render_cross()
-        self.render_text()
-        self.render_nodes()
+    def x(self) -> int:
+        return self.left
+
+    def y(self) -> int:
+        return self.top
+
+    def width(self) -> int:
+        return self.shape_width
+
+    def height(self) -> int:
+        return self.shape_height
+
+    def pos(self) -> QtCore.QPoint:
+        return QtCore.QPoint(self.left, self.top)
+
+    def geometry(self) -> QtCore.QRect:
+        return QtCore.QRect(self.left, self.top, self.shape_width, self.shape_height)
+
+    def move(self, x, y=None) -> None:
+        # Accepts a QPoint or two coordinates, like QWidget.move
+        if y is None:
+            x, y = x.x(), x.y()
+        self.left = x
+        self.top = y
+
+    @profiler.timed("Shape.paint")
+    def paint(self, painter: QtGui.QPainter, ratio: float, detailed: bool = True) -> None:
+        # The static outline and text come from the pixmap cache, only the overlays are drawn live.
+        # The ratio includes the zoom so the pixmap is drawn 1:1, zoomed out the text and overlays are left out
+        painter.drawPixmap(self.left, self.top, self.get_body_pixmap(ratio, detailed))
+        if self.selected:
+            self.render_selection(painter)
+        if detailed:
+            self.render_cross(painter)
+            self.render_nodes(painter)  # Render the nodes last to avoid overlap
+
+    def get_body_pixmap(self, ratio: float, with_text: bool = True) -> QtGui.QPixmap:
+        text = self.text if with_text else ""
+        key = f"{self.__class__.__name__}:{self.shape_width}x{self.shape_height}@{ratio}:{self.style_key()}:{self.child is not None}:{text}"
+        pixmap = QtGui.QPixmapCache.find(key)
+        if pixmap is None:
+            pixmap = QtGui.QPixmap(max(1, round(self.shape_width * ratio)), max(1, round(self.shape_height * ratio)))
+            pixmap.setDevicePixelRatio(ratio)
+            pixmap.fill(QtCore.Qt.transparent)
+            with QtGui.QPainter(pixmap) as painter:
+                self.draw_outline(painter, self.shape_width // 2, self.shape_height // 2)
+                if self.child is not None:
+                    self.draw_child_marker(painter, self.shape_width // 2, self.shape_height // 2)
+                if text:
+                    self.draw_text(painter, QtCore.QRect(0, 0, self.shape_width, self.shape_height), text)
+            QtGui.QPixmapCache.insert(key, pixmap)
+        return pixmap
+
+    @classmethod
+    def style_key(cls) -> str:
+        return (f"{cls.pen_color.rgba()}:{cls.pen_width}:{cls.background_color.rgba()}:"
+                f"{cls.text_type}:{cls.text_size}:{cls.text_color.rgba()}:{cls.text_pen_size}")
+
+    @classmethod
+    def draw_outline(cls, painter: QtGui.QPainter, center_x: int, center_y: int) -> None:
+        # Shared with the offscreen renderer, so it must not depend on the widget
+        pen = QtGui.QPen(cls.pen_color, cls.pen_width)
+        painter.setPen(pen)
+        painter.setBrush(cls.background_color)
+        cls.draw_body(painter, center_x, center_y)
 
-    def mouseDoubleClickEvent(self, event):
-        if event.button() != QtCore.Qt.LeftButton:
-            return  # Only process left mouse clicks
+    @staticmethod
+    def draw_body(painter: QtGui.QPainter, center_x: int, center_y: int) -> None:
+        raise NotImplementedError
 
-        text, ok = QtWidgets.QInputDialog.getText(self, "Set Text", "Enter text for the shape:")
-        if ok and text:
-            self.text = text
-            self.update()
-    
-    def leaveEvent(self, event):
-        # Reset the active node and hide the cross when the mouse leaves the shape
-        self.active_node = None
-        self.show_cross = False
-        self.update()
-        
-    def enterEvent(self, event):
-        # Show the cross when the mouse enters the shape
-        self.show_cross = True
-        self.update()
-        
-    def render_cross(self):
+    @staticmethod
+    def draw_child_marker(painter: QtGui.QPainter, center_x: int, center_y: int) -> None:
+        # Drawn over the outline of a shape with a sub-diagram, only processes have one
+        pass
+
+    @classmethod
+    def draw_text(cls, painter: QtGui.QPainter, text_rect: QtCore.QRect, text: str) -> None:
+        pen = QtGui.QPen(cls.text_color, cls.text_pen_size)
+        painter.setPen(pen)
+        painter.setFont(QtGui.QFont(cls.text_type, cls.text_size))
+        # Draw the text in the center of the rect
+        painter.drawText(text_rect, QtCore.Qt.AlignCenter, text)
+
+    def render_cross(self, painter: QtGui.QPainter):
         if self.show_cross:
-            with QtGui.QPainter(self) as painter:
-                pen = QtGui.QPen(self.cross_color, self.cross_pen_size)
-                painter.setPen(pen)
-                # Use cross_rect to draw the cross
-                painter.drawLine(self.cross_rect.topLeft(), self.cross_rect.bottomRight())
-                painter.drawLine(self.cross_rect.topRight(), self.cross_rect.bottomLeft())
-
-    def render_text(self):
-        if self.text:
-            with QtGui.QPainter(self) as painter:
-                pen = QtGui.QPen(self.text_color, self.text_pen_size)
-                painter.setPen(pen)
-                painter.setFont(QtGui.QFont(self.text_type, self.text_size))
-                # Draw the text in the center of the shape
-                text_rect = QtCore.QRect(0, 0, self.width(), self.height())
-                painter.drawText(text_rect, QtCore.Qt.AlignCenter, self.text)
-
-    def render_nodes(self):
-        for node in self.nodes:
-            with QtGui.QPainter(self) as painter:
-                painter.setPen(QtCore.Qt.NoPen)
-                if self.active_node == node:
-                    painter.setBrush(QtGui.QBrush(QtGui.QColor(255, 255, 0)))  # Highlight active node
-                else:
-                    painter.setBrush(QtCore.Qt.NoBrush)
-                painter.drawEllipse(node.get_parent_position(), self.node_radius, self.node_radius)
-
-    def has_active_node(self, mouse_pos) -> Node:
-        self.active_node = None
-        for node in self.nodes:
-            distance = math.hypot(mouse_pos.x() - node.get_global_position().x(), 
-                                  mouse_pos.y() - node.get_global_position().y())
-            if distance < self.node_radius:
-                self.active_node = node
-        return self.active_node
+            painter.setPen(self.cross_pen)
+            # Use cross_rect to draw the cross
+            cross_rect = self.cross_rect.translated(self.left, self.top)
+            painter.drawLine(cross_rect.topLeft(), cross_rect.bottomRight())
+            painter.drawLine(cross_rect.topRight(), cross_rect.bottomLeft())
+
+    def render_selection(self, painter: QtGui.QPainter):
+        # Dashed outline along the inside of the geometry, a view pixel wide at any zoom
+        pen = QtGui.QPen(self.selection_color, 0, QtCore.Qt.DashLine)
+        painter.setPen(pen)
+        painter.setBrush(QtCore.Qt.NoBrush)
+        painter.drawRect(self.left, self.top, self.shape_width - 1, self.shape_height - 1)
+
+    def render_nodes(self, painter: QtGui.QPainter):
+        # Nodes are invisible unless highlighted, so only the active one is drawn
+        if self.active_node:
+            painter.setPen(QtCore.Qt.NoPen)
+            painter.setBrush(self.active_node_brush)  # Highlight active node
+            painter.drawEllipse(self.active_node.get_global_position(), self.node_radius, self.node_radius)
 
     def on_cross(self, mouse_pos) -> bool:
         return self.cross_rect.contains(mouse_pos - self.pos())
 
 class Decision(Shape):
-    def __init__(self, parent):
-        super().__init__(parent, 130, 130, [
-            QtCore.QPoint(-65, 0),
-            QtCore.QPoint(65, 0),
-            QtCore.QPoint(0, 65),
-            QtCore.QPoint(0, -65)
-        ], 8)
-        
-        self.pen_color = QtGui.QColor('black')
-        self.pen_width = 2
-        self.background_color = QtGui.QColor(255, 255, 255)
+    node_positions = NODE_POSITIONS['Decision']
 
-    def paintEvent(self, event):
-        with QtGui.QPainter(self) as painter:
-            pen = QtGui.QPen(self.pen_color, self.pen_width)
-            painter.setPen(pen)
-            painter.setBrush(self.background_color)
-            
-            # Draw a diamond shape
-            center_x = self.width() // 2
-            center_y = self.height() // 2
-            points = [
-                QtCore.QPoint(center_x, center_y - 65),
-                QtCore.QPoint(center_x + 65, center_y),
-                QtCore.QPoint(center_x, center_y + 65),
-                QtCore.QPoint(center_x - 65, center_y) 
-            ]
-            painter.drawPolygon(QtGui.QPolygon(points))
-            
-        super().paintEvent(event)  # Render the nodes last to avoid overlap
+    def __init__(self):
+        super().__init__(130, 130, [QtCore.QPoint(x, y) for x, y in self.node_positions], 8)
+
+    @staticmethod
+    def draw_body(painter: QtGui.QPainter, center_x: int, center_y: int) -> None:
+        # Draw a diamond shape
+        points = [
+            QtCore.QPoint(center_x, center_y - 65),
+            QtCore.QPoint(center_x + 65, center_y),
+            QtCore.QPoint(center_x, center_y + 65),
+            QtCore.QPoint(center_x - 65, center_y)
+        ]
+        painter.drawPolygon(QtGui.QPolygon(points))
 
 class Terminator(Shape):
-    def __init__(self, parent):
-        super().__init__(parent, 130, 80, [
-            QtCore.QPoint(-65, 0),
-            QtCore.QPoint(65, 0),  
-            QtCore.QPoint(0, 40),  
-            QtCore.QPoint(0, -40)
-        ], 8)
-        
-        self.pen_color = QtGui.QColor('black')
-        self.pen_width = 2
-        self.background_color = QtGui.QColor(255, 255, 255)
+    node_positions = NODE_POSITIONS['Terminator']
 
-    def paintEvent(self, event):
-        with QtGui.QPainter(self) as painter:
-            pen = QtGui.QPen(self.pen_color, self.pen_width)
-            painter.setPen(pen)
-            painter.setBrush(self.background_color)
-            
-            # Draw an oval shape
-            center_x = self.width() // 2
-            center_y = self.height() // 2
-            painter.drawRoundedRect(center_x - 65, center_y - 40, 130, 80, 40, 40)
-            
-        super().paintEvent(event)  # Render the nodes last to avoid overlap
+    def __init__(self):
+        super().__init__(130, 80, [QtCore.QPoint(x, y) for x, y in self.node_positions], 8)
+
+    @staticmethod
+    def draw_body(painter: QtGui.QPainter, center_x: int, center_y: int) -> None:
+        # Draw an oval shape
+        painter.drawRoundedRect(center_x - 65, center_y - 40, 130, 80, 40, 40)
 
 class Process(Shape):
-    def __init__(self, parent):
-        super().__init__(parent, 130, 80, [
-            QtCore.QPoint(-65, 0),
-            QtCore.QPoint(65, 0),
-            QtCore.QPoint(0, 40),
-            QtCore.QPoint(0, -40)
-        ], 8)
-        
-        self.pen_color = QtGui.QColor('black')
-        self.pen_width = 2
-        self.background_color = QtGui.QColor(255, 255, 255)
+    node_positions = NODE_POSITIONS['Process']
 
-    def paintEvent(self, event):
-        with QtGui.QPainter(self) as painter:
-            pen = QtGui.QPen(self.pen_color, self.pen_width)
-            painter.setPen(pen)
-            painter.setBrush(self.background_color)
-            
-            # Draw a rectangle shape
-            center_x = self.width() // 2
-            center_y = self.height() // 2
-            painter.drawRect(center_x - 65, center_y - 40, 130, 80)
-            
-        super().paintEvent(event)  # Render the nodes last to avoid overlap
-
-            
+    def __init__(self):
+        super().__init__(130, 80, [QtCore.QPoint(x, y) for x, y in self.node_positions], 8)
 
-class IO(Shape):
-    def __init__(self, parent):
-        super().__init__(parent, 130, 80, [
-            QtCore.QPoint(0, -40),
-            QtCore.QPoint(60, 0),
-            QtCore.QPoint(0, 40),
-            QtCore.QPoint(-60, 0)
-        ], 8)
-        
-        self.pen_color = QtGui.QColor('black')
-        self.pen_width = 2
-        self.background_color = QtGui.QColor(255, 255, 255)
+    @staticmethod
+    def draw_body(painter: QtGui.QPainter, center_x: int, center_y: int) -> None:
+        # Draw a rectangle shape
+        painter.drawRect(center_x - 65, center_y - 40, 130, 80)
 
-    def paintEvent(self, event):
-        with QtGui.QPainter(self) as painter:
-            pen = QtGui.QPen(self.pen_color, self.pen_width)
-            painter.setPen(pen)
-            painter.setBrush(self.background_color)
-            
-            # Draw a parallelogram shape
-            center_x = self.width() // 2
-            center_y = self.height() // 2
-            points = [
-                QtCore.QPoint(center_x - 55, center_y - 40),
-                QtCore.QPoint(center_x + 65, center_y - 40),
-                QtCore.QPoint(center_x + 55, center_y + 40),
-                QtCore.QPoint(center_x - 65, center_y + 40) 
-            ]
-            painter.drawPolygon(QtGui.QPolygon(points))
-            
-        super().paintEvent(event)  # Render the nodes last to avoid overlap
-
-class Arrow(QtWidgets.QWidget):
-    def __init__(self, parent: QtWidgets.QWidget, start_position: Node, end_position: Node):
-        super().__init__(parent)
-        self.start = start_position
-        self.end = end_position
-        self.pen_color = QtGui.QColor('black')
-        self.pen_width = 3
-        self.arrow_size = 15
-        self.setFixedSize(self.parent().size())
-        self.setAttribute(QtCore.Qt.WA_TransparentForMouseEvents) 
-        
-    def paintEvent(self, event):
-        with QtGui.QPainter(self) as painter:
-            pen = QtGui.QPen(self.pen_color, self.pen_width)
-            painter.setPen(pen)
+    @staticmethod
+    def draw_child_marker(painter: QtGui.QPainter, center_x: int, center_y: int) -> None:
+        # Inner side lines, the flowchart symbol of a predefined process
+        painter.drawLine(center_x - 55, center_y - 40, center_x - 55, center_y + 40)
+        painter.drawLine(center_x + 55, center_y - 40, center_x + 55, center_y + 40)
 
-            # Get the positions of the start and end points
-            start_pos = self.mapToParent(self.start.get_global_position())
-            end_pos = self.end.get_global_position()
+class IO(Shape):
+    node_positions = NODE_POSITIONS['IO']
 
-            # Draw the main line
-            painter.drawLine(start_pos, end_pos)
+    def __init__(self):
+        super().__init__(130, 80, [QtCore.QPoint(x, y) for x, y in self.node_positions], 8)
 
-            # Calculate the angle of the line
-            angle = math.atan2(end_pos.y() - start_pos.y(), end_pos.x() - start_pos.x())  # Get the angle in radians
+    @staticmethod
+    def draw_body(painter: QtGui.QPainter, center_x: int, center_y: int) -> None:
+        # Draw a parallelogram shape
+        points = [
+            QtCore.QPoint(center_x - 55, center_y - 40),
+            QtCore.QPoint(center_x + 65, center_y - 40),
+            QtCore.QPoint(center_x + 55, center_y + 40),
+            QtCore.QPoint(center_x - 65, center_y + 40)
+        ]
+        painter.drawPolygon(QtGui.QPolygon(points))
+
+SHAPE_CLASSES = {
+    'Process': Process,
+    'Decision': Decision,
+    'Terminator': Terminator,
+    'IO': IO
+}
+
+class Arrow:
+    arrow_size = 15
+    pick_threshold = 5
+
+    def __init__(self, start_position: Node, end_position: Node):
+        self.start = start_position
+        self.end = end_position
+        self.route: Optional[List[Tuple[int, int]]] = None  # Points from start to end, set when the area routes the arrow
 
-            # Calculate the arrowhead points using math.sin and math.cos
-            left_arrowhead = QtCore.QPointF(
-                end_pos.x() - self.arrow_size * math.cos(angle + math.radians(30)),
-                end_pos.y() - self.arrow_size * math.sin(angle + math.radians(30))
-            )
-            right_arrowhead = QtCore.QPointF(
-                end_pos.x() - self.arrow_size * math.cos(angle - math.radians(30)),
-                end_pos.y() - self.arrow_size * math.sin(angle - math.radians(30))
-            )
+    def add_to_path(self, path: QtGui.QPainterPath, head: bool = True) -> None:
+        if self.route:
+            self.add_route_to_path(path, self.route, head)
+        else:
+            self.add_line_to_path(path, self.start.get_global_position(), self.end.get_global_position(), head)
 
-            # Draw the arrowhead using two lines that meet at the endpoint
-            painter.drawLine(end_pos, left_arrowhead)
-            painter.drawLine(end_pos, right_arrowhead)
-        
-        # Resize to match the parent size
-        self.setFixedSize(self.parent().size())
+    @staticmethod
+    def add_line_to_path(path: QtGui.QPainterPath, start_pos: QtCore.QPoint, end_pos: QtCore.QPoint, head: bool = True) -> None:
+        Arrow.add_route_to_path(path, [(start_pos.x(), start_pos.y()), (end_pos.x(), end_pos.y())], head)
 
-    def contains_node(self, node: Node) -> bool:
-        return node == self.start or node == self.end        
-    
-    def is_mouse_on_line(self, mouse_pos: QtCore.QPoint, threshold=5) -> bool:
-        start_pos = self.start.get_global_position()
-        end_pos = self.end.get_global_position()
-        
-        # Get coordinates for start, end, and mouse position
-        x1, y1 = start_pos.x(), start_pos.y()
-        x2, y2 = end_pos.x(), end_pos.y()
-        mx, my = mouse_pos.x(), mouse_pos.y()
-
-        # Calculate the distance from the mouse position to the line
-        numerator = abs((x2 - x1) * (y1 - my) - (x1 - mx) * (y2 - y1))
-        denominator = math.sqrt((x2 - x1) ** 2 + (y2 - y1) ** 2)
-        
-        # If the line segment has zero length (edge case), return False
-        if denominator == 0:
-            return False
-        distance = numerator / denominator
-        
-        # Check if the mouse is close enough to the line
-        return distance <= threshold
+    @staticmethod
+    def add_route_to_path(path: QtGui.QPainterPath, route: List[Tuple[int, int]], head: bool = True) -> None:
+        # Add the main line
+        path.moveTo(*route[0])
+        for x, y in route[1:]:
+            path.lineTo(x, y)
+        if not head:
+            return
+
+        # Calculate the angle of the last segment
+        (start_x, start_y), (end_x, end_y) = route[-2], route[-1]
+        angle = math.atan2(end_y - start_y, end_x - start_x)  # Get the angle in radians
+
+        # Calculate the arrowhead points using math.sin and math.cos
+        left_arrowhead = QtCore.QPointF(
+            end_x - Arrow.arrow_size * math.cos(angle + math.radians(30)),
+            end_y - Arrow.arrow_size * math.sin(angle + math.radians(30))
+        )
+        right_arrowhead = QtCore.QPointF(
+            end_x - Arrow.arrow_size * math.cos(angle - math.radians(30)),
+            end_y - Arrow.arrow_size * math.sin(angle - math.radians(30))
+        )
+
+        # Add the arrowhead as two lines that meet at the endpoint
+        path.moveTo(end_x, end_y)
+        path.lineTo(left_arrowhead)
+        path.moveTo(end_x, end_y)
+        path.lineTo(right_arrowhead)
 
 if __name__ == "__main__":
+    # Profiling is opt-in, F3 toggles the overlay and the measurements are written on exit
+    parser = argparse.ArgumentParser(description="Flowchart editor.")
+    parser.add_argument("--profile", metavar="PATH", default=os.environ.get("FLOWCHART_PROFILE"),
+                        help="measure paint, input and file handling times and write them to PATH on exit")
+    parser.add_argument("--profile-format", choices=("json", "chrome"), default=os.environ.get("FLOWCHART_PROFILE_FORMAT", "json"),
+                        help="percentile summary, or a trace for chrome://tracing")
+    args, qt_args = parser.parse_known_args()
+    if args.profile:
+        profiler.enable(args.profile, args.profile_format)
+
     # Create the Qt application
-    app = QtWidgets.QApplication(sys.argv)
+    app = QtWidgets.QApplication(sys.argv[:1] + qt_args)
+    app.setApplicationName("FlowchartMaker")  # Names the directory holding the journal of unsaved diagrams
     
     # Create the main application object (which will automatically start the flowchart editor)
     flowchart_editor = FlowchartEditor()
     
     # Run the Qt event loop
-    sys.exit(app.exec())
\ No newline at end of file
+    exit_code = app.exec()
+    profiler.dump()
+    sys.exit(exit_code)
\ No newline at end of file
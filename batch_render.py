@@ -0,0 +1,236 @@
+import os
+import sys
+import math
+import time
+import json
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+# Render without a display, must be set before Qt creates the application
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PySide6 import QtCore, QtGui, QtSvg
+from app import SHAPE_CLASSES, Area, Arrow
+from core import DiagramData, OrthogonalRouter, Serializer, ShapeData, SpatialGrid, is_integer
+
+RENDER_VERSION = 4  # Bump when the drawing changes so cached outputs are rendered again
+MANIFEST_NAME = ".render-manifest.json"
+MARGIN = 20
+
+application = None  # One Qt application per worker process
+
+
+def init_worker() -> None:
+    global application
+    if QtGui.QGuiApplication.instance() is None:
+        application = QtGui.QGuiApplication([])
+
+
+def node_position(shape: ShapeData, node_index: int) -> Tuple[int, int]:
+    # Same as Node.get_global_coordinates, from the saved shape instead of a widget
+    x, y = SHAPE_CLASSES[shape.shape_type].node_positions[node_index]
+    return shape.x + shape.width // 2 + x, shape.y + shape.height // 2 + y
+
+
+def node_direction(shape: ShapeData, node_index: int) -> Tuple[int, int]:
+    return OrthogonalRouter.get_direction(*SHAPE_CLASSES[shape.shape_type].node_positions[node_index])
+
+
+def has_node(diagram_data: DiagramData, shape_index: int, node_index: int) -> bool:
+    if not is_integer(shape_index) or not is_integer(node_index) or not 0 <= shape_index < len(diagram_data.shapes):
+        return False
+    shape_class = SHAPE_CLASSES.get(diagram_data.shapes[shape_index].shape_type)
+    return shape_class is not None and 0 <= node_index < len(shape_class.node_positions)
+
+
+def route_arrows(diagram_data: DiagramData, input_path: str) -> List[List[Tuple[int, int]]]:
+    # Arrows are routed around the shapes, as in the editor. Like the editor, arrows without
+    # both of their nodes are reported and left out
+    obstacles = SpatialGrid()
+    for index, shape in enumerate(diagram_data.shapes):
+        obstacles.insert(index, shape.x, shape.y, shape.x + shape.width - 1, shape.y + shape.height - 1)
+    router = OrthogonalRouter(obstacles)
+    routes = []
+    for number, arrow in enumerate(diagram_data.arrows):
+        if not (has_node(diagram_data, arrow.start_shape_index, arrow.start_node_index)
+                and has_node(diagram_data, arrow.end_shape_index, arrow.end_node_index)):
+            print(f"Error rendering {input_path}: arrow {number} has no node {arrow.start_node_index!r} of shape "
+                  f"{arrow.start_shape_index!r} or node {arrow.end_node_index!r} of shape {arrow.end_shape_index!r}", file=sys.stderr)
+            continue
+        start_shape, end_shape = diagram_data.shapes[arrow.start_shape_index], diagram_data.shapes[arrow.end_shape_index]
+        routes.append(router.route(node_position(start_shape, arrow.start_node_index), node_direction(start_shape, arrow.start_node_index),
+                                   node_position(end_shape, arrow.end_node_index), node_direction(end_shape, arrow.end_node_index)))
+    return routes
+
+
+def diagram_bounds(diagram_data: DiagramData, routes: List[List[Tuple[int, int]]]) -> QtCore.QRect:
+    bounds = QtCore.QRect()
+    for shape in diagram_data.shapes:
+        bounds = bounds.united(QtCore.QRect(shape.x, shape.y, shape.width, shape.height))
+    # Routes may go around shapes at the border
+    for route in routes:
+        for x, y in route:
+            bounds = bounds.united(QtCore.QRect(x, y, 1, 1))
+    return bounds.adjusted(-MARGIN, -MARGIN, MARGIN, MARGIN)
+
+
+def draw_diagram(painter: QtGui.QPainter, diagram_data: DiagramData, routes: List[List[Tuple[int, int]]]) -> None:
+    painter.setRenderHint(QtGui.QPainter.Antialiasing)
+    for shape in diagram_data.shapes:
+        shape_class = SHAPE_CLASSES.get(shape.shape_type)
+        if shape_class:
+            shape_class.draw_outline(painter, shape.x + shape.width // 2, shape.y + shape.height // 2)
+            if shape.child is not None:
+                shape_class.draw_child_marker(painter, shape.x + shape.width // 2, shape.y + shape.height // 2)
+            if shape.text:
+                shape_class.draw_text(painter, QtCore.QRect(shape.x, shape.y, shape.width, shape.height), shape.text)
+
+    # Arrows are batched into one path and drawn on top, as in the editor
+    path = QtGui.QPainterPath()
+    for route in routes:
+        Arrow.add_route_to_path(path, route)
+    painter.setPen(QtGui.QPen(Area.arrow_color, Area.arrow_width))
+    painter.setBrush(QtCore.Qt.NoBrush)
+    painter.drawPath(path)
+
+
+def render_file(input_path: str, output_path: str, output_format: str, max_size: int) -> None:
+    diagram_data = Serializer.load_from_file(input_path)
+    if diagram_data is None:
+        raise ValueError("could not load diagram")
+
+    routes = route_arrows(diagram_data, input_path)
+    bounds = diagram_bounds(diagram_data, routes)
+    scale = min(1.0, max_size / max(bounds.width(), bounds.height())) if max_size else 1.0
+    size = QtCore.QSize(max(1, math.ceil(bounds.width() * scale)), max(1, math.ceil(bounds.height() * scale)))
+
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    if output_format == "svg":
+        device = QtSvg.QSvgGenerator()
+        device.setFileName(output_path)
+        device.setSize(size)
+        device.setViewBox(QtCore.QRect(QtCore.QPoint(0, 0), size))
+    else:
+        device = QtGui.QImage(size, QtGui.QImage.Format_ARGB32)
+        device.fill(QtGui.QColor("white"))
+
+    with QtGui.QPainter(device) as painter:
+        painter.scale(scale, scale)
+        painter.translate(-bounds.left(), -bounds.top())
+        draw_diagram(painter, diagram_data, routes)
+
+    if output_format != "svg" and not device.save(output_path):
+        raise IOError(f"could not write {output_path}")
+
+
+def render_job(job: Tuple[str, str, str, int]) -> Tuple[str, Optional[str]]:
+    # Runs in a worker process, returns the input path and an error message if it failed
+    input_path, output_path, output_format, max_size = job
+    try:
+        render_file(input_path, output_path, output_format, max_size)
+        return input_path, None
+    except Exception as e:
+        return input_path, str(e) or e.__class__.__name__
+
+
+def content_hash(input_path: str, output_format: str, max_size: int) -> str:
+    digest = hashlib.sha256(f"{RENDER_VERSION}:{output_format}:{max_size}:".encode())
+    with open(input_path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def collect_inputs(paths: List[str]) -> List[Tuple[str, str]]:
+    # (input path, output path relative to the output directory)
+    inputs = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                for name in sorted(files):
+                    if name.lower().endswith((".json", ".fcb")):
+                        full_path = os.path.join(root, name)
+                        inputs.append((full_path, os.path.relpath(full_path, path)))
+        else:
+            inputs.append((path, os.path.basename(path)))
+    return inputs
+
+
+def load_manifest(output_dir: str) -> Dict[str, str]:
+    try:
+        with open(os.path.join(output_dir, MANIFEST_NAME), "r") as file:
+            return json.load(file)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_manifest(output_dir: str, manifest: Dict[str, str]) -> None:
+    os.makedirs(output_dir, exist_ok=True)
+    with open(os.path.join(output_dir, MANIFEST_NAME), "w") as file:
+        json.dump(manifest, file, indent=4, sort_keys=True)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Render saved flowcharts to PNG or SVG thumbnails without a display.")
+    parser.add_argument("inputs", nargs="+", help="flowchart files or directories to search for .json/.fcb files")
+    parser.add_argument("-o", "--output-dir", default="thumbnails", help="directory for the rendered files")
+    parser.add_argument("-f", "--format", choices=("png", "svg"), default="png", help="output format")
+    parser.add_argument("-s", "--max-size", type=int, default=512, help="longest side in pixels, 0 keeps the diagram size")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1, help="number of worker processes")
+    parser.add_argument("--force", action="store_true", help="render even when the input is unchanged")
+    args = parser.parse_args(argv)
+
+    start_time = time.perf_counter()
+    manifest = load_manifest(args.output_dir)
+    jobs = []
+    hashes = {}
+    skipped = 0
+    sources: Dict[str, str] = {}  # Input path of every output name
+    for input_path, relative_path in collect_inputs(args.inputs):
+        output_name = os.path.splitext(relative_path)[0] + "." + args.format
+        # Outputs are named by file name, or by the path below a given directory, so different
+        # inputs can end up with the same name. One would silently overwrite the other
+        if output_name in sources:
+            source = sources[output_name]
+            if os.path.realpath(source) == os.path.realpath(input_path):
+                continue  # Given twice
+            parser.error(f"{source} and {input_path} would both be rendered to {output_name}, render them in separate runs")
+        sources[output_name] = input_path
+        output_path = os.path.join(args.output_dir, output_name)
+        digest = content_hash(input_path, args.format, args.max_size)
+        if not args.force and manifest.get(output_name) == digest and os.path.exists(output_path):
+            skipped += 1
+            continue
+        hashes[input_path] = (output_name, digest)
+        jobs.append((input_path, output_path, args.format, args.max_size))
+
+    if args.jobs > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=args.jobs, initializer=init_worker) as executor:
+            results = list(executor.map(render_job, jobs, chunksize=max(1, len(jobs) // (args.jobs * 8))))
+    else:
+        init_worker()
+        results = [render_job(job) for job in jobs]
+
+    failed = 0
+    for input_path, error in results:
+        output_name, digest = hashes[input_path]
+        if error:
+            failed += 1
+            manifest.pop(output_name, None)
+            print(f"Error rendering {input_path}: {error}", file=sys.stderr)
+        else:
+            manifest[output_name] = digest
+    save_manifest(args.output_dir, manifest)
+
+    elapsed = time.perf_counter() - start_time
+    rendered = len(results) - failed
+    total = rendered + skipped + failed
+    print(f"Rendered {rendered}, skipped {skipped} unchanged, failed {failed} in {elapsed:.2f}s "
+          f"({total / elapsed if elapsed else 0:.1f} files/sec, {rendered / elapsed if elapsed else 0:.1f} rendered/sec)")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
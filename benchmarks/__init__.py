@@ -0,0 +1 @@
+# Benchmarks of the editor hot paths, run with: python -m benchmarks --help
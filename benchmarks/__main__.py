@@ -0,0 +1,98 @@
+import os
+import sys
+import json
+import platform
+import argparse
+import subprocess
+import tempfile
+from typing import List, Optional
+
+# Run without a display, must be set before Qt creates the application
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+import PySide6
+from PySide6 import QtWidgets
+from benchmarks.generator import TOPOLOGIES, generate_diagram
+from benchmarks.scenarios import SCENARIOS, Bench, summarize
+
+
+def get_commit() -> Optional[str]:
+    try:
+        result = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        return result.stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(results: dict, baseline_path: str, tolerance: float) -> int:
+    # Compares medians with a previous run, returns the number of regressions
+    with open(baseline_path, "r") as file:
+        baseline = json.load(file)
+    if baseline["parameters"] != results["parameters"]:
+        print("Warning: the baseline was run with different parameters", file=sys.stderr)
+
+    regressions = 0
+    print(f"\n{'scenario':<32}{'baseline':>12}{'current':>12}{'ratio':>8}")
+    for name, summary in results["scenarios"].items():
+        previous = baseline["scenarios"].get(name)
+        if not previous or not previous["samples"] or not summary["samples"]:
+            continue
+        ratio = summary["median"] / previous["median"] if previous["median"] else float("inf")
+        regressed = ratio > 1 + tolerance
+        regressions += regressed
+        print(f"{name:<32}{previous['median'] * 1000:>10.3f}ms{summary['median'] * 1000:>10.3f}ms{ratio:>8.2f}"
+              f"{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks",
+                                     description="Time the editor's hot paths on a generated diagram, without a display.")
+    parser.add_argument("--shapes", type=int, default=10000, help="number of shapes in the generated diagram")
+    parser.add_argument("--arrows", type=int, help="number of arrows, defaults to the number of shapes")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the generator and of the scenarios")
+    parser.add_argument("--topology", choices=TOPOLOGIES, default="local", help="how arrows connect the shapes")
+    parser.add_argument("--repeat", type=int, default=5, help="runs of the whole document scenarios (load, save)")
+    parser.add_argument("--events", type=int, default=500, help="events of the interactive scenarios (hover, drag...)")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS), help="scenario to run, may be repeated, defaults to all")
+    parser.add_argument("-o", "--output", default="benchmark-results.json", help="file the results are written to")
+    parser.add_argument("--compare", metavar="BASELINE", help="results of a previous run to compare the medians with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="slowdown ratio above which a scenario counts as regressed")
+    args = parser.parse_args(argv)
+
+    application = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])  # Kept alive for the whole run
+    arrow_count = args.shapes if args.arrows is None else args.arrows
+    diagram_data = generate_diagram(args.shapes, arrow_count, args.seed, args.topology)
+
+    scenarios = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        bench = Bench(diagram_data, args.repeat, args.events, args.seed, work_dir)
+        for name in args.scenario or SCENARIOS:
+            summary = summarize(SCENARIOS[name](bench))
+            scenarios[name] = summary
+            if summary["samples"]:
+                print(f"{name:<32}median {summary['median'] * 1000:>10.3f}ms  p95 {summary['p95'] * 1000:>10.3f}ms  "
+                      f"({summary['samples']} samples)")
+            else:
+                print(f"{name:<32}skipped, nothing to measure")
+
+    results = {
+        "commit": get_commit(),
+        "python": platform.python_version(),
+        "pyside": PySide6.__version__,
+        "platform": platform.platform(),
+        "parameters": {"shapes": args.shapes, "arrows": arrow_count, "seed": args.seed, "topology": args.topology,
+                       "repeat": args.repeat, "events": args.events},
+        "scenarios": scenarios,
+    }
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=4)
+
+    if args.compare:
+        return 1 if compare(results, args.compare, args.tolerance) else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
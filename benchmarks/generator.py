@@ -0,0 +1,65 @@
+import math
+import random
+from typing import Dict, List, Tuple
+
+from app import SHAPE_CLASSES
+from core import ArrowData, DiagramData, ShapeData
+
+TOPOLOGIES = ("random", "local", "chain", "tree")
+WORDS = ("start", "end", "check", "read", "write", "retry", "valid", "load", "save", "done", "input", "output")
+
+shape_sizes: Dict[str, Tuple[int, int]] = {}
+
+
+def shape_size(shape_type: str) -> Tuple[int, int]:
+    # Size of the widget area of a shape, as saved by Area.save_to_diagram_data
+    if shape_type not in shape_sizes:
+        shape = SHAPE_CLASSES[shape_type]()
+        shape_sizes[shape_type] = (shape.width(), shape.height())
+    return shape_sizes[shape_type]
+
+
+def generate_diagram(shape_count: int, arrow_count: int, seed: int = 0, topology: str = "local",
+                     spacing: int = 220) -> DiagramData:
+    # Shapes are laid out on a jittered square grid, spacing apart. Topologies:
+    # random connects any two shapes, local connects grid neighbours like a hand
+    # drawn chart, chain links shapes in order and tree links every shape to a parent
+    if topology not in TOPOLOGIES:
+        raise ValueError(f"unknown topology {topology}")
+    rng = random.Random(seed)
+    shape_types = sorted(SHAPE_CLASSES)
+    columns = max(1, math.ceil(math.sqrt(shape_count)))
+
+    shapes: List[ShapeData] = []
+    for index in range(shape_count):
+        shape_type = rng.choice(shape_types)
+        width, height = shape_size(shape_type)
+        row, column = divmod(index, columns)
+        x = column * spacing + rng.randint(-spacing // 8, spacing // 8)
+        y = row * spacing + rng.randint(-spacing // 8, spacing // 8)
+        text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(0, 2)))
+        shapes.append(ShapeData(shape_type=shape_type, x=x, y=y, width=width, height=height, text=text))
+
+    arrows: List[ArrowData] = []
+    if shape_count > 1:
+        for number in range(arrow_count):
+            if topology == "random":
+                start, end = rng.randrange(shape_count), rng.randrange(shape_count)
+            elif topology == "local":
+                start = rng.randrange(shape_count)
+                row, column = divmod(start, columns)
+                row += rng.randint(-1, 1)
+                column += rng.randint(-1, 1)
+                end = min(max(row * columns + min(max(column, 0), columns - 1), 0), shape_count - 1)
+            elif topology == "chain":
+                start = number % (shape_count - 1)
+                end = start + 1
+            else:
+                end = number % (shape_count - 1) + 1
+                start = (end - 1) // 2
+            start_nodes = len(SHAPE_CLASSES[shapes[start].shape_type].node_positions)
+            end_nodes = len(SHAPE_CLASSES[shapes[end].shape_type].node_positions)
+            arrows.append(ArrowData(start_shape_index=start, start_node_index=rng.randrange(start_nodes),
+                                    end_shape_index=end, end_node_index=rng.randrange(end_nodes)))
+
+    return DiagramData(shapes=shapes, arrows=arrows)
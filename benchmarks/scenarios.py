@@ -0,0 +1,301 @@
+import os
+import math
+import time
+import random
+import statistics
+from typing import Callable, Dict, List, Optional
+
+from PySide6 import QtCore, QtGui, QtWidgets
+from app import Area, Arrow, RemoveCommand
+from core import DiagramData, Serializer
+
+VIEW_SIZE = (1000, 600)
+
+SCENARIOS: Dict[str, Callable[['Bench'], List[float]]] = {}
+
+
+def scenario(name: str) -> Callable:
+    def register(function: Callable[['Bench'], List[float]]) -> Callable[['Bench'], List[float]]:
+        SCENARIOS[name] = function
+        return function
+    return register
+
+
+class Bench:
+    # State shared by the scenarios of one run, every scenario returns its samples in seconds
+    def __init__(self, diagram_data: DiagramData, repeat: int, events: int, seed: int, work_dir: str):
+        self.diagram_data = diagram_data
+        self.repeat = repeat
+        self.events = events
+        self.rng = random.Random(seed)
+        self.work_dir = work_dir
+        self.area: Optional[Area] = None
+        self.area_modified = True
+
+    def get_area(self) -> Area:
+        # The area is loaded once and reloaded only after a scenario modified it
+        if self.area is None:
+            self.area = Area(None)
+            self.area.resize(*VIEW_SIZE)
+            self.area.show()
+        if self.area_modified:
+            self.area.load_from_diagram_data(self.diagram_data)
+            self.area.view_offset = QtCore.QPoint(0, 0)
+            self.area.zoom = 1.0
+            QtWidgets.QApplication.processEvents()
+            self.area_modified = False
+        return self.area
+
+    def get_path(self, extension: str) -> str:
+        return os.path.join(self.work_dir, "diagram" + extension)
+
+
+def timed(function: Callable[[], object]) -> float:
+    start = time.perf_counter()
+    function()
+    return time.perf_counter() - start
+
+
+def mouse_event(event_type: QtCore.QEvent.Type, x: int, y: int,
+                button: QtCore.Qt.MouseButton = QtCore.Qt.NoButton) -> QtGui.QMouseEvent:
+    position = QtCore.QPointF(x, y)
+    return QtGui.QMouseEvent(event_type, position, position, button, button, QtCore.Qt.NoModifier)
+
+
+def move_mouse(area: Area, event: QtGui.QMouseEvent) -> None:
+    # Applies the move right away instead of with the next display frame
+    area.mouseMoveEvent(event)
+    area.flush_mouse_move()
+
+
+def summarize(samples: List[float]) -> Dict[str, float]:
+    ordered = sorted(samples)
+    if not ordered:
+        return {"samples": 0}
+    return {
+        "samples": len(ordered),
+        "min": ordered[0],
+        "median": statistics.median(ordered),
+        "mean": statistics.fmean(ordered),
+        "p95": ordered[min(len(ordered) - 1, math.ceil(len(ordered) * 0.95) - 1)],
+        "max": ordered[-1],
+    }
+
+
+@scenario("serializer_save_json")
+def save_json(bench: Bench) -> List[float]:
+    return [timed(lambda: Serializer.save_to_file(bench.diagram_data, bench.get_path(".json"))) for _ in range(bench.repeat)]
+
+
+@scenario("serializer_load_json")
+def load_json(bench: Bench) -> List[float]:
+    Serializer.save_to_file(bench.diagram_data, bench.get_path(".json"))
+    return [timed(lambda: Serializer.load_from_file(bench.get_path(".json"))) for _ in range(bench.repeat)]
+
+
+@scenario("serializer_load_json_streaming")
+def load_json_streaming(bench: Bench) -> List[float]:
+    Serializer.save_to_file(bench.diagram_data, bench.get_path(".json"))
+    return [timed(lambda: Serializer.load_from_file(bench.get_path(".json"), streaming=True)) for _ in range(bench.repeat)]
+
+
+@scenario("serializer_save_fcb")
+def save_fcb(bench: Bench) -> List[float]:
+    return [timed(lambda: Serializer.save_to_file(bench.diagram_data, bench.get_path(".fcb"))) for _ in range(bench.repeat)]
+
+
+@scenario("serializer_load_fcb")
+def load_fcb(bench: Bench) -> List[float]:
+    # Records are decoded lazily, so every one of them is accessed to compare with JSON
+    Serializer.save_to_file(bench.diagram_data, bench.get_path(".fcb"))
+
+    def load() -> None:
+        diagram_data = Serializer.load_from_file(bench.get_path(".fcb"))
+        list(diagram_data.shapes)
+        list(diagram_data.arrows)
+    return [timed(load) for _ in range(bench.repeat)]
+
+
+@scenario("area_load")
+def area_load(bench: Bench) -> List[float]:
+    area = bench.get_area()
+    return [timed(lambda: area.load_from_diagram_data(bench.diagram_data)) for _ in range(bench.repeat)]
+
+
+@scenario("area_save")
+def area_save(bench: Bench) -> List[float]:
+    area = bench.get_area()
+    return [timed(area.save_to_diagram_data) for _ in range(bench.repeat)]
+
+
+@scenario("hover")
+def hover(bench: Bench) -> List[float]:
+    # Half of the events land on nodes of the visible shapes, half anywhere in the view
+    area = bench.get_area()
+    nodes = [node for shape in area.shapes if area.get_visible_scene_rect().intersects(shape.geometry()) for node in shape.nodes]
+    samples = []
+    for number in range(bench.events):
+        if nodes and number % 2:
+            x, y = bench.rng.choice(nodes).get_global_coordinates()
+        else:
+            x, y = bench.rng.randrange(VIEW_SIZE[0]), bench.rng.randrange(VIEW_SIZE[1])
+        event = mouse_event(QtCore.QEvent.MouseMove, x, y)
+        samples.append(timed(lambda: move_mouse(area, event)))
+    return samples
+
+
+@scenario("arrow_pick")
+def arrow_pick(bench: Bench) -> List[float]:
+    # Picks at the middle of a segment of random arrows, as a double-click on them does
+    area = bench.get_area()
+    arrows = list(area.arrows)
+    samples = []
+    for _ in range(bench.events if arrows else 0):
+        route = bench.rng.choice(arrows).route
+        index = bench.rng.randrange(len(route) - 1)
+        (x1, y1), (x2, y2) = route[index], route[index + 1]
+        x, y = (x1 + x2) // 2, (y1 + y2) // 2
+        samples.append(timed(lambda: area.arrow_index.query_point(x, y, Arrow.pick_threshold)))
+    return samples
+
+
+@scenario("shape_deletion")
+def shape_deletion(bench: Bench) -> List[float]:
+    # Deletes shapes with their arrows the way the cross of a shape does
+    area = bench.get_area()
+    shapes = bench.rng.sample(list(area.shapes), min(len(area.shapes), bench.events))
+    samples = []
+    for shape in shapes:
+        def delete() -> None:
+            command = RemoveCommand([shape], list(area.shape_arrows[shape]))
+            command.redo(area)
+            area.undo_stack.push(command)
+        samples.append(timed(delete))
+    bench.area_modified = True
+    return samples
+
+
+@scenario("drag_frame")
+def drag_frame(bench: Bench) -> List[float]:
+    # Drags the shape closest to the view center in a circle, a frame is the mouse
+    # move plus the repaint it causes
+    area = bench.get_area()
+    if not area.shapes:
+        return []
+    center = area.get_visible_scene_rect().center()
+    shape = min(area.shapes, key=lambda shape: (shape.geometry().center() - center).manhattanLength())
+    start = shape.geometry().center()
+    area.mouseMoveEvent(mouse_event(QtCore.QEvent.MouseMove, start.x(), start.y()))
+    area.mousePressEvent(mouse_event(QtCore.QEvent.MouseButtonPress, start.x(), start.y(), QtCore.Qt.LeftButton))
+    QtWidgets.QApplication.processEvents()
+
+    samples = []
+    radius = min(VIEW_SIZE) // 4
+    for number in range(bench.events):
+        angle = 2 * math.pi * number / 120
+        x = start.x() + round(radius * math.sin(angle))
+        y = start.y() + round(radius * (1 - math.cos(angle)))
+        event = mouse_event(QtCore.QEvent.MouseMove, x, y, QtCore.Qt.LeftButton)
+
+        def frame() -> None:
+            move_mouse(area, event)
+            QtWidgets.QApplication.processEvents()
+        samples.append(timed(frame))
+
+    area.mouseReleaseEvent(mouse_event(QtCore.QEvent.MouseButtonRelease, x, y, QtCore.Qt.LeftButton))
+    bench.area_modified = True
+    return samples
+
+
+@scenario("zoomed_out_pan_frame")
+def zoomed_out_pan_frame(bench: Bench) -> List[float]:
+    # Full repaints while panning with the whole diagram in view
+    area = bench.get_area()
+    area.zoom_to_fit()
+    area.repaint()
+    samples = []
+    for number in range(bench.events):
+        area.view_offset += QtCore.QPoint(1 if number % 2 else -1, 0)
+        samples.append(timed(area.repaint))
+    area.zoom, area.view_offset = 1.0, QtCore.QPoint(0, 0)
+    return samples
+
+
+@scenario("zoomed_out_zoom_frame")
+def zoomed_out_zoom_frame(bench: Bench) -> List[float]:
+    # Full repaints while zooming four wheel notches in and out again with the whole
+    # diagram in view, the zoomed out view is rendered again whenever its level changes
+    area = bench.get_area()
+    area.zoom_to_fit()
+    samples = []
+    for number in range(bench.events):
+        area.zoom_by(Area.zoom_step if number % 8 < 4 else 1 / Area.zoom_step)
+        samples.append(timed(area.repaint))
+    area.zoom, area.view_offset = 1.0, QtCore.QPoint(0, 0)
+    return samples
+
+
+@scenario("group_drag_frame")
+def group_drag_frame(bench: Bench) -> List[float]:
+    # Drags the 2000 shapes closest to the view center together, as drag_frame
+    area = bench.get_area()
+    if not area.shapes:
+        return []
+    center = area.get_visible_scene_rect().center()
+    shapes = sorted(area.shapes, key=lambda shape: (shape.geometry().center() - center).manhattanLength())[:2000]
+    area.set_selected(shapes, True)
+    start = shapes[0].geometry().center()
+    area.mouseMoveEvent(mouse_event(QtCore.QEvent.MouseMove, start.x(), start.y()))
+    area.mousePressEvent(mouse_event(QtCore.QEvent.MouseButtonPress, start.x(), start.y(), QtCore.Qt.LeftButton))
+    QtWidgets.QApplication.processEvents()
+
+    samples = []
+    for number in range(bench.events):
+        event = mouse_event(QtCore.QEvent.MouseMove, start.x() + number % 50, start.y() + number % 30, QtCore.Qt.LeftButton)
+
+        def frame() -> None:
+            move_mouse(area, event)
+            QtWidgets.QApplication.processEvents()
+        samples.append(timed(frame))
+
+    area.mouseReleaseEvent(mouse_event(QtCore.QEvent.MouseButtonRelease, event.position().x(), event.position().y(), QtCore.Qt.LeftButton))
+    bench.area_modified = True
+    return samples
+
+
+@scenario("drag_burst")
+def drag_burst(bench: Bench) -> List[float]:
+    # Drags a shape with a move reported every millisecond, as by a 1000 Hz mouse, through the
+    # event loop. A sample is the time spent applying moves within one millisecond, most of
+    # them are only recorded and the latest one is applied with the next display frame
+    area = bench.get_area()
+    if not area.shapes:
+        return []
+    center = area.get_visible_scene_rect().center()
+    shape = min(area.shapes, key=lambda shape: (shape.geometry().center() - center).manhattanLength())
+    start = shape.geometry().center()
+    area.mouseMoveEvent(mouse_event(QtCore.QEvent.MouseMove, start.x(), start.y()))
+    area.mousePressEvent(mouse_event(QtCore.QEvent.MouseButtonPress, start.x(), start.y(), QtCore.Qt.LeftButton))
+    QtWidgets.QApplication.processEvents()
+
+    applied = []
+    apply_mouse_move = area.apply_mouse_move
+    area.apply_mouse_move = lambda pos: applied.append(timed(lambda: apply_mouse_move(pos)))
+    samples = []
+    radius = min(VIEW_SIZE) // 4
+    next_report = time.perf_counter()
+    for number in range(bench.events):
+        angle = 2 * math.pi * number / 500
+        x = start.x() + round(radius * math.sin(angle))
+        y = start.y() + round(radius * (1 - math.cos(angle)))
+        area.mouseMoveEvent(mouse_event(QtCore.QEvent.MouseMove, x, y, QtCore.Qt.LeftButton))
+        next_report += 0.001
+        while time.perf_counter() < next_report:
+            QtWidgets.QApplication.processEvents()
+        samples.append(sum(applied))
+        applied.clear()
+    del area.apply_mouse_move
+
+    area.mouseReleaseEvent(mouse_event(QtCore.QEvent.MouseButtonRelease, x, y, QtCore.Qt.LeftButton))
+    bench.area_modified = True
+    return samples
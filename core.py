@@ -0,0 +1,2032 @@
+import io
+import os
+import bisect
+import functools
+import heapq
+import json
+import math
+import mmap
+import re
+import struct
+import threading
+import time
+import weakref
+from array import array
+from collections import deque
+from collections.abc import Mapping, Sequence
+from itertools import accumulate
+from dataclasses import dataclass, field, replace
+from typing import BinaryIO, Callable, Deque, Dict, Hashable, Iterable, Iterator, List, Optional, Set, TextIO, Tuple
+
+# The data model, file formats, routing, layout and validation of flowcharts. Nothing in here
+# imports Qt, so headless tools start quickly and run where the Qt libraries aren't installed
+
+# Nodes of every shape type relative to the shape center, in the order arrows refer to them
+NODE_POSITIONS: Dict[str, List[Tuple[int, int]]] = {
+    'Process': [(-65, 0), (65, 0), (0, 40), (0, -40)],
+    'Decision': [(-65, 0), (65, 0), (0, 65), (0, -65)],
+    'Terminator': [(-65, 0), (65, 0), (0, 40), (0, -40)],
+    'IO': [(0, -40), (60, 0), (0, 40), (-60, 0)]
+}
+
+
+numpy_min_records = 4096  # Bulk operations on fewer records run in Python, they finish before NumPy would be imported
+
+
+@functools.lru_cache(maxsize=None)
+def load_numpy():
+    # NumPy is optional and imported on first use, importing it takes longer than
+    # everything else a headless command does on a small diagram
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+@dataclass
+class ShapeData:
+    shape_type: str
+    x: int
+    y: int
+    width: int
+    height: int
+    text: str
+    shape_id: Optional[str] = None  # Stable across saves and reordering, None until assigned
+    child: Optional[str] = None  # Sub-diagram the shape stands for, see Serializer.resolve_reference
+
+
+def is_integer(value) -> bool:
+    # Fields a hand edited file may hold as other JSON values, booleans included
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def new_shape_id() -> str:
+    # Random, so shapes added to two copies of a diagram don't collide when they are merged
+    return os.urandom(8).hex()
+
+
+@dataclass
+class ArrowData:
+    start_shape_index: int
+    start_node_index: int
+    end_shape_index: int
+    end_node_index: int
+
+
+@dataclass
+class DiagramData:
+    shapes: List[ShapeData]
+    arrows: List[ArrowData]
+    # Sub-diagrams saved in the same file by name, decoded only when accessed
+    sections: Mapping[str, 'DiagramData'] = field(default_factory=dict)
+
+
+class DiagramSections(Mapping):
+    # Read only mapping of the sections of a file, decoding a section every time it is accessed.
+    # Keeping the decoded ones is left to DiagramCache
+    def __init__(self, names: Iterable[str], decode: Callable[[str], DiagramData]):
+        self.names = dict.fromkeys(names)  # Ordered set
+        self.decode = decode
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __contains__(self, name) -> bool:
+        return name in self.names
+
+    def __getitem__(self, name: str) -> DiagramData:
+        if name not in self.names:
+            raise KeyError(name)
+        return self.decode(name)
+
+
+class Profiler:
+    # Opt-in timing of the hot paths, enabled with --profile or FLOWCHART_PROFILE.
+    # Keeps the latest samples of every measurement for rolling percentiles, the
+    # recent call rate and a bounded trace, dumped as JSON or Chrome trace on exit
+    window = 1000  # Samples per measurement the percentiles are computed from
+    trace_limit = 200000  # Events kept for the Chrome trace
+
+    def __init__(self):
+        self.enabled = False
+        self.output_path: Optional[str] = None
+        self.output_format = "json"
+        self.samples: Dict[str, Deque[float]] = {}
+        self.counts: Dict[str, int] = {}
+        self.recent: Dict[str, Deque[float]] = {}  # End times within the last second, for the call rate
+        self.trace: Deque[Tuple[str, float, float, int]] = deque(maxlen=self.trace_limit)
+        self.origin = time.perf_counter()
+        self.lock = threading.Lock()  # Serializer calls are also measured on worker threads
+
+    def enable(self, output_path: Optional[str] = None, output_format: str = "json") -> None:
+        self.enabled = True
+        self.output_path = output_path
+        self.output_format = output_format
+
+    def timed(self, name: str) -> Callable:
+        # Decorator measuring every call of the function while profiling is enabled
+        def decorate(function: Callable) -> Callable:
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.add(name, start, time.perf_counter())
+            return wrapper
+        return decorate
+
+    def add(self, name: str, start: float, end: float) -> None:
+        with self.lock:
+            if name not in self.samples:
+                self.samples[name] = deque(maxlen=self.window)
+                self.counts[name] = 0
+                self.recent[name] = deque()
+            self.samples[name].append(end - start)
+            self.counts[name] += 1
+            self.recent[name].append(end)
+            self.trace.append((name, start, end, threading.get_ident()))
+
+    def percentiles(self, name: str) -> Tuple[float, float, float]:
+        # p50, p95 and p99 of the latest samples, in seconds
+        with self.lock:
+            ordered = sorted(self.samples.get(name, ()))
+        if not ordered:
+            return (0.0, 0.0, 0.0)
+        return tuple(ordered[min(len(ordered) - 1, math.ceil(len(ordered) * fraction) - 1)] for fraction in (0.5, 0.95, 0.99))
+
+    def rate(self, name: str) -> int:
+        # Calls during the last second
+        with self.lock:
+            recent = self.recent.get(name)
+            if not recent:
+                return 0
+            while recent and recent[0] < time.perf_counter() - 1:
+                recent.popleft()
+            return len(recent)
+
+    def summary(self) -> Dict[str, dict]:
+        summary = {}
+        for name in sorted(self.samples):
+            p50, p95, p99 = self.percentiles(name)
+            summary[name] = {"count": self.counts[name], "p50_ms": p50 * 1000, "p95_ms": p95 * 1000,
+                             "p99_ms": p99 * 1000, "max_ms": max(self.samples[name]) * 1000}
+        return summary
+
+    def dump(self) -> None:
+        if not self.output_path:
+            return
+        if self.output_format == "chrome":
+            # Complete events in microseconds, loadable in chrome://tracing or Perfetto
+            data = {"displayTimeUnit": "ms", "traceEvents": [
+                {"name": name, "cat": "flowchart", "ph": "X", "pid": os.getpid(), "tid": thread,
+                 "ts": (start - self.origin) * 1e6, "dur": (end - start) * 1e6}
+                for name, start, end, thread in self.trace]}
+        else:
+            data = {"measurements": self.summary()}
+        try:
+            with open(self.output_path, "w") as file:
+                json.dump(data, file, indent=4 if self.output_format == "json" else None)
+        except IOError as e:
+            print(f"Error writing profile: {e}")
+
+
+profiler = Profiler()
+
+
+class ColumnarDiagramData:
+    # Diagram stored as parallel typed columns instead of one dataclass per record,
+    # texts and shape types are interned and referenced by index. Bulk operations
+    # use NumPy views of the columns when it is installed and the diagram is large.
+    def __init__(self):
+        self.shape_types: List[str] = []
+        self.shape_type_codes: Dict[str, int] = {}
+        self.texts: List[str] = []
+        self.text_ids: Dict[str, int] = {}
+
+        self.type_code = array("H")
+        self.x = array("i")
+        self.y = array("i")
+        self.width = array("i")
+        self.height = array("i")
+        self.text = array("I")
+        self.shape_ids: List[Optional[str]] = []
+        self.children: List[Optional[str]] = []
+
+        self.start_shape = array("i")
+        self.start_node = array("i")
+        self.end_shape = array("i")
+        self.end_node = array("i")
+
+    @property
+    def shape_count(self) -> int:
+        return len(self.x)
+
+    @property
+    def arrow_count(self) -> int:
+        return len(self.start_shape)
+
+    @staticmethod
+    def from_diagram_data(diagram_data: DiagramData) -> 'ColumnarDiagramData':
+        columns = ColumnarDiagramData()
+        columns.extend(diagram_data.shapes, diagram_data.arrows)
+        return columns
+
+    def to_diagram_data(self) -> DiagramData:
+        return DiagramData(shapes=[self.shape(index) for index in range(self.shape_count)],
+                           arrows=[self.arrow(index) for index in range(self.arrow_count)])
+
+    def extend(self, shapes: Iterable[ShapeData], arrows: Iterable[ArrowData]) -> None:
+        for shape in shapes:
+            self.add_shape(shape)
+        for arrow in arrows:
+            self.add_arrow(arrow)
+
+    def add_shape(self, shape: ShapeData) -> int:
+        type_code = self.shape_type_codes.get(shape.shape_type)
+        if type_code is None:
+            type_code = self.shape_type_codes[shape.shape_type] = len(self.shape_types)
+            self.shape_types.append(shape.shape_type)
+        text_id = self.text_ids.get(shape.text)
+        if text_id is None:
+            text_id = self.text_ids[shape.text] = len(self.texts)
+            self.texts.append(shape.text)
+
+        self.type_code.append(type_code)
+        self.x.append(shape.x)
+        self.y.append(shape.y)
+        self.width.append(shape.width)
+        self.height.append(shape.height)
+        self.text.append(text_id)
+        self.shape_ids.append(shape.shape_id)
+        self.children.append(shape.child)
+        return self.shape_count - 1
+
+    def add_arrow(self, arrow: ArrowData) -> int:
+        self.start_shape.append(arrow.start_shape_index)
+        self.start_node.append(arrow.start_node_index)
+        self.end_shape.append(arrow.end_shape_index)
+        self.end_node.append(arrow.end_node_index)
+        return self.arrow_count - 1
+
+    def shape(self, index: int) -> ShapeData:
+        return ShapeData(self.shape_types[self.type_code[index]], self.x[index], self.y[index], self.width[index],
+                         self.height[index], self.texts[self.text[index]], self.shape_ids[index], self.children[index])
+
+    def arrow(self, index: int) -> ArrowData:
+        return ArrowData(self.start_shape[index], self.start_node[index], self.end_shape[index], self.end_node[index])
+
+    def translate(self, dx: int, dy: int, indices: Optional[Iterable[int]] = None) -> None:
+        # Move all shapes, or only the given ones, by the same offset in place
+        numpy = load_numpy() if self.shape_count >= numpy_min_records else None
+        if numpy is not None:
+            x = numpy.frombuffer(self.x, dtype=numpy.int32)
+            y = numpy.frombuffer(self.y, dtype=numpy.int32)
+            if indices is None:
+                x += dx
+                y += dy
+            else:
+                selection = numpy.fromiter(indices, dtype=numpy.intp)
+                x[selection] += dx
+                y[selection] += dy
+            return
+        for index in range(self.shape_count) if indices is None else indices:
+            self.x[index] += dx
+            self.y[index] += dy
+
+    def bounding_box(self) -> Optional[Tuple[int, int, int, int]]:
+        # (left, top, right, bottom) of all shapes, None when there are none
+        if not self.shape_count:
+            return None
+        numpy = load_numpy() if self.shape_count >= numpy_min_records else None
+        if numpy is not None:
+            x = numpy.frombuffer(self.x, dtype=numpy.int32).astype(numpy.int64)
+            y = numpy.frombuffer(self.y, dtype=numpy.int32).astype(numpy.int64)
+            right = x + numpy.frombuffer(self.width, dtype=numpy.int32)
+            bottom = y + numpy.frombuffer(self.height, dtype=numpy.int32)
+            return int(x.min()), int(y.min()), int(right.max()), int(bottom.max())
+        return (min(self.x), min(self.y),
+                max(map(int.__add__, self.x, self.width)), max(map(int.__add__, self.y, self.height)))
+
+    def indices_of_type(self, shape_type: str) -> array:
+        # Indices of the shapes of the given type, in order
+        type_code = self.shape_type_codes.get(shape_type)
+        if type_code is None:
+            return array("i")
+        numpy = load_numpy() if self.shape_count >= numpy_min_records else None
+        if numpy is not None:
+            codes = numpy.frombuffer(self.type_code, dtype=numpy.uint16)
+            return array("i", numpy.flatnonzero(codes == type_code).astype(numpy.int32).tobytes())
+        return array("i", [index for index, code in enumerate(self.type_code) if code == type_code])
+
+    def type_counts(self) -> Dict[str, int]:
+        numpy = load_numpy() if self.shape_count >= numpy_min_records else None
+        if numpy is not None:
+            counts = numpy.bincount(numpy.frombuffer(self.type_code, dtype=numpy.uint16), minlength=len(self.shape_types)).tolist()
+        else:
+            counts = [0] * len(self.shape_types)
+            for code in self.type_code:
+                counts[code] += 1
+        return dict(zip(self.shape_types, counts))
+
+
+class JsonStreamReader:
+    # Decodes the arrays of a top level JSON object one element at a time,
+    # reading the file in chunks so memory is bounded by the largest element
+    whitespace = re.compile(r"[ \t\n\r]*")
+    number_chars = frozenset("0123456789.eE+-")
+
+    def __init__(self, file: TextIO, chunk_size: int = 1 << 16):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.position = 0
+        self.consumed = 0  # Characters read from the file so far
+        self.values: Dict[str, object] = {}  # Top level values that are not arrays, read so far
+
+    def fill(self, size: int = 0) -> bool:
+        # Reads at least a chunk, or size characters
+        chunk = self.file.read(max(self.chunk_size, size))
+        self.consumed += len(chunk)
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+        return bool(chunk)
+
+    def peek(self) -> str:
+        # Skip whitespace and return the next character, empty at end of file
+        while True:
+            self.position = self.whitespace.match(self.buffer, self.position).end()
+            if self.position < len(self.buffer) or not self.fill():
+                return self.buffer[self.position:self.position + 1]
+
+    def expect(self, char: str) -> None:
+        if self.peek() != char:
+            raise json.JSONDecodeError(f"Expecting '{char}'", self.buffer, self.position)
+        self.position += 1
+
+    def decode_value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+            except json.JSONDecodeError:
+                # The value may continue in the next chunks. Decoding starts over from the start
+                # of the value, so what is buffered of it is doubled before trying again, which
+                # keeps values spanning many chunks, like the sections of a file, linear
+                if self.fill(len(self.buffer) - self.position):
+                    continue
+                raise
+            # A number may also be cut at the end of the buffer, where "1e" or "-6." decode as a shorter number
+            if (end == len(self.buffer) or isinstance(value, (int, float)) and self.buffer[end] in self.number_chars) and self.fill():
+                continue
+            self.position = end
+            return value
+
+    def iter_arrays(self) -> Iterator[Tuple[str, object]]:
+        # Yields (key, element) for every element of every top level array,
+        # values that are not arrays are decoded into self.values
+        self.expect("{")
+        if self.peek() == "}":
+            return
+        while True:
+            key = self.decode_value()
+            self.expect(":")
+            if self.peek() == "[":
+                self.position += 1
+                if self.peek() == "]":
+                    self.position += 1
+                else:
+                    while True:
+                        yield key, self.decode_value()
+                        if self.peek() == "]":
+                            self.position += 1
+                            break
+                        self.expect(",")
+            else:
+                self.values[key] = self.decode_value()
+            if self.peek() == "}":
+                return
+            self.expect(",")
+
+
+class BinaryFormat:
+    # Layout of .fcb files, all little endian:
+    # header | shape records | arrow records | per section: shape records | arrow records |
+    # string offsets | utf-8 string data | section records
+    # Texts, shape types, shape ids, children and section names are stored once in the string
+    # table and referenced by index
+    extension = ".fcb"
+    magic = b"FCB1"
+    version = 3
+    prefix = struct.Struct("<4sI")  # magic, version
+    headers = {  # Per version, files of older versions are still read
+        1: struct.Struct("<4sIIIIQQQ"),  # magic, version, shape/arrow/string counts, shape/arrow/string offsets
+        2: struct.Struct("<4sIIIIQQQ"),
+        3: struct.Struct("<4sIIIIQQQIQ"),  # Then section count and offset
+    }
+    header = headers[version]
+    shape_records = {
+        1: struct.Struct("<IiiiiI"),  # shape_type, x, y, width, height, text
+        2: struct.Struct("<IiiiiII"),  # Then shape_id
+        3: struct.Struct("<IiiiiIII"),  # Then child, no_string when there is none
+    }
+    shape_record = shape_records[version]
+    arrow_record = struct.Struct("<iiii")  # start shape, start node, end shape, end node
+    section_record = struct.Struct("<IQIQI")  # name, shapes offset, shape count, arrows offset, arrow count
+    string_offset = struct.Struct("<Q")
+    no_string = 0xFFFFFFFF
+
+    @staticmethod
+    def write(file: BinaryIO, shapes: Iterable[ShapeData], arrows: Iterable[ArrowData],
+              sections: Optional[Mapping[str, DiagramData]] = None) -> None:
+        strings: Dict[str, int] = {}
+        shape_record = BinaryFormat.shape_record
+        arrow_record = BinaryFormat.arrow_record
+
+        def write_shapes(shapes: Iterable[ShapeData]) -> Tuple[int, int]:
+            offset = file.tell()
+            count = 0
+            for shape in shapes:
+                shape_type = strings.setdefault(shape.shape_type, len(strings))
+                text = strings.setdefault(shape.text, len(strings))
+                shape_id = strings.setdefault(shape.shape_id or str(count), len(strings))
+                child = BinaryFormat.no_string if shape.child is None else strings.setdefault(shape.child, len(strings))
+                file.write(shape_record.pack(shape_type, shape.x, shape.y, shape.width, shape.height, text, shape_id, child))
+                count += 1
+            return offset, count
+
+        def write_arrows(arrows: Iterable[ArrowData]) -> Tuple[int, int]:
+            offset = file.tell()
+            count = 0
+            for arrow in arrows:
+                file.write(arrow_record.pack(arrow.start_shape_index, arrow.start_node_index, arrow.end_shape_index, arrow.end_node_index))
+                count += 1
+            return offset, count
+
+        # Header is written last, once the counts are known
+        file.write(bytes(BinaryFormat.header.size))
+        shapes_offset, shape_count = write_shapes(shapes)
+        arrows_offset, arrow_count = write_arrows(arrows)
+        section_records = []
+        for name, section in (sections or {}).items():
+            section_shapes = write_shapes(section.shapes)
+            section_arrows = write_arrows(section.arrows)
+            section_records.append((strings.setdefault(name, len(strings)),) + section_shapes + section_arrows)
+
+        strings_offset = file.tell()
+        encoded = [string.encode("utf-8", "surrogatepass") for string in strings]
+        offset = 0
+        for data in encoded:
+            file.write(BinaryFormat.string_offset.pack(offset))
+            offset += len(data)
+        file.write(BinaryFormat.string_offset.pack(offset))
+        file.write(b"".join(encoded))
+
+        sections_offset = file.tell()
+        for record in section_records:
+            file.write(BinaryFormat.section_record.pack(*record))
+
+        file.seek(0)
+        file.write(BinaryFormat.header.pack(BinaryFormat.magic, BinaryFormat.version, shape_count, arrow_count, len(strings),
+                                            shapes_offset, arrows_offset, strings_offset, len(section_records), sections_offset))
+        file.seek(0, io.SEEK_END)
+
+    @staticmethod
+    def open(file_path: str) -> DiagramData:
+        # Records are decoded lazily from the memory mapped file, sections only once accessed
+        return BinaryDiagram(file_path).root()
+
+    @staticmethod
+    def close(file_path: str) -> None:
+        # Unmaps the file before it is replaced or removed, which fails on Windows while it is
+        # mapped. Diagrams opened from it can't be read afterwards, they are outdated anyway
+        file_path = os.path.normcase(os.path.realpath(file_path))
+        with BinaryDiagram.lock:
+            diagrams = [diagram for diagram in BinaryDiagram.open_diagrams if diagram.file_path == file_path]
+        for diagram in diagrams:
+            diagram.close()
+
+
+class BinaryDiagram:
+    # The open diagrams, for BinaryFormat.close to find those of a file
+    open_diagrams: 'weakref.WeakSet[BinaryDiagram]' = weakref.WeakSet()
+    lock = threading.Lock()  # Files are loaded and saved on worker threads
+
+    def __init__(self, file_path: str):
+        self.file_path = os.path.normcase(os.path.realpath(file_path))
+        with open(file_path, "rb") as file:
+            self.mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self.read_header()
+        except (ValueError, struct.error):
+            self.mapping.close()
+            raise
+        with BinaryDiagram.lock:
+            BinaryDiagram.open_diagrams.add(self)
+
+    def __enter__(self) -> 'BinaryDiagram':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        # Records of the diagram can't be read afterwards
+        with BinaryDiagram.lock:
+            BinaryDiagram.open_diagrams.discard(self)
+        self.mapping.close()
+
+    def read_header(self) -> None:
+        if len(self.mapping) < BinaryFormat.prefix.size:
+            raise ValueError("File is too short for a flowchart header")
+        magic, version = BinaryFormat.prefix.unpack_from(self.mapping)
+        if magic != BinaryFormat.magic or version not in BinaryFormat.headers:
+            raise ValueError("Not a supported flowchart binary file")
+        if len(self.mapping) < BinaryFormat.headers[version].size:
+            raise ValueError("File is too short for a flowchart header")
+        header = BinaryFormat.headers[version].unpack_from(self.mapping)
+        (self.shape_count, self.arrow_count, self.string_count,
+         self.shapes_offset, self.arrows_offset, self.strings_offset) = header[2:8]
+        section_count, sections_offset = header[8:] or (0, 0)
+        self.shape_record = BinaryFormat.shape_records[version]
+        self.string_data_offset = self.strings_offset + (self.string_count + 1) * BinaryFormat.string_offset.size
+        self.strings: List[Optional[str]] = [None] * self.string_count
+        # Record ranges of the sections by name, read from the small section table only
+        self.sections: Dict[str, tuple] = {}
+        for name, *ranges in BinaryFormat.section_record.iter_unpack(
+                self.mapping[sections_offset:sections_offset + section_count * BinaryFormat.section_record.size]):
+            self.sections[self.string(name)] = ranges
+
+    def root(self) -> DiagramData:
+        return self.diagram(self.shapes_offset, self.shape_count, self.arrows_offset, self.arrow_count, root=True)
+
+    def diagram(self, shapes_offset: int, shape_count: int, arrows_offset: int, arrow_count: int, root: bool = False) -> DiagramData:
+        # The root diagram, which holds the sections of the file, or a section, as in JSON files
+        return DiagramData(
+            shapes=BinaryRecords(shape_count, functools.partial(self.shape, shapes_offset),
+                                 functools.partial(self.iter_shapes, shapes_offset, shape_count)),
+            arrows=BinaryRecords(arrow_count, functools.partial(self.arrow, arrows_offset),
+                                 functools.partial(self.iter_arrows, arrows_offset, arrow_count)),
+            sections=DiagramSections(self.sections, lambda name: self.diagram(*self.sections[name])) if root else {})
+
+    def string(self, index: int) -> str:
+        string = self.strings[index]
+        if string is None:
+            start, end = struct.unpack_from("<QQ", self.mapping, self.strings_offset + index * BinaryFormat.string_offset.size)
+            string = str(self.mapping[self.string_data_offset + start:self.string_data_offset + end], "utf-8", "surrogatepass")
+            self.strings[index] = string
+        return string
+
+    def shape(self, offset: int, index: int) -> ShapeData:
+        return self.decode_shape(index, self.shape_record.unpack_from(self.mapping, offset + index * self.shape_record.size))
+
+    def decode_shape(self, index: int, record: tuple) -> ShapeData:
+        # Files without shape ids use the index, as index based JSON files do
+        shape_type, x, y, width, height, text = record[:6]
+        shape_id = self.string(record[6]) if len(record) > 6 else str(index)
+        child = self.string(record[7]) if len(record) > 7 and record[7] != BinaryFormat.no_string else None
+        return ShapeData(self.string(shape_type), x, y, width, height, self.string(text), shape_id, child)
+
+    def arrow(self, offset: int, index: int) -> ArrowData:
+        return ArrowData(*BinaryFormat.arrow_record.unpack_from(self.mapping, offset + index * BinaryFormat.arrow_record.size))
+
+    def iter_records(self, record: struct.Struct, offset: int, count: int, chunk_records: int = 4096) -> Iterator[tuple]:
+        # Bulk decoding of consecutive records, a chunk at a time
+        for first in range(0, count, chunk_records):
+            start = offset + first * record.size
+            end = offset + min(count, first + chunk_records) * record.size
+            yield from record.iter_unpack(self.mapping[start:end])
+
+    def iter_shapes(self, offset: int, count: int) -> Iterator[ShapeData]:
+        decode_shape = self.decode_shape
+        for index, record in enumerate(self.iter_records(self.shape_record, offset, count)):
+            yield decode_shape(index, record)
+
+    def iter_arrows(self, offset: int, count: int) -> Iterator[ArrowData]:
+        for record in self.iter_records(BinaryFormat.arrow_record, offset, count):
+            yield ArrowData(*record)
+
+
+class BinaryRecords(Sequence):
+    # Read only list of the records of a BinaryDiagram, decoded on access
+    def __init__(self, count: int, decode: Callable[[int], object], iterate: Callable[[], Iterator]):
+        self.count = count
+        self.decode = decode
+        self.iterate = iterate
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.decode(i) for i in range(*index.indices(self.count))]
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError("record index out of range")
+        return self.decode(index)
+
+    def __iter__(self):
+        return self.iterate()
+
+
+class Serializer:
+    progress_step = 1024  # Records written between progress reports
+
+    @staticmethod
+    @profiler.timed("Serializer.save_to_file")
+    def save_to_file(diagram_data: DiagramData, file_path: str, indent: Optional[int] = 4,
+                     progress: Optional[Callable[[int, int], None]] = None) -> bool:
+        # The format is picked from the file extension
+        shapes, arrows = diagram_data.shapes, diagram_data.arrows
+        if progress:
+            total = len(shapes) + len(arrows)
+            shapes = Serializer.track(shapes, progress, 0, total)
+            arrows = Serializer.track(arrows, progress, len(diagram_data.shapes), total)
+        try:
+            Serializer.write_file(file_path, shapes, arrows, indent, diagram_data.sections)
+            return True
+        except (IOError, ValueError, struct.error) as e:
+            print(f"Error saving file: {e}")
+            return False
+
+    @staticmethod
+    def write_file(file_path: str, shapes: Iterable[ShapeData], arrows: Iterable[ArrowData], indent: Optional[int] = 4,
+                   sections: Optional[Mapping[str, DiagramData]] = None) -> None:
+        # The file is written next to the target and moved in place once complete, so a
+        # failed or cancelled write never leaves a truncated file behind
+        temp_path = file_path + ".tmp"
+        try:
+            if Serializer.is_binary(file_path):
+                with open(temp_path, "wb") as file:
+                    BinaryFormat.write(file, shapes, arrows, sections)
+            else:
+                with open(temp_path, "w") as file:
+                    Serializer.write_stream(file, shapes, arrows, indent, sections)
+            BinaryFormat.close(file_path)
+            os.replace(temp_path, file_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    @staticmethod
+    def track(records: Iterable, progress: Callable[[int, int], None], done: int, total: int) -> Iterator:
+        # Reports progress every progress_step records while passing them through
+        for number, record in enumerate(records, done + 1):
+            if number % Serializer.progress_step == 0:
+                progress(number, total)
+            yield record
+        progress(done + len(records), total)
+
+    @staticmethod
+    def is_binary(file_path: str) -> bool:
+        return file_path.lower().endswith(BinaryFormat.extension)
+
+    @staticmethod
+    @profiler.timed("Serializer.convert")
+    def convert(source_path: str, target_path: str, indent: Optional[int] = 4) -> bool:
+        # Lossless conversion between JSON and binary files, records are streamed
+        # from the source so the whole diagram is never held in memory
+        try:
+            if os.path.exists(target_path) and os.path.samefile(source_path, target_path):
+                raise ValueError("the target is the source file")
+            if Serializer.is_binary(source_path):
+                with BinaryDiagram(source_path) as diagram:
+                    source = diagram.root()
+                    Serializer.write_file(target_path, source.shapes, source.arrows, indent, source.sections)
+            else:
+                Serializer.write_file(target_path, Serializer.iter_shapes(source_path), Serializer.iter_arrows(source_path),
+                                      indent, Serializer.load_sections(source_path))
+            return True
+        except (IOError, ValueError, struct.error) as e:
+            print(f"Error converting file: {e}")
+            return False
+
+    @staticmethod
+    def write_stream(file: TextIO, shapes: Iterable[ShapeData], arrows: Iterable[ArrowData], indent: Optional[int] = 4,
+                     sections: Optional[Mapping[str, DiagramData]] = None) -> None:
+        # Writes shapes and arrows as they are produced, pass indent=None for compact output
+        if indent is None:
+            item_separator, key_separator, newline, level = ",", ":", "", ""
+        else:
+            item_separator, key_separator, newline, level = ",", ": ", "\n", " " * indent
+
+        shape_ids = []  # Arrows are written after the shapes, by the ids of their shapes
+
+        def shape_elements() -> Iterator[dict]:
+            for index, shape in enumerate(shapes):
+                element = Serializer.encode_shape(shape, index)
+                shape_ids.append(element["shape_id"])
+                yield element
+
+        arrow_elements = (Serializer.encode_arrow(arrow, shape_ids) for arrow in arrows)
+        file.write("{")
+        for number, (key, elements) in enumerate((("shapes", shape_elements()), ("arrows", arrow_elements))):
+            if number:
+                file.write(item_separator)
+            file.write(f'{newline}{level}"{key}"{key_separator}[')
+            empty = True
+            for element in elements:
+                element = json.dumps(element, indent=indent, separators=(item_separator, key_separator))
+                if indent is not None:
+                    element = element.replace("\n", "\n" + level * 2)
+                file.write(f"{'' if empty else item_separator}{newline}{level * 2}{element}")
+                empty = False
+            if not empty:
+                file.write(f"{newline}{level}")
+            file.write("]")
+        if sections:
+            # Sections are charts of their own, small next to a whole hierarchy, so each one is encoded at once
+            file.write(f'{item_separator}{newline}{level}"diagrams"{key_separator}{{')
+            for number, (name, section) in enumerate(sections.items()):
+                element = json.dumps(Serializer.encode_diagram(section), indent=indent, separators=(item_separator, key_separator))
+                if indent is not None:
+                    element = element.replace("\n", "\n" + level * 2)
+                file.write(f"{item_separator if number else ''}{newline}{level * 2}{json.dumps(name)}{key_separator}{element}")
+            file.write(f"{newline}{level}}}")
+        file.write(f"{newline}}}")
+
+    @staticmethod
+    def encode_diagram(diagram_data: DiagramData) -> dict:
+        elements = [Serializer.encode_shape(shape, index) for index, shape in enumerate(diagram_data.shapes)]
+        shape_ids = [element["shape_id"] for element in elements]
+        return {"shapes": elements, "arrows": [Serializer.encode_arrow(arrow, shape_ids) for arrow in diagram_data.arrows]}
+
+    @staticmethod
+    def encode_shape(shape: ShapeData, index: int) -> dict:
+        # Shapes without an id get the one an index based file is loaded with
+        element = {"shape_id": shape.shape_id or str(index), "shape_type": shape.shape_type, "x": shape.x, "y": shape.y,
+                   "width": shape.width, "height": shape.height, "text": shape.text}
+        if shape.child is not None:
+            element["child"] = shape.child
+        return element
+
+    @staticmethod
+    def encode_arrow(arrow: ArrowData, shape_ids: List[str]) -> dict:
+        # Arrows refer to shapes by id, so they don't change when the shapes are reordered.
+        # Out of range indices are written as they are and reported when loaded
+        element = {}
+        for end, shape_index, node_index in (("start", arrow.start_shape_index, arrow.start_node_index),
+                                             ("end", arrow.end_shape_index, arrow.end_node_index)):
+            if 0 <= shape_index < len(shape_ids):
+                element[f"{end}_shape_id"] = shape_ids[shape_index]
+            else:
+                element[f"{end}_shape_index"] = shape_index
+            element[f"{end}_node_index"] = node_index
+        return element
+
+    @staticmethod
+    def decode_shape(element: dict, index: int) -> ShapeData:
+        shape = ShapeData(**element)
+        if shape.shape_id is None:
+            shape.shape_id = str(index)  # Saved before shapes had ids
+        return shape
+
+    @staticmethod
+    def decode_arrow(element: dict, shape_indices: Dict[str, int]) -> ArrowData:
+        # Both index and id based ends are accepted, unknown ids become -1 so the arrow is reported as invalid
+        for end in ("start", "end"):
+            if f"{end}_shape_id" in element:
+                element[f"{end}_shape_index"] = shape_indices.get(element.pop(f"{end}_shape_id"), -1)
+        return ArrowData(**element)
+
+    @staticmethod
+    def decode_diagram(element: dict) -> DiagramData:
+        shapes = [Serializer.decode_shape(shape_element, index) for index, shape_element in enumerate(element['shapes'])]
+        shape_indices = Serializer.get_shape_indices(shapes)
+        return DiagramData(shapes=shapes, arrows=[Serializer.decode_arrow(arrow_element, shape_indices) for arrow_element in element['arrows']])
+
+    @staticmethod
+    def decode_sections(elements: Dict[str, dict]) -> Mapping[str, DiagramData]:
+        # The sections of a JSON file are parsed with it, but only turned into records when visited
+        if not isinstance(elements, dict):
+            raise ValueError("diagrams must be an object")
+        return DiagramSections(elements, lambda name: Serializer.decode_diagram(elements[name]))
+
+    @staticmethod
+    def get_shape_indices(shapes: Iterable[ShapeData]) -> Dict[str, int]:
+        # Index of every shape id, the first shape wins if an id is duplicated
+        shape_indices = {}
+        for index, shape in enumerate(shapes):
+            shape_indices.setdefault(shape.shape_id, index)
+        return shape_indices
+
+    @staticmethod
+    @profiler.timed("Serializer.load_from_file")
+    def load_from_file(file_path: str, streaming: bool = False,
+                       progress: Optional[Callable[[int, int], None]] = None) -> DiagramData:
+        # Streaming parses element by element instead of holding the whole decoded
+        # document, slower but bounded in memory for very large files. Progress is
+        # reported in characters read and only while streaming
+        try:
+            if Serializer.is_binary(file_path):
+                return BinaryFormat.open(file_path)
+            if streaming:
+                shapes = []
+                arrow_elements = []  # Decoded once all shape ids are known
+                total = os.path.getsize(file_path)
+                with open(file_path, "r") as file:
+                    reader = JsonStreamReader(file)
+                    for key, element in reader.iter_arrays():
+                        if key == "shapes":
+                            shapes.append(Serializer.decode_shape(element, len(shapes)))
+                        elif key == "arrows":
+                            arrow_elements.append(element)
+                        if progress:
+                            progress(min(reader.consumed, total), total)
+                shape_indices = Serializer.get_shape_indices(shapes)
+                return DiagramData(shapes=shapes, arrows=[Serializer.decode_arrow(element, shape_indices) for element in arrow_elements],
+                                   sections=Serializer.decode_sections(reader.values.get("diagrams", {})))
+            with open(file_path, "r") as file:
+                data = json.load(file)
+            if not isinstance(data, dict):
+                raise ValueError("the diagram must be an object")
+            diagram_data = Serializer.decode_diagram(data)
+            diagram_data.sections = Serializer.decode_sections(data.get("diagrams", {}))
+            return diagram_data
+        except (IOError, ValueError, TypeError, struct.error) as e:
+            print(f"Error loading file: {e}")
+            return None
+
+    @staticmethod
+    def validate(diagram_data: DiagramData) -> bool:
+        # Checks that every arrow refers to an existing shape and node
+        node_counts = []
+        for number, shape in enumerate(diagram_data.shapes):
+            if not isinstance(shape.shape_type, str) or not all(is_integer(value) for value in (shape.x, shape.y, shape.width, shape.height)):
+                print(f"Invalid diagram: shape {number} has a field of the wrong type")
+                return False
+            node_counts.append(len(NODE_POSITIONS.get(shape.shape_type, ())))
+        for number, arrow in enumerate(diagram_data.arrows):
+            for shape_index, node_index in ((arrow.start_shape_index, arrow.start_node_index),
+                                            (arrow.end_shape_index, arrow.end_node_index)):
+                if not is_integer(shape_index) or not is_integer(node_index):
+                    print(f"Invalid diagram: arrow {number} refers to node {node_index!r} of shape {shape_index!r}")
+                    return False
+                if not 0 <= shape_index < len(node_counts) or not 0 <= node_index < node_counts[shape_index]:
+                    print(f"Invalid diagram: arrow {number} refers to missing node {node_index} of shape {shape_index}")
+                    return False
+        return True
+
+    @staticmethod
+    def iter_shapes(file_path: str) -> Iterator[ShapeData]:
+        with open(file_path, "r") as file:
+            index = 0
+            for key, element in JsonStreamReader(file).iter_arrays():
+                if key == "shapes":
+                    yield Serializer.decode_shape(element, index)
+                    index += 1
+
+    @staticmethod
+    def iter_arrows(file_path: str) -> Iterator[ArrowData]:
+        # The shape ids are read in a first pass
+        shape_indices = Serializer.get_shape_indices(Serializer.iter_shapes(file_path))
+        with open(file_path, "r") as file:
+            for key, element in JsonStreamReader(file).iter_arrays():
+                if key == "arrows":
+                    yield Serializer.decode_arrow(element, shape_indices)
+
+    @staticmethod
+    def load_sections(file_path: str) -> Mapping[str, DiagramData]:
+        # The sections of a file without its root diagram. JSON files are only read through
+        # once more, element by element, when they name sections at all
+        if Serializer.is_binary(file_path):
+            return BinaryFormat.open(file_path).sections
+        if not os.path.getsize(file_path):
+            return {}
+        with open(file_path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+            if mapping.find(b'"diagrams"') < 0:
+                return {}
+        with open(file_path, "r") as file:
+            reader = JsonStreamReader(file)
+            for _ in reader.iter_arrays():
+                pass
+        return Serializer.decode_sections(reader.values.get("diagrams", {}))
+
+    # Diagrams of a hierarchy are named by documents: the path of their file, followed by
+    # "#" and the name of their section unless they are the root diagram of the file
+
+    @staticmethod
+    def split_document(document: str) -> Tuple[str, Optional[str]]:
+        # (file path, section name or None), a "#" within the directories is part of the path
+        file_path, separator, section = document.rpartition("#")
+        if not separator or "/" in section or os.sep in section:
+            return document, None
+        return file_path, section
+
+    @staticmethod
+    def resolve_reference(document: Optional[str], reference: str) -> str:
+        # The document a child refers to from the diagram of document, None for an unsaved one.
+        # A child names a file relative to the file of its diagram, "#name" a section of that
+        # file and "file#name" a section of another file
+        file_path, section = Serializer.split_document(reference)
+        base_path = Serializer.split_document(document)[0] if document else None
+        if file_path:
+            file_path = os.path.normpath(os.path.join(os.path.dirname(base_path) if base_path else "", file_path))
+        elif base_path:
+            file_path = base_path
+        else:
+            raise ValueError(f"'{reference}' refers to a section of a diagram that was never saved")
+        return file_path if section is None else f"{file_path}#{section}"
+
+    @staticmethod
+    def save_document(diagram_data: DiagramData, document: str, progress: Optional[Callable[[int, int], None]] = None,
+                      source: Optional[str] = None) -> bool:
+        # The other diagrams of the file are kept, for a root diagram those of the file it was
+        # loaded from, source, if that is another one. Saving a section writes the whole file again
+        file_path, section = Serializer.split_document(document)
+        try:
+            if section is None:
+                source = source or file_path
+                if not diagram_data.sections and os.path.exists(source):
+                    diagram_data = replace(diagram_data, sections=Serializer.load_sections(source))
+                return Serializer.save_to_file(diagram_data, file_path, progress=progress)
+            root = Serializer.load_from_file(file_path) if os.path.exists(file_path) else DiagramData(shapes=[], arrows=[])
+            if root is None:
+                return False
+            sections = {name: root.sections[name] for name in root.sections}
+            sections[section] = diagram_data
+            return Serializer.save_to_file(replace(root, sections=sections), file_path, progress=progress)
+        except (IOError, ValueError, TypeError, KeyError, struct.error) as e:
+            print(f"Error saving file: {e}")
+            return False
+
+
+class DiagramCache:
+    # Recently visited diagrams of a hierarchy by document. A diagram is loaded when it is
+    # first visited, and the least recently visited ones are dropped once more than size are
+    # held, so only the charts the user drills into are ever loaded
+    def __init__(self, size: int = 32):
+        self.size = size
+        self.diagrams: Dict[str, DiagramData] = {}  # Least recently visited first
+        self.lock = threading.Lock()  # Diagrams are loaded on worker threads
+
+    def get(self, document: str) -> Optional[DiagramData]:
+        with self.lock:
+            diagram_data = self.diagrams.pop(document, None)
+            if diagram_data is not None:
+                self.diagrams[document] = diagram_data
+                return diagram_data
+        file_path, section = Serializer.split_document(document)
+        if section is None:
+            diagram_data = Serializer.load_from_file(file_path)
+        else:
+            # Through the root of the file, so the sections of a JSON file are parsed only once
+            root = self.get(file_path)
+            try:
+                diagram_data = root and root.sections[section]
+            except (KeyError, ValueError, TypeError, struct.error) as e:
+                print(f"Error loading section {section}: {e}")
+                diagram_data = None
+        if diagram_data is not None:
+            self.put(document, diagram_data)
+        return diagram_data
+
+    def put(self, document: str, diagram_data: DiagramData) -> None:
+        with self.lock:
+            self.diagrams.pop(document, None)
+            self.diagrams[document] = diagram_data
+            while len(self.diagrams) > self.size:
+                del self.diagrams[next(iter(self.diagrams))]
+
+    def discard(self, file_path: str) -> None:
+        # Drops every diagram of a file, once it was written
+        with self.lock:
+            for document in [document for document in self.diagrams if Serializer.split_document(document)[0] == file_path]:
+                del self.diagrams[document]
+
+
+def point_to_segment_distance(px: float, py: float, x1: float, y1: float, x2: float, y2: float) -> float:
+    dx, dy = x2 - x1, y2 - y1
+    length_squared = dx * dx + dy * dy
+    if length_squared == 0:
+        return math.hypot(px - x1, py - y1)
+    # Project the point on the segment and clamp to its endpoints
+    t = max(0.0, min(1.0, ((px - x1) * dx + (py - y1) * dy) / length_squared))
+    return math.hypot(px - (x1 + t * dx), py - (y1 + t * dy))
+
+
+def segment_intersects_rect(x1: float, y1: float, x2: float, y2: float,
+                            left: float, top: float, right: float, bottom: float) -> bool:
+    # Liang-Barsky clipping of the segment against the rectangle
+    dx, dy = x2 - x1, y2 - y1
+    t_min, t_max = 0.0, 1.0
+    for p, q in ((-dx, x1 - left), (dx, right - x1), (-dy, y1 - top), (dy, bottom - y1)):
+        if p == 0:
+            if q < 0:
+                return False
+        else:
+            t = q / p
+            if p < 0:
+                t_min = max(t_min, t)
+            else:
+                t_max = min(t_max, t)
+            if t_min > t_max:
+                return False
+    return True
+
+
+class SpatialGrid:
+    # Uniform grid bucketing items by their bounding rectangle, so point and
+    # rectangle queries only look at the items sharing the queried cells
+    def __init__(self, cell_size: int = 128):
+        self.cell_size = cell_size
+        self.cells: Dict[Tuple[int, int], Set[Hashable]] = {}
+        self.bounds: Dict[Hashable, Tuple[int, int, int, int]] = {}
+        self.item_cells: Dict[Hashable, Tuple[int, int, int, int]] = {}
+
+    def __len__(self) -> int:
+        return len(self.bounds)
+
+    def cell_range(self, left: int, top: int, right: int, bottom: int) -> Tuple[int, int, int, int]:
+        size = self.cell_size
+        return left // size, top // size, right // size, bottom // size
+
+    def insert(self, item: Hashable, left: int, top: int, right: int, bottom: int) -> None:
+        if item in self.bounds:
+            self.update(item, left, top, right, bottom)
+            return
+        self.bounds[item] = (left, top, right, bottom)
+        cell_range = self.cell_range(left, top, right, bottom)
+        self.item_cells[item] = cell_range
+        self.add_to_cells(item, cell_range)
+
+    def update(self, item: Hashable, left: int, top: int, right: int, bottom: int) -> None:
+        if item not in self.bounds:
+            self.insert(item, left, top, right, bottom)
+            return
+        self.bounds[item] = (left, top, right, bottom)
+        cell_range = self.cell_range(left, top, right, bottom)
+        # Only re-bucket when the item actually crossed a cell border
+        if cell_range != self.item_cells[item]:
+            self.remove_from_cells(item, self.item_cells[item])
+            self.item_cells[item] = cell_range
+            self.add_to_cells(item, cell_range)
+
+    def remove(self, item: Hashable) -> None:
+        if item not in self.bounds:
+            return
+        self.remove_from_cells(item, self.item_cells.pop(item))
+        del self.bounds[item]
+
+    def clear(self) -> None:
+        self.cells.clear()
+        self.bounds.clear()
+        self.item_cells.clear()
+
+    def query_point(self, x: int, y: int) -> List[Hashable]:
+        cell = self.cells.get((x // self.cell_size, y // self.cell_size))
+        if not cell:
+            return []
+        result = []
+        for item in cell:
+            left, top, right, bottom = self.bounds[item]
+            if left <= x <= right and top <= y <= bottom:
+                result.append(item)
+        return result
+
+    def query_rect(self, left: int, top: int, right: int, bottom: int, limit: Optional[int] = None) -> Set[Hashable]:
+        # Stops after limit items when given, for callers that only need to know whether there are that many
+        result = set()
+        first_col, first_row, last_col, last_row = self.cell_range(left, top, right, bottom)
+        for col in range(first_col, last_col + 1):
+            for row in range(first_row, last_row + 1):
+                for item in self.cells.get((col, row), ()):
+                    item_left, item_top, item_right, item_bottom = self.bounds[item]
+                    if item_left <= right and left <= item_right and item_top <= bottom and top <= item_bottom:
+                        result.add(item)
+                        if len(result) == limit:
+                            return result
+        return result
+
+    def add_to_cells(self, item: Hashable, cell_range: Tuple[int, int, int, int]) -> None:
+        first_col, first_row, last_col, last_row = cell_range
+        for col in range(first_col, last_col + 1):
+            for row in range(first_row, last_row + 1):
+                self.cells.setdefault((col, row), set()).add(item)
+
+    def remove_from_cells(self, item: Hashable, cell_range: Tuple[int, int, int, int]) -> None:
+        first_col, first_row, last_col, last_row = cell_range
+        for col in range(first_col, last_col + 1):
+            for row in range(first_row, last_row + 1):
+                cell = self.cells[(col, row)]
+                cell.discard(item)
+                if not cell:
+                    del self.cells[(col, row)]
+
+
+class SegmentIndex:
+    # Uniform grid bucketing polylines by the cells their segments actually cross,
+    # long diagonal segments don't fill their whole bounding box. A polyline is
+    # stored flat as (x1, y1, x2, y2, ..., xn, yn), a single segment is the 2 point case
+    def __init__(self, cell_size: int = 128):
+        self.cell_size = cell_size
+        self.cells: Dict[Tuple[int, int], Set[Hashable]] = {}
+        self.segments: Dict[Hashable, Tuple[int, ...]] = {}
+        self.item_cells: Dict[Hashable, Set[Tuple[int, int]]] = {}
+
+    def __len__(self) -> int:
+        return len(self.segments)
+
+    @staticmethod
+    def iter_segments(points: Tuple[int, ...]) -> Iterator[Tuple[int, int, int, int]]:
+        for index in range(0, len(points) - 2, 2):
+            yield points[index], points[index + 1], points[index + 2], points[index + 3]
+
+    def segment_cells(self, x1: int, y1: int, x2: int, y2: int) -> List[Tuple[int, int]]:
+        size = self.cell_size
+        if x1 > x2:
+            x1, y1, x2, y2 = x2, y2, x1, y1
+        if y1 == y2:
+            # Horizontal, as most segments of routed connectors
+            row = y1 // size
+            return [(col, row) for col in range(x1 // size, x2 // size + 1)]
+        cells = []
+        for col in range(x1 // size, x2 // size + 1):
+            # Part of the segment within this column
+            if x1 == x2:
+                low, high = min(y1, y2), max(y1, y2)
+            else:
+                slope = (y2 - y1) / (x2 - x1)
+                start_x = max(x1, col * size)
+                end_x = min(x2, (col + 1) * size)
+                start_y = y1 + (start_x - x1) * slope
+                end_y = y1 + (end_x - x1) * slope
+                low, high = min(start_y, end_y), max(start_y, end_y)
+            for row in range(int(low) // size, int(high) // size + 1):
+                cells.append((col, row))
+        return cells
+
+    def insert(self, item: Hashable, *points: int) -> None:
+        if item in self.segments:
+            self.remove(item)
+        self.segments[item] = points
+        cells = set()
+        for segment in self.iter_segments(points):
+            cells.update(self.segment_cells(*segment))
+        self.item_cells[item] = cells
+        for cell in cells:
+            self.cells.setdefault(cell, set()).add(item)
+
+    def update(self, item: Hashable, *points: int) -> None:
+        if self.segments.get(item) != points:
+            self.insert(item, *points)
+
+    def remove(self, item: Hashable) -> None:
+        if item not in self.segments:
+            return
+        for cell in self.item_cells.pop(item):
+            bucket = self.cells[cell]
+            bucket.discard(item)
+            if not bucket:
+                del self.cells[cell]
+        del self.segments[item]
+
+    def clear(self) -> None:
+        self.cells.clear()
+        self.segments.clear()
+        self.item_cells.clear()
+
+    def candidates(self, left: int, top: int, right: int, bottom: int) -> Set[Hashable]:
+        size = self.cell_size
+        result = set()
+        for col in range(int(left) // size, int(right) // size + 1):
+            for row in range(int(top) // size, int(bottom) // size + 1):
+                result.update(self.cells.get((col, row), ()))
+        return result
+
+    def query_point(self, x: int, y: int, threshold: float) -> List[Hashable]:
+        # Polylines whose distance to the point is within the threshold
+        result = []
+        for item in self.candidates(x - threshold, y - threshold, x + threshold, y + threshold):
+            if any(point_to_segment_distance(x, y, *segment) <= threshold for segment in self.iter_segments(self.segments[item])):
+                result.append(item)
+        return result
+
+    def query_rect(self, left: int, top: int, right: int, bottom: int) -> List[Hashable]:
+        # Polylines crossing or lying inside the rectangle
+        result = []
+        for item in self.candidates(left, top, right, bottom):
+            if any(segment_intersects_rect(*segment, left, top, right, bottom) for segment in self.iter_segments(self.segments[item])):
+                result.append(item)
+        return result
+
+class OrthogonalRouter:
+    # Routes connectors as horizontal and vertical segments that keep margin away
+    # from the rectangles of a SpatialGrid. A route leaves its start and enters its
+    # end along their directions. L and Z shapes are tried first, then A* over the
+    # sparse grid of obstacle borders around both ends, where every bend costs
+    # bend_cost pixels. Searches that would grow too large give up on avoiding
+    # obstacles, so a single route stays cheap enough to reroute while dragging
+    margin = 15
+    bend_cost = 50
+    search_margin = 100  # Space around the two ends the search may go through
+    max_obstacles = 60
+    max_expansions = 3000
+
+    def __init__(self, obstacles: SpatialGrid):
+        self.obstacles = obstacles
+
+    @staticmethod
+    def get_direction(x: int, y: int) -> Tuple[int, int]:
+        # Axis direction pointing away from the center, for a point at offset (x, y) from it
+        if abs(x) >= abs(y):
+            return (1 if x >= 0 else -1), 0
+        return 0, (1 if y >= 0 else -1)
+
+    def route(self, start: Tuple[int, int], start_direction: Tuple[int, int],
+              end: Tuple[int, int], end_direction: Tuple[int, int], quick: bool = False) -> List[Tuple[int, int]]:
+        # Points of the route from start to end, both included. Quick routes skip the search,
+        # for arrows that are routed again soon anyway
+        start_exit = self.get_exit(start, start_direction)
+        end_exit = self.get_exit(end, end_direction)
+        horizontal = start_direction[0] != 0
+        middle = (self.route_simple(start_exit, end_exit)
+                  or (not quick and self.search(start_exit, horizontal, end_exit, end_direction[0] != 0))
+                  or self.get_z_shape(start_exit, end_exit, horizontal))
+        route = self.simplify([start] + middle + [end])
+        return route if len(route) > 1 else [start, end]
+
+    def get_exit(self, point: Tuple[int, int], direction: Tuple[int, int]) -> Tuple[int, int]:
+        # First point in the direction that is margin away from the obstacles under point
+        x, y = point
+        dx, dy = direction
+        for item in self.obstacles.query_point(x, y):
+            left, top, right, bottom = self.obstacles.bounds[item]
+            if dx:
+                x = min(x, left - self.margin) if dx < 0 else max(x, right + self.margin)
+            else:
+                y = min(y, top - self.margin) if dy < 0 else max(y, bottom + self.margin)
+        if (x, y) == point:
+            x, y = x + dx * self.margin, y + dy * self.margin
+        return x, y
+
+    def is_clear(self, x1: int, y1: int, x2: int, y2: int) -> bool:
+        # Whether the axis aligned segment stays margin away from every obstacle
+        inset = self.margin - 1
+        return not self.obstacles.query_rect(min(x1, x2) - inset, min(y1, y2) - inset, max(x1, x2) + inset, max(y1, y2) + inset, limit=1)
+
+    @staticmethod
+    def get_z_shape(start: Tuple[int, int], end: Tuple[int, int], horizontal: bool) -> List[Tuple[int, int]]:
+        (x1, y1), (x2, y2) = start, end
+        if horizontal:
+            middle = (x1 + x2) // 2
+            return [start, (middle, y1), (middle, y2), end]
+        middle = (y1 + y2) // 2
+        return [start, (x1, middle), (x2, middle), end]
+
+    def route_simple(self, start: Tuple[int, int], end: Tuple[int, int]) -> Optional[List[Tuple[int, int]]]:
+        # Straight, L or Z shaped route between the exits if one is clear, fewest bends first
+        (x1, y1), (x2, y2) = start, end
+        candidates = [[start, end]] if x1 == x2 or y1 == y2 else []
+        candidates += [[start, (x2, y1), end], [start, (x1, y2), end],
+                       self.get_z_shape(start, end, True), self.get_z_shape(start, end, False)]
+        for points in candidates:
+            if all(self.is_clear(*first, *second) for first, second in zip(points, points[1:])):
+                return points
+        return None
+
+    def search(self, start: Tuple[int, int], start_horizontal: bool,
+               end: Tuple[int, int], end_horizontal: bool) -> Optional[List[Tuple[int, int]]]:
+        # A* from exit to exit over the lines margin away from the obstacles nearby,
+        # states are grid points with the axis they were reached along
+        (start_x, start_y), (end_x, end_y) = start, end
+        if not self.is_clear(start_x, start_y, start_x, start_y) or not self.is_clear(end_x, end_y, end_x, end_y):
+            return None  # Squeezed against another obstacle, there is no way around it
+        left, right = min(start_x, end_x) - self.search_margin, max(start_x, end_x) + self.search_margin
+        top, bottom = min(start_y, end_y) - self.search_margin, max(start_y, end_y) + self.search_margin
+        obstacles = [self.obstacles.bounds[item] for item in
+                     self.obstacles.query_rect(left - self.margin, top - self.margin, right + self.margin, bottom + self.margin,
+                                               limit=self.max_obstacles + 1)]
+        if len(obstacles) > self.max_obstacles:
+            return None
+        xs = {left, right, start_x, end_x}
+        ys = {top, bottom, start_y, end_y}
+        for item_left, item_top, item_right, item_bottom in obstacles:
+            xs.update((item_left - self.margin, item_right + self.margin))
+            ys.update((item_top - self.margin, item_bottom + self.margin))
+        xs = sorted(x for x in xs if left <= x <= right)
+        ys = sorted(y for y in ys if top <= y <= bottom)
+        columns = len(xs)
+
+        # Grid edges to the right and downwards that pass closer than margin to an obstacle,
+        # the lines strictly within margin of an obstacle are found by bisection
+        blocked_right = bytearray(columns * len(ys))
+        blocked_down = bytearray(columns * len(ys))
+        for item_left, item_top, item_right, item_bottom in obstacles:
+            first_column = bisect.bisect_right(xs, item_left - self.margin)
+            last_column = bisect.bisect_left(xs, item_right + self.margin) - 1
+            first_row = bisect.bisect_right(ys, item_top - self.margin)
+            last_row = bisect.bisect_left(ys, item_bottom + self.margin) - 1
+            for row in range(first_row, last_row + 1):
+                for column in range(max(first_column - 1, 0), min(last_column, columns - 2) + 1):
+                    blocked_right[row * columns + column] = 1
+            for column in range(first_column, last_column + 1):
+                for row in range(max(first_row - 1, 0), min(last_row, len(ys) - 2) + 1):
+                    blocked_down[row * columns + column] = 1
+
+        def estimate(x: int, y: int) -> int:
+            # Distance left, plus the bend needed when not aligned with the end yet
+            return abs(x - end_x) + abs(y - end_y) + (self.bend_cost if x != end_x and y != end_y else 0)
+
+        # Ties go to the state closest to the end, the grid has many equally short paths
+        goal = (bisect.bisect_left(xs, end_x), bisect.bisect_left(ys, end_y))
+        end_axis = 0 if end_horizontal else 1
+        first = (bisect.bisect_left(xs, start_x), bisect.bisect_left(ys, start_y), 0 if start_horizontal else 1)
+        costs = {first: 0}
+        parents = {}
+        queue = [(estimate(start_x, start_y), 0, first)]
+        for _ in range(self.max_expansions):
+            if not queue:
+                return None
+            _, cost, state = heapq.heappop(queue)
+            cost = -cost
+            if cost > costs[state]:
+                continue
+            column, row, axis = state
+            if (column, row) == goal:
+                if axis == end_axis:
+                    points = []
+                    while state in parents:
+                        points.append((xs[state[0]], ys[state[1]]))
+                        state = parents[state]
+                    points.append(start)
+                    return points[::-1]
+                # Turning into the end direction costs a bend
+                turned = (column, row, end_axis)
+                if cost + self.bend_cost < costs.get(turned, math.inf):
+                    costs[turned] = cost + self.bend_cost
+                    parents[turned] = state
+                    heapq.heappush(queue, (cost + self.bend_cost, -cost - self.bend_cost, turned))
+                continue
+            index = row * columns + column
+            neighbours = []
+            if column > 0 and not blocked_right[index - 1]:
+                neighbours.append((column - 1, row, 0))
+            if column < columns - 1 and not blocked_right[index]:
+                neighbours.append((column + 1, row, 0))
+            if row > 0 and not blocked_down[index - columns]:
+                neighbours.append((column, row - 1, 1))
+            if row < len(ys) - 1 and not blocked_down[index]:
+                neighbours.append((column, row + 1, 1))
+            x, y = xs[column], ys[row]
+            for next_state in neighbours:
+                next_x, next_y = xs[next_state[0]], ys[next_state[1]]
+                next_cost = cost + abs(next_x - x) + abs(next_y - y) + (self.bend_cost if next_state[2] != axis else 0)
+                if next_cost < costs.get(next_state, math.inf):
+                    costs[next_state] = next_cost
+                    parents[next_state] = state
+                    heapq.heappush(queue, (next_cost + estimate(next_x, next_y), -next_cost, next_state))
+        return None
+
+    @staticmethod
+    def simplify(points: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+        # Drops repeated points and points in the middle of a straight run
+        result: List[Tuple[int, int]] = []
+        for point in points:
+            if result and point == result[-1]:
+                continue
+            if len(result) > 1 and (result[-2][0] == result[-1][0] == point[0] or result[-2][1] == result[-1][1] == point[1]):
+                result[-1] = point
+            else:
+                result.append(point)
+        return result
+
+class LayeredLayout:
+    # Layered (Sugiyama style) layout along the arrows, from top to bottom. Cycles
+    # are broken by reversing the back edges of a depth first search, shapes are
+    # layered by longest path and arrows crossing several layers are split into
+    # dummy nodes. Barycenter sweeps then order the layers to reduce crossings, and
+    # shapes are pulled towards their neighbours without overlapping. The sweeps
+    # and coordinate passes handle all layers at once, with NumPy when it is
+    # installed. Only DiagramData is used, so it also runs without a display
+    shape_gap = 40  # Horizontal space between the shapes of a layer
+    dummy_gap = 10  # Horizontal space taken by an arrow passing through a layer
+    layer_gap = 80  # Vertical space between layers
+    sweeps = 13  # Alternately downwards and upwards, ending downwards
+    balance_passes = 8
+    search_radius = 20  # Rings of candidates tried around the target of a placed shape
+
+    def apply(self, diagram_data: DiagramData, indices: Optional[Iterable[int]] = None) -> None:
+        # Lays out the whole diagram in place, or only places the shapes at indices
+        if indices is None:
+            positions = dict(enumerate(self.layout(diagram_data)))
+        else:
+            positions = self.place(diagram_data, indices)
+        diagram_data.shapes = [replace(shape, x=positions[index][0], y=positions[index][1]) if index in positions else shape
+                               for index, shape in enumerate(diagram_data.shapes)]
+
+    @profiler.timed("layout")
+    def layout(self, diagram_data: DiagramData,
+               progress: Optional[Callable[[int, int], None]] = None) -> List[Tuple[int, int]]:
+        # Top left position of every shape, in the order of diagram_data.shapes
+        shapes = list(diagram_data.shapes)
+        if not shapes:
+            return []
+        total = self.sweeps + self.balance_passes
+
+        def report(done: int) -> None:
+            if progress:
+                progress(done, total)
+
+        edges = self.break_cycles(len(shapes), self.get_edges(diagram_data))
+        layers = self.assign_layers(len(shapes), edges)
+        node_layers, sources, targets = self.split_edges(layers, edges)
+        dummy_count = len(node_layers) - len(shapes)
+        half_widths = [shape.width / 2 for shape in shapes] + [0.0] * dummy_count
+        gaps = [self.shape_gap] * len(shapes) + [self.dummy_gap] * dummy_count
+
+        positions = self.order_layers(node_layers, sources, targets, report)
+        centers = self.assign_x(node_layers, sources, targets, positions, half_widths, gaps,
+                                lambda done: report(self.sweeps + done))
+
+        # Shapes are centered vertically in the row of their layer
+        row_height = max(shape.height for shape in shapes)
+        lefts = [centers[index] - shape.width / 2 for index, shape in enumerate(shapes)]
+        min_left = min(lefts)
+        min_layer = min(layers)
+        return [(round(left - min_left), (layer - min_layer) * (row_height + self.layer_gap) + (row_height - shape.height) // 2)
+                for left, layer, shape in zip(lefts, layers, shapes)]
+
+    def place(self, diagram_data: DiagramData, indices: Iterable[int]) -> Dict[int, Tuple[int, int]]:
+        # Positions of the shapes at indices only, the others stay where they are. A
+        # shape goes below the shapes with arrows to it, or else above the shapes it
+        # has arrows to, at the closest free spot. Shapes without placed neighbours
+        # go to the right of the diagram
+        shapes = list(diagram_data.shapes)
+        waiting = dict.fromkeys(indices)
+        predecessors: Dict[int, List[int]] = {index: [] for index in waiting}
+        successors: Dict[int, List[int]] = {index: [] for index in waiting}
+        for arrow in diagram_data.arrows:
+            start, end = arrow.start_shape_index, arrow.end_shape_index
+            if start != end and end in waiting:
+                predecessors[end].append(start)
+            if start != end and start in waiting:
+                successors[start].append(end)
+
+        positions = {index: (shape.x, shape.y) for index, shape in enumerate(shapes) if index not in waiting}
+        grid = SpatialGrid()
+        for index, (x, y) in positions.items():
+            grid.insert(index, x, y, x + shapes[index].width - 1, y + shapes[index].height - 1)
+        right = max((x + shapes[index].width for index, (x, _) in positions.items()), default=None)
+        top = min((y for _, y in positions.values()), default=0)
+
+        # Shapes next to placed ones go first, so chains of new shapes grow out of the diagram
+        ready = deque(index for index in waiting
+                      if any(other in positions for other in predecessors[index] + successors[index]))
+        result = {}
+        while waiting:
+            index = ready.popleft() if ready else next(iter(waiting))
+            if index not in waiting:
+                continue
+            del waiting[index]
+            shape = shapes[index]
+            above = [other for other in predecessors[index] if other in positions]
+            below = [other for other in successors[index] if other in positions]
+            neighbours = above or below
+            if neighbours:
+                center = sum(positions[other][0] + shapes[other].width / 2 for other in neighbours) / len(neighbours)
+                x = round(center - shape.width / 2)
+                if above:
+                    y = max(positions[other][1] + shapes[other].height for other in above) + self.layer_gap
+                else:
+                    y = min(positions[other][1] for other in below) - self.layer_gap - shape.height
+            elif right is not None:
+                x, y = right + self.shape_gap, top
+            else:
+                x, y = 0, 0
+
+            x, y = self.find_free_position(grid, x, y, shape.width, shape.height)
+            positions[index] = result[index] = (x, y)
+            grid.insert(index, x, y, x + shape.width - 1, y + shape.height - 1)
+            right = max(right, x + shape.width) if right is not None else x + shape.width
+            top = min(top, y)
+            ready.extend(other for other in predecessors[index] + successors[index] if other in waiting)
+        return result
+
+    def find_free_position(self, grid: SpatialGrid, x: int, y: int, width: int, height: int) -> Tuple[int, int]:
+        # Closest position to (x, y), in steps of the shape size, where the shape keeps
+        # half a gap away from every item of the grid. (x, y) if none is free nearby
+        margin = self.shape_gap // 2
+        step_x, step_y = width + self.shape_gap, height + self.shape_gap
+        for radius in range(self.search_radius + 1):
+            ring = [(column, row) for row in range(-radius, radius + 1) for column in range(-radius, radius + 1)
+                    if max(abs(column), abs(row)) == radius]
+            ring.sort(key=lambda cell: (cell[0] * step_x) ** 2 + (cell[1] * step_y) ** 2)
+            for column, row in ring:
+                left, top = x + column * step_x, y + row * step_y
+                if not grid.query_rect(left - margin, top - margin, left + width - 1 + margin, top + height - 1 + margin):
+                    return left, top
+        return x, y
+
+    @staticmethod
+    def get_edges(diagram_data: DiagramData) -> List[Tuple[int, int]]:
+        # Distinct (start, end) shape pairs of the arrows, without self loops or invalid indices
+        shape_count = len(diagram_data.shapes)
+        edges = {}
+        for arrow in diagram_data.arrows:
+            if arrow.start_shape_index != arrow.end_shape_index and 0 <= arrow.start_shape_index < shape_count \
+                    and 0 <= arrow.end_shape_index < shape_count:
+                edges[(arrow.start_shape_index, arrow.end_shape_index)] = None
+        return list(edges)
+
+    @staticmethod
+    def break_cycles(node_count: int, edges: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+        # Reverses the edges closing a cycle during a depth first search, the result is acyclic
+        successors: List[List[int]] = [[] for _ in range(node_count)]
+        for start, end in edges:
+            successors[start].append(end)
+        state = bytearray(node_count)  # 0 unvisited, 1 on the search path, 2 done
+        back_edges = set()
+        for root in range(node_count):
+            if state[root]:
+                continue
+            state[root] = 1
+            stack = [(root, iter(successors[root]))]
+            while stack:
+                node, children = stack[-1]
+                for child in children:
+                    if state[child] == 1:
+                        back_edges.add((node, child))
+                    elif not state[child]:
+                        state[child] = 1
+                        stack.append((child, iter(successors[child])))
+                        break
+                else:
+                    state[node] = 2
+                    stack.pop()
+        if not back_edges:
+            return edges
+        return list(dict.fromkeys((end, start) if (start, end) in back_edges else (start, end) for start, end in edges))
+
+    @staticmethod
+    def assign_layers(node_count: int, edges: List[Tuple[int, int]]) -> List[int]:
+        # Longest path layering of an acyclic graph, sources are then moved down to
+        # the layer above their first successor to shorten their edges
+        successors: List[List[int]] = [[] for _ in range(node_count)]
+        in_degrees = [0] * node_count
+        for start, end in edges:
+            successors[start].append(end)
+            in_degrees[end] += 1
+        sources = [node for node in range(node_count) if not in_degrees[node]]
+        layers = [0] * node_count
+        queue = deque(sources)
+        while queue:
+            node = queue.popleft()
+            for child in successors[node]:
+                layers[child] = max(layers[child], layers[node] + 1)
+                in_degrees[child] -= 1
+                if not in_degrees[child]:
+                    queue.append(child)
+        for node in sources:
+            if successors[node]:
+                layers[node] = min(layers[child] for child in successors[node]) - 1
+        return layers
+
+    @staticmethod
+    def split_edges(layers: List[int], edges: List[Tuple[int, int]]) -> Tuple[List[int], List[int], List[int]]:
+        # Layers of the nodes followed by one dummy node per layer crossed by an edge,
+        # and the (sources, targets) of the edges between consecutive layers
+        node_layers = list(layers)
+        sources: List[int] = []
+        targets: List[int] = []
+        for start, end in edges:
+            previous = start
+            for layer in range(layers[start] + 1, layers[end]):
+                node_layers.append(layer)
+                sources.append(previous)
+                previous = len(node_layers) - 1
+                targets.append(previous)
+            sources.append(previous)
+            targets.append(end)
+        return node_layers, sources, targets
+
+    def order_layers(self, node_layers: List[int], sources: List[int], targets: List[int],
+                     report: Callable[[int], None]) -> Sequence:
+        # Position of every node within its layer. Sweeps go through the layers one at
+        # a time, sorting the nodes by the mean relative position of their neighbours
+        # in the layer just sorted, above on downward sweeps and below on upward ones.
+        # Nodes without such neighbours keep their relative position
+        node_count = len(node_layers)
+        layer_count = max(node_layers) + 1
+        numpy = load_numpy()
+        if numpy is not None:
+            layers = numpy.asarray(node_layers, dtype=numpy.int64)
+            sources = numpy.asarray(sources, dtype=numpy.int64)
+            targets = numpy.asarray(targets, dtype=numpy.int64)
+            sizes = numpy.bincount(layers, minlength=layer_count)
+            members = numpy.argsort(layers, kind="stable")
+            bounds = numpy.concatenate(([0], numpy.cumsum(sizes)))
+            positions = numpy.empty(node_count)
+            positions[members] = numpy.arange(node_count) - bounds[layers[members]]
+            # Edges grouped by the layer of their free end, for each direction
+            directions = []
+            for fixed, free in ((sources, targets), (targets, sources)):
+                edge_order = numpy.argsort(layers[free], kind="stable")
+                edge_bounds = numpy.searchsorted(layers[free][edge_order], numpy.arange(layer_count + 1))
+                directions.append((fixed[edge_order], positions[free[edge_order]].astype(numpy.int64), edge_bounds))
+
+            for sweep in range(self.sweeps):
+                fixed, free_local, edge_bounds = directions[sweep % 2]
+                step = 1 if sweep % 2 == 0 else -1
+                for layer in range(layer_count)[::step]:
+                    size = int(sizes[layer])
+                    first, last = edge_bounds[layer], edge_bounds[layer + 1]
+                    if size < 2 or first == last:
+                        continue
+                    nodes = members[bounds[layer]:bounds[layer + 1]]
+                    fixed_layer = layer - step
+                    relative = (positions[fixed[first:last]] + 0.5) / sizes[fixed_layer]
+                    counts = numpy.bincount(free_local[first:last], minlength=size)
+                    sums = numpy.bincount(free_local[first:last], weights=relative, minlength=size)
+                    current = positions[nodes]
+                    keys = numpy.where(counts > 0, sums / numpy.maximum(counts, 1), (current + 0.5) / size)
+                    positions[nodes[numpy.lexsort((current, keys))]] = numpy.arange(size)
+                report(sweep + 1)
+            return positions
+
+        layer_nodes: List[List[int]] = [[] for _ in range(layer_count)]
+        positions = [0] * node_count
+        for node, layer in enumerate(node_layers):
+            positions[node] = len(layer_nodes[layer])
+            layer_nodes[layer].append(node)
+        neighbours: Tuple[List[List[int]], List[List[int]]] = ([[] for _ in range(node_count)], [[] for _ in range(node_count)])
+        for source, target in zip(sources, targets):
+            neighbours[0][target].append(source)
+            neighbours[1][source].append(target)
+
+        for sweep in range(self.sweeps):
+            fixed = neighbours[sweep % 2]
+            step = 1 if sweep % 2 == 0 else -1
+            for layer in range(layer_count)[::step]:
+                nodes = layer_nodes[layer]
+                if len(nodes) < 2 or not 0 <= layer - step < layer_count:
+                    continue
+                fixed_size = len(layer_nodes[layer - step])
+                keys = {node: sum(positions[other] + 0.5 for other in fixed[node]) / fixed_size / len(fixed[node]) if fixed[node]
+                        else (positions[node] + 0.5) / len(nodes) for node in nodes}
+                nodes.sort(key=lambda node: (keys[node], positions[node]))
+                for position, node in enumerate(nodes):
+                    positions[node] = position
+            report(sweep + 1)
+        return positions
+
+    def assign_x(self, node_layers: List[int], sources: List[int], targets: List[int], positions: Sequence,
+                 half_widths: List[float], gaps: List[float], report: Callable[[int], None]) -> Sequence:
+        # Horizontal center of every node, keeping the order and gaps within the layers.
+        # Passes go through the layers like the ordering sweeps, moving the nodes to the
+        # mean of their neighbours in the layer just placed. Overlaps are pushed apart
+        # once from the left and once from the right, and the two results averaged
+        node_count = len(node_layers)
+        layer_count = max(node_layers) + 1
+        numpy = load_numpy()
+        if numpy is not None:
+            layers = numpy.asarray(node_layers, dtype=numpy.int64)
+            positions = numpy.asarray(positions, dtype=numpy.int64)
+            members = numpy.lexsort((positions, layers))
+            bounds = numpy.concatenate(([0], numpy.cumsum(numpy.bincount(layers, minlength=layer_count))))
+            # Offsets are the closest the nodes can be to the first one of their layer
+            half = numpy.asarray(half_widths)[members]
+            gap = numpy.asarray(gaps, dtype=numpy.float64)[members]
+            separations = numpy.zeros(node_count)
+            separations[1:] = half[:-1] + half[1:] + (gap[:-1] + gap[1:]) / 2
+            separations[bounds[:-1][bounds[:-1] < node_count]] = 0
+            cumulative = numpy.cumsum(separations)
+            starts = bounds[layers[members]]
+            offsets = cumulative - cumulative[starts]
+            centers = numpy.empty(node_count)
+            centers[members] = offsets - offsets[bounds[layers[members] + 1] - 1] / 2
+
+            directions = []
+            for fixed, free in ((sources, targets), (targets, sources)):
+                fixed = numpy.asarray(fixed, dtype=numpy.int64)
+                free = numpy.asarray(free, dtype=numpy.int64)
+                edge_order = numpy.argsort(layers[free], kind="stable")
+                edge_bounds = numpy.searchsorted(layers[free][edge_order], numpy.arange(layer_count + 1))
+                directions.append((fixed[edge_order], positions[free[edge_order]], edge_bounds))
+
+            for number in range(self.balance_passes):
+                fixed, free_local, edge_bounds = directions[number % 2]
+                step = 1 if number % 2 == 0 else -1
+                for layer in range(layer_count)[::step]:
+                    first, last = edge_bounds[layer], edge_bounds[layer + 1]
+                    if first == last:
+                        continue
+                    start, end = bounds[layer], bounds[layer + 1]
+                    nodes = members[start:end]
+                    counts = numpy.bincount(free_local[first:last], minlength=end - start)
+                    sums = numpy.bincount(free_local[first:last], weights=centers[fixed[first:last]], minlength=end - start)
+                    wanted = numpy.where(counts > 0, sums / numpy.maximum(counts, 1), centers[nodes]) - offsets[start:end]
+                    forward = numpy.maximum.accumulate(wanted)
+                    backward = numpy.minimum.accumulate(wanted[::-1])[::-1]
+                    centers[nodes] = offsets[start:end] + (forward + backward) / 2
+                report(number + 1)
+            return centers
+
+        layer_nodes: List[List[int]] = [[] for _ in range(layer_count)]
+        for node in sorted(range(node_count), key=lambda node: (node_layers[node], positions[node])):
+            layer_nodes[node_layers[node]].append(node)
+        offsets = [0.0] * node_count
+        centers = [0.0] * node_count
+        for nodes in layer_nodes:
+            for previous, node in zip(nodes, nodes[1:]):
+                offsets[node] = (offsets[previous] + half_widths[previous] + half_widths[node]
+                                 + (gaps[previous] + gaps[node]) / 2)
+            for node in nodes:
+                centers[node] = offsets[node] - offsets[nodes[-1]] / 2
+
+        neighbours: Tuple[List[List[int]], List[List[int]]] = ([[] for _ in range(node_count)], [[] for _ in range(node_count)])
+        for source, target in zip(sources, targets):
+            neighbours[0][target].append(source)
+            neighbours[1][source].append(target)
+        for number in range(self.balance_passes):
+            fixed = neighbours[number % 2]
+            step = 1 if number % 2 == 0 else -1
+            for layer in range(layer_count)[::step]:
+                nodes = layer_nodes[layer]
+                wanted = [(sum(centers[other] for other in fixed[node]) / len(fixed[node]) if fixed[node] else centers[node])
+                          - offsets[node] for node in nodes]
+                forward = accumulate(wanted, max)
+                backward = list(accumulate(reversed(wanted), min))[::-1]
+                for node, low, high in zip(nodes, forward, backward):
+                    centers[node] = offsets[node] + (low + high) / 2
+            report(number + 1)
+        return centers
+
+
+ERROR = "error"
+WARNING = "warning"
+
+
+@dataclass
+class Diagnostic:
+    severity: str  # ERROR or WARNING
+    code: str  # Stable identifier of the check, e.g. "arrow-shape-index" or "cycle"
+    message: str
+    shapes: List[int] = field(default_factory=list)  # Indices of the shapes concerned
+    arrows: List[int] = field(default_factory=list)  # Indices of the arrows concerned
+
+
+class ShapeGraph:
+    # Arrows between shapes as compressed sparse rows: the successors of shape i are
+    # targets[offsets[i]:offsets[i + 1]], and its predecessors the same in the reverse rows
+    def __init__(self, shape_count: int, starts: array, ends: array):
+        self.shape_count = shape_count
+        self.offsets, self.targets = self.build_rows(shape_count, starts, ends)
+        self.reverse_offsets, self.sources = self.build_rows(shape_count, ends, starts)
+
+    @staticmethod
+    def build_rows(count: int, rows: array, columns: array) -> Tuple[array, array]:
+        # Groups the columns by row, keeping the arrow order within a row
+        numpy = load_numpy() if len(rows) >= numpy_min_records else None
+        if numpy is not None:
+            row_values = numpy.frombuffer(rows, dtype=numpy.int32)
+            offsets = numpy.zeros(count + 1, dtype=numpy.int32)
+            numpy.cumsum(numpy.bincount(row_values, minlength=count), out=offsets[1:])
+            order = numpy.argsort(row_values, kind="stable")
+            return array("i", offsets.tobytes()), array("i", numpy.frombuffer(columns, dtype=numpy.int32)[order].tobytes())
+        # Counting sort
+        offsets = array("i", bytes(4 * (count + 1)))
+        for row in rows:
+            offsets[row + 1] += 1
+        for row in range(count):
+            offsets[row + 1] += offsets[row]
+        positions = offsets[:-1]
+        values = array("i", bytes(4 * len(rows)))
+        for row, column in zip(rows, columns):
+            values[positions[row]] = column
+            positions[row] += 1
+        return offsets, values
+
+    def out_degree(self, shape: int) -> int:
+        return self.offsets[shape + 1] - self.offsets[shape]
+
+    def in_degree(self, shape: int) -> int:
+        return self.reverse_offsets[shape + 1] - self.reverse_offsets[shape]
+
+    def successors(self, shape: int) -> array:
+        return self.targets[self.offsets[shape]:self.offsets[shape + 1]]
+
+    def reachable(self, roots: List[int]) -> bytearray:
+        # Flags of the shapes reachable from the roots, including the roots
+        offsets, targets = self.offsets, self.targets
+        reached = bytearray(self.shape_count)
+        stack = []
+        for root in roots:
+            if not reached[root]:
+                reached[root] = 1
+                stack.append(root)
+        while stack:
+            shape = stack.pop()
+            for target in targets[offsets[shape]:offsets[shape + 1]]:
+                if not reached[target]:
+                    reached[target] = 1
+                    stack.append(target)
+        return reached
+
+    def find_cycles(self) -> List[List[int]]:
+        # Strongly connected components containing a cycle, found with an iterative
+        # Tarjan search so long chains don't hit the recursion limit
+        offsets, targets = self.offsets, self.targets
+        order = array("i", [-1]) * self.shape_count  # Visit number, -1 when not visited yet
+        low = array("i", bytes(4 * self.shape_count))
+        on_stack = bytearray(self.shape_count)
+        stack: List[int] = []
+        cycles = []
+        counter = 0
+        for root in range(self.shape_count):
+            if order[root] != -1:
+                continue
+            order[root] = low[root] = counter
+            counter += 1
+            stack.append(root)
+            on_stack[root] = 1
+            work = [(root, offsets[root])]  # Shape and its next arrow to follow
+            while work:
+                shape, edge = work[-1]
+                if edge < offsets[shape + 1]:
+                    work[-1] = (shape, edge + 1)
+                    target = targets[edge]
+                    if order[target] == -1:
+                        order[target] = low[target] = counter
+                        counter += 1
+                        stack.append(target)
+                        on_stack[target] = 1
+                        work.append((target, offsets[target]))
+                    elif on_stack[target]:
+                        low[shape] = min(low[shape], order[target])
+                    continue
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[shape])
+                if low[shape] != order[shape]:
+                    continue
+                component = []
+                while True:
+                    member = stack.pop()
+                    on_stack[member] = 0
+                    component.append(member)
+                    if member == shape:
+                        break
+                if len(component) > 1 or shape in self.successors(shape):
+                    cycles.append(sorted(component))
+        return cycles
+
+
+class Validator:
+    # Lints a diagram in time linear in its shapes and arrows. Arrows with invalid
+    # indices are reported and left out of the graph the other checks run on
+    degree_rules: Dict[str, Tuple[int, int]] = {  # Minimum arrows (to, from) a shape of the type
+        "Process": (1, 1),
+        "IO": (1, 1),
+        "Decision": (1, 2),
+    }
+    max_listed = 10  # Shapes named in a message, the diagnostic still lists all of them
+
+    def validate(self, diagram_data: DiagramData) -> List[Diagnostic]:
+        self.shapes = list(diagram_data.shapes)
+        diagnostics = []
+        first_indices: Dict[str, int] = {}
+        for index, shape in enumerate(self.shapes):
+            if not self.check_shape_fields(index, diagnostics):
+                continue
+            if shape.shape_type not in NODE_POSITIONS:
+                diagnostics.append(Diagnostic(ERROR, "unknown-shape-type",
+                                              f"Shape {index} has unknown type '{shape.shape_type}'", [index]))
+            first = first_indices.setdefault(shape.shape_id, index)
+            if first != index and shape.shape_id is not None:
+                diagnostics.append(Diagnostic(ERROR, "duplicate-shape-id",
+                                              f"{self.describe(index)} has the same id '{shape.shape_id}' as {self.describe(first)}",
+                                              [first, index]))
+            if shape.child is not None:
+                self.check_child(index, diagram_data, diagnostics)
+        starts, ends = self.check_arrows(diagram_data, diagnostics)
+        graph = ShapeGraph(len(self.shapes), starts, ends)
+        self.check_degrees(graph, diagnostics)
+        self.check_reachability(graph, diagnostics)
+        self.check_cycles(graph, diagnostics)
+        return diagnostics
+
+    def describe(self, index: int) -> str:
+        shape = self.shapes[index]
+        return f"{shape.shape_type} {index}" + (f" '{shape.text}'" if shape.text else "")
+
+    def describe_all(self, indices: List[int]) -> str:
+        names = ", ".join(self.describe(index) for index in indices[:self.max_listed])
+        return names + (f" and {len(indices) - self.max_listed} more" if len(indices) > self.max_listed else "")
+
+    def check_shape_fields(self, index: int, diagnostics: List[Diagnostic]) -> bool:
+        # Fields of the wrong type are reported, and the shape is checked further without them
+        shape = self.shapes[index]
+        wrong = [name for name in ("x", "y", "width", "height") if not is_integer(getattr(shape, name))]
+        wrong += [name for name in ("shape_type", "text") if not isinstance(getattr(shape, name), str)]
+        wrong += [name for name in ("shape_id", "child") if not isinstance(getattr(shape, name), (str, type(None)))]
+        if not wrong:
+            return True
+        fields = ", ".join(f"{name} {getattr(shape, name)!r}" for name in wrong)
+        diagnostics.append(Diagnostic(ERROR, "shape-field-type", f"Shape {index} has {fields} of the wrong type", [index]))
+        self.shapes[index] = replace(shape, shape_type=shape.shape_type if isinstance(shape.shape_type, str) else repr(shape.shape_type),
+                                     text=shape.text if isinstance(shape.text, str) else repr(shape.text), shape_id=None, child=None)
+        return False
+
+    def check_child(self, index: int, diagram_data: DiagramData, diagnostics: List[Diagnostic]) -> None:
+        # Only sections of the same file can be checked without knowing where the diagram is saved
+        shape = self.shapes[index]
+        if shape.shape_type != "Process":
+            diagnostics.append(Diagnostic(WARNING, "child-shape-type",
+                                          f"{self.describe(index)} has a sub-diagram, only Process shapes open theirs", [index]))
+        file_path, section = Serializer.split_document(shape.child)
+        if not file_path and section is not None and section not in diagram_data.sections:
+            diagnostics.append(Diagnostic(ERROR, "child-section",
+                                          f"{self.describe(index)} refers to section '{section}', which isn't in the file", [index]))
+
+    def check_arrows(self, diagram_data: DiagramData, diagnostics: List[Diagnostic]) -> Tuple[array, array]:
+        # Shape and node indices in range, returns the (start, end) shapes of the valid arrows
+        shape_count = len(self.shapes)
+        starts, ends = array("i"), array("i")
+        for index, arrow in enumerate(diagram_data.arrows):
+            valid = True
+            for end_name, shape_index, node_index in (("start", arrow.start_shape_index, arrow.start_node_index),
+                                                      ("end", arrow.end_shape_index, arrow.end_node_index)):
+                if not is_integer(shape_index) or not is_integer(node_index):
+                    diagnostics.append(Diagnostic(ERROR, "arrow-field-type",
+                                                  f"Arrow {index} {end_name}s at node {node_index!r} of shape {shape_index!r}, "
+                                                  f"which are not both integers", arrows=[index]))
+                    valid = False
+                    continue
+                if not 0 <= shape_index < shape_count:
+                    diagnostics.append(Diagnostic(ERROR, "arrow-shape-index",
+                                                  f"Arrow {index} {end_name}s at shape {shape_index}, "
+                                                  f"the diagram has {shape_count} shapes", arrows=[index]))
+                    valid = False
+                    continue
+                node_positions = NODE_POSITIONS.get(self.shapes[shape_index].shape_type)
+                if node_positions and not 0 <= node_index < len(node_positions):
+                    diagnostics.append(Diagnostic(ERROR, "arrow-node-index",
+                                                  f"Arrow {index} {end_name}s at node {node_index} of {self.describe(shape_index)}, "
+                                                  f"which has {len(node_positions)} nodes", [shape_index], [index]))
+                    valid = False
+            if valid:
+                starts.append(arrow.start_shape_index)
+                ends.append(arrow.end_shape_index)
+        return starts, ends
+
+    def check_degrees(self, graph: ShapeGraph, diagnostics: List[Diagnostic]) -> None:
+        for index, shape in enumerate(self.shapes):
+            incoming, outgoing = graph.in_degree(index), graph.out_degree(index)
+            if not incoming and not outgoing:
+                diagnostics.append(Diagnostic(ERROR, "isolated", f"{self.describe(index)} has no arrows", [index]))
+            elif shape.shape_type == "Terminator":
+                # Either the start or an end of the flow
+                if incoming and outgoing:
+                    diagnostics.append(Diagnostic(ERROR, "terminator-degree",
+                                                  f"{self.describe(index)} has arrows both to and from it", [index]))
+            elif shape.shape_type in self.degree_rules:
+                min_incoming, min_outgoing = self.degree_rules[shape.shape_type]
+                if incoming < min_incoming:
+                    diagnostics.append(Diagnostic(ERROR, "missing-incoming",
+                                                  f"{self.describe(index)} has {incoming} arrows to it, "
+                                                  f"at least {min_incoming} expected", [index]))
+                if outgoing < min_outgoing:
+                    diagnostics.append(Diagnostic(ERROR, "missing-outgoing",
+                                                  f"{self.describe(index)} has {outgoing} arrows from it, "
+                                                  f"at least {min_outgoing} expected", [index]))
+
+    def check_reachability(self, graph: ShapeGraph, diagnostics: List[Diagnostic]) -> None:
+        # Everything must be reachable from a start, a Terminator without arrows to it
+        if not self.shapes:
+            return
+        roots = [index for index, shape in enumerate(self.shapes)
+                 if shape.shape_type == "Terminator" and not graph.in_degree(index) and graph.out_degree(index)]
+        if not roots:
+            diagnostics.append(Diagnostic(ERROR, "no-start", "No Terminator starts the flow"))
+            return
+        reached = graph.reachable(roots)
+        for index, shape in enumerate(self.shapes):
+            if reached[index] or not (graph.in_degree(index) or graph.out_degree(index)):
+                continue  # Isolated shapes are already reported
+            if shape.shape_type == "Terminator":
+                diagnostics.append(Diagnostic(ERROR, "unreachable-terminator",
+                                              f"{self.describe(index)} can't be reached from a start", [index]))
+            else:
+                diagnostics.append(Diagnostic(WARNING, "unreachable",
+                                              f"{self.describe(index)} can't be reached from a start", [index]))
+
+    def check_cycles(self, graph: ShapeGraph, diagnostics: List[Diagnostic]) -> None:
+        # A loop is intended when a Decision can leave it, otherwise the flow never ends
+        for cycle in graph.find_cycles():
+            members = set(cycle)
+            if not any(self.shapes[index].shape_type == "Decision" for index in cycle):
+                diagnostics.append(Diagnostic(ERROR, "cycle",
+                                              f"Loop without a Decision through {self.describe_all(cycle)}", cycle))
+            elif all(target in members for index in cycle for target in graph.successors(index)):
+                diagnostics.append(Diagnostic(ERROR, "cycle",
+                                              f"Loop without a way out through {self.describe_all(cycle)}", cycle))
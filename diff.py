@@ -0,0 +1,225 @@
+import sys
+import argparse
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from core import ArrowData, DiagramData, Serializer, ShapeData
+
+SHAPE_FIELDS = ("shape_type", "x", "y", "width", "height", "text", "child")
+ArrowKey = Tuple[str, int, str, int]  # Start shape id and node, end shape id and node
+
+
+@dataclass
+class ShapeChange:
+    shape_id: str
+    fields: Dict[str, Tuple[object, object]]  # Changed field: (old value, new value)
+
+
+@dataclass
+class DiagramDiff:
+    added_shapes: List[ShapeData] = field(default_factory=list)
+    removed_shapes: List[ShapeData] = field(default_factory=list)
+    changed_shapes: List[ShapeChange] = field(default_factory=list)
+    added_arrows: List[ArrowKey] = field(default_factory=list)
+    removed_arrows: List[ArrowKey] = field(default_factory=list)
+
+    def is_empty(self) -> bool:
+        return not (self.added_shapes or self.removed_shapes or self.changed_shapes or self.added_arrows or self.removed_arrows)
+
+
+@dataclass
+class Conflict:
+    shape_id: str
+    field: str  # Shape field, "shape" when one side removed a shape the other changed, "arrow", or "section"
+    base: object
+    ours: object
+    theirs: object
+    section: Optional[str] = None  # Section of the file the conflict is in, None for the root diagram
+
+
+def content(shape: ShapeData) -> tuple:
+    # Everything but the id, compared as one hashable tuple
+    return shape.shape_type, shape.x, shape.y, shape.width, shape.height, shape.text, shape.child
+
+
+def index_shapes(diagram_data: DiagramData) -> Dict[str, ShapeData]:
+    # Shapes by id in save order, the first shape wins if an id is duplicated
+    shapes = {}
+    for shape in diagram_data.shapes:
+        shapes.setdefault(shape.shape_id, shape)
+    return shapes
+
+
+def arrow_keys(diagram_data: DiagramData) -> Counter:
+    # Arrows by the ids of their shapes, counted since nothing prevents duplicates.
+    # Arrows with invalid indices are left out
+    shape_ids = [shape.shape_id for shape in diagram_data.shapes]
+    keys = Counter()
+    for arrow in diagram_data.arrows:
+        if 0 <= arrow.start_shape_index < len(shape_ids) and 0 <= arrow.end_shape_index < len(shape_ids):
+            keys[(shape_ids[arrow.start_shape_index], arrow.start_node_index,
+                  shape_ids[arrow.end_shape_index], arrow.end_node_index)] += 1
+    return keys
+
+
+def diff_diagrams(old: DiagramData, new: DiagramData) -> DiagramDiff:
+    # Shapes are matched by id, their order doesn't matter. Linear in the size of both diagrams
+    old_shapes, new_shapes = index_shapes(old), index_shapes(new)
+    result = DiagramDiff()
+    for shape_id, shape in new_shapes.items():
+        old_shape = old_shapes.get(shape_id)
+        if old_shape is None:
+            result.added_shapes.append(shape)
+        elif content(old_shape) != content(shape):
+            result.changed_shapes.append(ShapeChange(shape_id, {
+                name: (old_value, new_value) for name, old_value, new_value in zip(SHAPE_FIELDS, content(old_shape), content(shape))
+                if old_value != new_value}))
+    result.removed_shapes = [shape for shape_id, shape in old_shapes.items() if shape_id not in new_shapes]
+
+    old_arrows, new_arrows = arrow_keys(old), arrow_keys(new)
+    result.added_arrows = list((new_arrows - old_arrows).elements())
+    result.removed_arrows = list((old_arrows - new_arrows).elements())
+    return result
+
+
+def merge_value(base: object, ours: object, theirs: object) -> Tuple[object, bool]:
+    # Three way merge of one value, returns it and whether both sides changed it differently
+    if ours == theirs or theirs == base:
+        return ours, False
+    if ours == base:
+        return theirs, False
+    return ours, True
+
+
+def merge_diagrams(base: DiagramData, ours: DiagramData, theirs: DiagramData) -> Tuple[DiagramData, List[Conflict]]:
+    # Changes of both sides are combined field by field and arrow by arrow. Conflicting
+    # changes keep our side and are returned, so the caller decides whether to accept them
+    base_shapes, our_shapes, their_shapes = index_shapes(base), index_shapes(ours), index_shapes(theirs)
+    conflicts = []
+    merged: Dict[str, ShapeData] = {}
+    # Our order first, then the shapes only they have, so our stacking order is kept
+    for shape_id in list(our_shapes) + [shape_id for shape_id in their_shapes if shape_id not in our_shapes]:
+        base_shape, our_shape, their_shape = base_shapes.get(shape_id), our_shapes.get(shape_id), their_shapes.get(shape_id)
+        if our_shape is None or their_shape is None:
+            kept = our_shape or their_shape
+            if base_shape is None:
+                merged[shape_id] = kept  # Added by one side
+            elif content(kept) != content(base_shape):
+                # Removed by one side and changed by the other
+                conflicts.append(Conflict(shape_id, "shape", content(base_shape),
+                                          our_shape and content(our_shape), their_shape and content(their_shape)))
+                if our_shape is not None:
+                    merged[shape_id] = our_shape
+            continue
+        if content(our_shape) == content(their_shape):
+            merged[shape_id] = our_shape
+            continue
+        values = []
+        for number, name in enumerate(SHAPE_FIELDS):
+            base_value = content(base_shape)[number] if base_shape else None
+            our_value, their_value = content(our_shape)[number], content(their_shape)[number]
+            value, conflicted = merge_value(base_value, our_value, their_value)
+            if conflicted:
+                conflicts.append(Conflict(shape_id, name, base_value, our_value, their_value))
+            values.append(value)
+        merged[shape_id] = ShapeData(**dict(zip(SHAPE_FIELDS, values)), shape_id=shape_id)
+
+    shape_indices = {shape_id: index for index, shape_id in enumerate(merged)}
+    base_arrows, our_arrows, their_arrows = arrow_keys(base), arrow_keys(ours), arrow_keys(theirs)
+    arrows = []
+    for key in our_arrows | their_arrows:
+        count, conflicted = merge_value(base_arrows[key], our_arrows[key], their_arrows[key])
+        start_id, start_node, end_id, end_node = key
+        if conflicted:
+            conflicts.append(Conflict(start_id, "arrow", base_arrows[key], our_arrows[key], their_arrows[key]))
+        if not count:
+            continue
+        if start_id not in shape_indices or end_id not in shape_indices:
+            # Added to a shape the other side removed
+            missing = start_id if start_id not in shape_indices else end_id
+            conflicts.append(Conflict(missing, "arrow", base_arrows[key], our_arrows[key], their_arrows[key]))
+            continue
+        arrows.extend([ArrowData(shape_indices[start_id], start_node, shape_indices[end_id], end_node)] * count)
+    sections, section_conflicts = merge_sections(base, ours, theirs)
+    return DiagramData(shapes=list(merged.values()), arrows=arrows, sections=sections), conflicts + section_conflicts
+
+
+def merge_sections(base: DiagramData, ours: DiagramData, theirs: DiagramData) -> Tuple[Dict[str, DiagramData], List[Conflict]]:
+    # Sections are merged one by one like the root diagram. A section removed by one side and
+    # changed by the other is a conflict, and our side is kept
+    sections: Dict[str, DiagramData] = {}
+    conflicts = []
+    for name in list(ours.sections) + [name for name in theirs.sections if name not in ours.sections]:
+        base_section, our_section, their_section = (side.sections[name] if name in side.sections else None for side in (base, ours, theirs))
+        if our_section is None or their_section is None:
+            kept = their_section if our_section is None else our_section
+            if base_section is None:
+                sections[name] = kept  # Added by one side
+            elif not diff_diagrams(base_section, kept).is_empty():
+                conflicts.append(Conflict("", "section", "present", "changed" if our_section else "removed",
+                                          "changed" if their_section else "removed", name))
+                if our_section is not None:
+                    sections[name] = our_section
+            continue
+        merged, merge_conflicts = merge_diagrams(base_section or DiagramData(shapes=[], arrows=[]), our_section, their_section)
+        for conflict in merge_conflicts:
+            conflict.section = name
+        sections[name] = merged
+        conflicts.extend(merge_conflicts)
+    return sections, conflicts
+
+
+def describe_shape(shape: ShapeData) -> str:
+    return f"{shape.shape_type} {shape.shape_id}" + (f" '{shape.text}'" if shape.text else "")
+
+
+def format_diff(result: DiagramDiff) -> List[str]:
+    lines = [f"+ shape {describe_shape(shape)} at {shape.x}, {shape.y}" for shape in result.added_shapes]
+    lines.extend(f"- shape {describe_shape(shape)}" for shape in result.removed_shapes)
+    for change in result.changed_shapes:
+        fields = ", ".join(f"{name} {old!r} -> {new!r}" for name, (old, new) in change.fields.items())
+        lines.append(f"~ shape {change.shape_id}: {fields}")
+    lines.extend(f"+ arrow {start_id}:{start_node} -> {end_id}:{end_node}" for start_id, start_node, end_id, end_node in result.added_arrows)
+    lines.extend(f"- arrow {start_id}:{start_node} -> {end_id}:{end_node}" for start_id, start_node, end_id, end_node in result.removed_arrows)
+    return lines
+
+
+def load(path: str) -> DiagramData:
+    diagram_data = Serializer.load_from_file(path)
+    if diagram_data is None:
+        raise SystemExit(2)
+    return diagram_data
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Compare flowcharts shape by shape, or merge two revisions of one.")
+    parser.add_argument("files", nargs="+", metavar="FILE", help="OLD NEW to compare, or BASE OURS THEIRS with --merge")
+    parser.add_argument("--merge", action="store_true", help="three way merge of BASE, OURS and THEIRS")
+    parser.add_argument("-o", "--output", help="file the merge is written to, defaults to OURS")
+    args = parser.parse_args(argv)
+
+    if not args.merge:
+        if len(args.files) != 2:
+            parser.error("comparing takes OLD and NEW")
+        lines = format_diff(diff_diagrams(load(args.files[0]), load(args.files[1])))
+        print("\n".join(lines))
+        return 1 if lines else 0
+
+    if len(args.files) != 3:
+        parser.error("--merge takes BASE, OURS and THEIRS")
+    merged, conflicts = merge_diagrams(*(load(path) for path in args.files))
+    for conflict in conflicts:
+        if conflict.field == "section":
+            print(f"Conflict in section {conflict.section}: ours {conflict.ours}, theirs {conflict.theirs}, kept ours", file=sys.stderr)
+            continue
+        section = f" in section {conflict.section}" if conflict.section else ""
+        print(f"Conflict in {conflict.field} of shape {conflict.shape_id}{section}: base {conflict.base!r}, "
+              f"ours {conflict.ours!r}, theirs {conflict.theirs!r}, kept ours", file=sys.stderr)
+    if not Serializer.save_to_file(merged, args.output or args.files[1]):
+        return 2
+    return 1 if conflicts else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,71 @@
+import sys
+import json
+import argparse
+from typing import List, Optional
+
+# Headless commands, run as python -m flowchart. Only the Qt-free core is imported,
+# so a command starts in a fraction of the time the editor takes to import Qt
+import validate
+from core import ColumnarDiagramData, Serializer
+
+
+def convert(args: argparse.Namespace) -> int:
+    return 0 if Serializer.convert(args.source, args.target, None if args.compact else 4) else 2
+
+
+def get_stats(path: str) -> Optional[dict]:
+    diagram_data = Serializer.load_from_file(path)
+    if diagram_data is None:
+        return None
+    columns = ColumnarDiagramData.from_diagram_data(diagram_data)
+    return {"shapes": columns.shape_count, "arrows": columns.arrow_count, "texts": len(columns.texts),
+            "children": columns.shape_count - columns.children.count(None), "sections": len(diagram_data.sections),
+            "types": columns.type_counts(), "bounds": columns.bounding_box()}
+
+
+def stats(args: argparse.Namespace) -> int:
+    results = {}
+    for path in validate.collect_files(args.inputs):
+        results[path] = get_stats(path)
+    if args.format == "json":
+        json.dump(results, sys.stdout, indent=4)
+        print()
+    else:
+        for path, result in results.items():
+            if result is None:
+                print(f"{path}: could not load diagram")
+                continue
+            types = ", ".join(f"{count} {shape_type}" for shape_type, count in sorted(result["types"].items()))
+            bounds = "empty" if result["bounds"] is None else "{}, {} to {}, {}".format(*result["bounds"])
+            print(f"{path}: {result['shapes']} shapes ({types or 'none'}), {result['arrows']} arrows, "
+                  f"{result['texts']} distinct texts, {result['children']} sub-diagrams, {result['sections']} sections, bounds {bounds}")
+    return 2 if None in results.values() else 0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m flowchart", description="Work with saved flowcharts without the editor.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    # The options of validate.py, which does the checking
+    commands.add_parser("validate", add_help=False, help="check flowcharts, see python validate.py --help")
+
+    convert_parser = commands.add_parser("convert", help="convert between JSON and binary .fcb files without loss")
+    convert_parser.add_argument("source", help="flowchart to read")
+    convert_parser.add_argument("target", help="file to write, the format is picked from the extension")
+    convert_parser.add_argument("--compact", action="store_true", help="write JSON without indentation")
+    convert_parser.set_defaults(run=convert)
+
+    stats_parser = commands.add_parser("stats", help="count the shapes, arrows, texts and sub-diagrams of flowcharts")
+    stats_parser.add_argument("inputs", nargs="+", help="flowchart files or directories to search for .json/.fcb files")
+    stats_parser.add_argument("-f", "--format", choices=("text", "json"), default="text", help="output format")
+    stats_parser.set_defaults(run=stats)
+
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ["validate"]:
+        return validate.main(argv[1:])
+    args = parser.parse_args(argv)
+    return args.run(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
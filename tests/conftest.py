@@ -0,0 +1,13 @@
+import os
+import sys
+
+# The modules live at the top of the repository, next to this directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core import ArrowData, DiagramData, ShapeData  # noqa: E402
+
+
+def make_diagram(*texts: str) -> DiagramData:
+    # A chain of processes with the given texts, from left to right
+    shapes = [ShapeData("Process", index * 200, 0, 146, 96, text, f"id{index}") for index, text in enumerate(texts)]
+    return DiagramData(shapes=shapes, arrows=[ArrowData(index, 1, index + 1, 3) for index in range(len(shapes) - 1)])
@@ -0,0 +1,90 @@
+import pytest
+
+from conftest import make_diagram
+from core import BinaryDiagram, BinaryFormat, DiagramData, Serializer, ShapeData
+
+
+@pytest.mark.parametrize("source, target", [(".json", ".fcb"), (".fcb", ".json"), (".fcb", ".fcb")])
+def test_convert_round_trip(tmp_path, source, target):
+    diagram_data = make_diagram("a", "b", "")
+    diagram_data.shapes.append(ShapeData("Decision", -5, 7, 146, 146, "a", None))
+    source_path, target_path = str(tmp_path / f"source{source}"), str(tmp_path / f"target{target}")
+    assert Serializer.save_to_file(diagram_data, source_path)
+    assert Serializer.convert(source_path, target_path)
+    loaded = Serializer.load_from_file(target_path)
+    # A shape without an id is saved with its index as id
+    diagram_data.shapes[-1].shape_id = "3"
+    assert (list(loaded.shapes), list(loaded.arrows)) == (diagram_data.shapes, diagram_data.arrows)
+
+
+def test_binary_records_are_decoded_on_access(tmp_path):
+    path = str(tmp_path / "diagram.fcb")
+    assert Serializer.save_to_file(make_diagram(*"abcdef"), path)
+    loaded = BinaryFormat.open(path)
+    assert len(loaded.shapes) == 6
+    assert [shape.text for shape in loaded.shapes[1:3]] == ["b", "c"]
+    assert loaded.shapes[-1].text == "f"
+    with pytest.raises(IndexError):
+        loaded.shapes[6]
+
+
+def test_empty_binary_diagram(tmp_path):
+    path = str(tmp_path / "empty.fcb")
+    assert Serializer.save_to_file(DiagramData(shapes=[], arrows=[]), path)
+    loaded = Serializer.load_from_file(path)
+    assert (list(loaded.shapes), list(loaded.arrows)) == ([], [])
+
+
+def test_corrupt_binary_file_fails_to_load(tmp_path):
+    path = tmp_path / "corrupt.fcb"
+    path.write_bytes(b"FCB1")
+    assert Serializer.load_from_file(str(path)) is None
+
+
+def test_convert_refuses_the_source_as_target(tmp_path):
+    path = str(tmp_path / "diagram.json")
+    assert Serializer.save_to_file(make_diagram("a", "b"), path)
+    with open(path) as file:
+        content = file.read()
+    assert not Serializer.convert(path, path)
+    with open(path) as file:
+        assert file.read() == content
+
+
+def test_failed_convert_keeps_the_target(tmp_path):
+    source_path, target_path = str(tmp_path / "broken.json"), str(tmp_path / "target.json")
+    with open(source_path, "w") as file:
+        file.write('{"shapes": [{"shape_type": "Process", "x": 0')
+    assert Serializer.save_to_file(make_diagram("kept"), target_path)
+    assert not Serializer.convert(source_path, target_path)
+    assert [shape.text for shape in Serializer.load_from_file(target_path).shapes] == ["kept"]
+    assert not (tmp_path / "target.json.tmp").exists()
+
+
+def test_saving_closes_the_maps_of_the_replaced_file(tmp_path):
+    path = str(tmp_path / "diagram.fcb")
+    assert Serializer.save_to_file(make_diagram("old"), path)
+    old = Serializer.load_from_file(path)
+    assert Serializer.save_to_file(make_diagram("new", "more"), path)
+    # What was read from the replaced file is gone, the file itself is read again
+    with pytest.raises(ValueError):
+        old.shapes[0]
+    assert [shape.text for shape in Serializer.load_from_file(path).shapes] == ["new", "more"]
+
+
+def test_saving_a_section_replaces_the_file_it_read(tmp_path):
+    path = str(tmp_path / "diagram.fcb")
+    assert Serializer.save_to_file(make_diagram("root"), path)
+    assert Serializer.save_document(make_diagram("a"), path + "#a")
+    assert Serializer.save_document(make_diagram("b"), path + "#b")
+    loaded = Serializer.load_from_file(path)
+    assert {name: [shape.text for shape in loaded.sections[name].shapes] for name in loaded.sections} == {"a": ["a"], "b": ["b"]}
+
+
+def test_binary_diagram_is_closed_on_exit(tmp_path):
+    path = str(tmp_path / "diagram.fcb")
+    assert Serializer.save_to_file(make_diagram("a"), path)
+    with BinaryDiagram(path) as diagram:
+        assert diagram.root().shapes[0].text == "a"
+    assert diagram.mapping.closed
+    assert diagram not in BinaryDiagram.open_diagrams
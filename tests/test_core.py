@@ -0,0 +1,133 @@
+import json
+import struct
+
+import pytest
+
+from conftest import make_diagram
+from core import BinaryFormat, DiagramCache, DiagramData, Serializer
+
+
+def make_hierarchy() -> DiagramData:
+    # The first process is linked to the section "sub"
+    diagram_data = make_diagram("root", "next")
+    diagram_data.shapes[0].child = "#sub"
+    diagram_data.sections = {"sub": make_diagram("in sub", "más"), "empty": DiagramData(shapes=[], arrows=[])}
+    return diagram_data
+
+
+def as_tuple(diagram_data: DiagramData) -> tuple:
+    return ([(shape.shape_type, shape.x, shape.y, shape.width, shape.height, shape.text, shape.shape_id, shape.child)
+             for shape in diagram_data.shapes],
+            [(arrow.start_shape_index, arrow.start_node_index, arrow.end_shape_index, arrow.end_node_index)
+             for arrow in diagram_data.arrows],
+            {name: as_tuple(diagram_data.sections[name]) for name in diagram_data.sections})
+
+
+@pytest.mark.parametrize("extension, streaming", [(".json", False), (".json", True), (".fcb", False)])
+def test_sections_round_trip(tmp_path, extension, streaming):
+    path = str(tmp_path / f"diagram{extension}")
+    assert Serializer.save_to_file(make_hierarchy(), path)
+    loaded = Serializer.load_from_file(path, streaming=streaming)
+    assert as_tuple(loaded) == as_tuple(make_hierarchy())
+    # Only the root diagram holds the sections of the file
+    assert dict(loaded.sections["sub"].sections) == {}
+    assert list(Serializer.load_sections(path)) == ["sub", "empty"]
+
+
+def test_file_without_sections(tmp_path):
+    path = str(tmp_path / "plain.json")
+    assert Serializer.save_to_file(make_diagram("a", "b"), path)
+    assert "diagrams" not in json.load(open(path))
+    assert dict(Serializer.load_from_file(path).sections) == {}
+    assert dict(Serializer.load_sections(path)) == {}
+
+
+@pytest.mark.parametrize("source, target", [(".json", ".fcb"), (".fcb", ".json")])
+def test_convert_keeps_sections(tmp_path, source, target):
+    source_path, target_path = str(tmp_path / f"source{source}"), str(tmp_path / f"target{target}")
+    assert Serializer.save_to_file(make_hierarchy(), source_path)
+    assert Serializer.convert(source_path, target_path)
+    assert as_tuple(Serializer.load_from_file(target_path)) == as_tuple(make_hierarchy())
+
+
+def write_version_2(path: str, diagram_data: DiagramData) -> None:
+    # Layout of files saved before sections and children: header | shapes | arrows | string offsets | string data
+    strings = []
+    for shape in diagram_data.shapes:
+        strings.extend(string for string in (shape.shape_type, shape.text, shape.shape_id) if string not in strings)
+    data = [string.encode() for string in strings]
+    header, shape_record, arrow_record = BinaryFormat.headers[2], BinaryFormat.shape_records[2], BinaryFormat.arrow_record
+    shapes_offset = header.size
+    arrows_offset = shapes_offset + len(diagram_data.shapes) * shape_record.size
+    strings_offset = arrows_offset + len(diagram_data.arrows) * arrow_record.size
+    with open(path, "wb") as file:
+        file.write(header.pack(BinaryFormat.magic, 2, len(diagram_data.shapes), len(diagram_data.arrows), len(strings),
+                               shapes_offset, arrows_offset, strings_offset))
+        for shape in diagram_data.shapes:
+            file.write(shape_record.pack(strings.index(shape.shape_type), shape.x, shape.y, shape.width, shape.height,
+                                         strings.index(shape.text), strings.index(shape.shape_id)))
+        for arrow in diagram_data.arrows:
+            file.write(arrow_record.pack(arrow.start_shape_index, arrow.start_node_index, arrow.end_shape_index, arrow.end_node_index))
+        offset = 0
+        for encoded in [b""] + data:
+            offset += len(encoded)
+            file.write(struct.pack("<Q", offset))
+        file.write(b"".join(data))
+
+
+def test_version_2_files_still_load(tmp_path):
+    path = str(tmp_path / "old.fcb")
+    diagram_data = make_diagram("a", "b", "c")
+    write_version_2(path, diagram_data)
+    loaded = Serializer.load_from_file(path)
+    assert as_tuple(loaded) == as_tuple(diagram_data)
+    assert dict(loaded.sections) == {}
+
+
+def test_save_document_keeps_the_other_diagrams(tmp_path):
+    path = str(tmp_path / "diagram.fcb")
+    assert Serializer.save_to_file(make_hierarchy(), path)
+    assert Serializer.save_document(make_diagram("changed"), path + "#sub")
+    assert Serializer.save_document(make_diagram("new"), path + "#new")
+    loaded = Serializer.load_from_file(path)
+    assert [shape.text for shape in loaded.shapes] == ["root", "next"]
+    assert list(loaded.sections) == ["sub", "empty", "new"]
+    assert [shape.text for shape in loaded.sections["sub"].shapes] == ["changed"]
+    # Saving the root keeps the sections, also when saved under another name
+    assert Serializer.save_document(make_diagram("root changed"), path)
+    copy_path = str(tmp_path / "copy.json")
+    assert Serializer.save_document(Serializer.load_from_file(path), copy_path, source=path)
+    assert list(Serializer.load_from_file(copy_path).sections) == ["sub", "empty", "new"]
+
+
+def test_documents():
+    assert Serializer.split_document("a/b.json#sub") == ("a/b.json", "sub")
+    assert Serializer.split_document("a#b/c.json") == ("a#b/c.json", None)
+    assert Serializer.resolve_reference("dir/a.json", "#sub") == "dir/a.json#sub"
+    assert Serializer.resolve_reference("dir/a.json#sub", "b.fcb#x") == "dir/b.fcb#x"
+    with pytest.raises(ValueError):
+        Serializer.resolve_reference(None, "#sub")
+
+
+def test_cache_is_lru_and_discarded_per_file(tmp_path):
+    paths = [str(tmp_path / f"diagram{number}.json") for number in range(3)]
+    for path in paths:
+        assert Serializer.save_to_file(make_hierarchy(), path)
+    cache = DiagramCache(size=2)
+    first = cache.get(paths[0])
+    assert cache.get(paths[0]) is first
+    # The section is loaded through the root of its file, which is cached too
+    section = cache.get(paths[1] + "#sub")
+    assert [shape.text for shape in section.shapes] == ["in sub", "más"]
+    assert list(cache.diagrams) == [paths[1], paths[1] + "#sub"]
+    assert cache.get(paths[1] + "#sub") is section
+    # Looking for a missing section goes through the root of the file too
+    assert cache.get(paths[1] + "#missing") is None
+    assert list(cache.diagrams) == [paths[1] + "#sub", paths[1]]
+    cache.get(paths[2])
+    assert list(cache.diagrams) == [paths[1], paths[2]]
+    # A saved file is read again
+    assert Serializer.save_document(make_diagram("saved"), paths[1] + "#sub")
+    cache.discard(paths[1])
+    assert list(cache.diagrams) == [paths[2]]
+    assert [shape.text for shape in cache.get(paths[1] + "#sub").shapes] == ["saved"]
@@ -0,0 +1,60 @@
+from conftest import make_diagram
+from core import DiagramData
+from diff import diff_diagrams, merge_diagrams
+
+
+def with_sections(diagram_data: DiagramData, **sections: DiagramData) -> DiagramData:
+    diagram_data.sections = sections
+    return diagram_data
+
+
+def texts(diagram_data: DiagramData) -> dict:
+    return {name: [shape.text for shape in diagram_data.sections[name].shapes] for name in diagram_data.sections}
+
+
+def test_merge_combines_changes_of_both_sides():
+    base, ours, theirs = make_diagram("a", "b"), make_diagram("A", "b"), make_diagram("a", "b", "c")
+    theirs.shapes[1].x = 50
+    merged, conflicts = merge_diagrams(base, ours, theirs)
+    assert conflicts == []
+    assert [shape.text for shape in merged.shapes] == ["A", "b", "c"]
+    assert merged.shapes[1].x == 50
+    assert len(merged.arrows) == 2
+
+
+def test_merge_keeps_our_side_of_a_conflict():
+    base, ours, theirs = make_diagram("a", "b"), make_diagram("ours", "b"), make_diagram("theirs")
+    merged, conflicts = merge_diagrams(base, ours, theirs)
+    # They removed b, which we left alone, and changed the text of a like we did
+    assert [(conflict.shape_id, conflict.field, conflict.section) for conflict in conflicts] == [("id0", "text", None)]
+    assert [shape.text for shape in merged.shapes] == ["ours"]
+    assert merged.arrows == []
+
+
+def test_merge_combines_the_sections_of_both_sides():
+    base = with_sections(make_diagram("root"), a=make_diagram("x", "y"), b=make_diagram("b"), c=make_diagram("c"))
+    ours = with_sections(make_diagram("root"), a=make_diagram("X", "y"), b=make_diagram("b"), c=make_diagram("c"))
+    theirs = with_sections(make_diagram("root"), a=make_diagram("x", "Y"), c=make_diagram("c", "c2"), d=make_diagram("d"))
+    merged, conflicts = merge_diagrams(base, ours, theirs)
+    assert conflicts == []
+    # b was removed by them and left alone by us
+    assert texts(merged) == {"a": ["X", "Y"], "c": ["c", "c2"], "d": ["d"]}
+    assert len(merged.sections["c"].arrows) == 1
+
+
+def test_merge_reports_conflicts_within_sections():
+    base = with_sections(make_diagram("root"), a=make_diagram("x"), b=make_diagram("b"))
+    ours = with_sections(make_diagram("root"), a=make_diagram("ours"))
+    theirs = with_sections(make_diagram("root"), a=make_diagram("theirs"), b=make_diagram("changed"))
+    merged, conflicts = merge_diagrams(base, ours, theirs)
+    assert [(conflict.section, conflict.field) for conflict in conflicts] == [("a", "text"), ("b", "section")]
+    # Our side is kept
+    assert texts(merged) == {"a": ["ours"]}
+
+
+def test_diff_matches_shapes_by_id():
+    old, new = make_diagram("a", "b"), make_diagram("a", "B", "c")
+    result = diff_diagrams(old, new)
+    assert [shape.text for shape in result.added_shapes] == ["c"]
+    assert [(change.shape_id, change.fields) for change in result.changed_shapes] == [("id1", {"text": ("b", "B")})]
+    assert result.added_arrows == [("id1", 1, "id2", 3)]
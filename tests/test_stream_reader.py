@@ -0,0 +1,62 @@
+import io
+import json
+
+import pytest
+
+from conftest import make_diagram
+from core import JsonStreamReader, Serializer
+
+
+def read_stream(text: str, chunk_size: int) -> tuple:
+    reader = JsonStreamReader(io.StringIO(text), chunk_size)
+    return list(reader.iter_arrays()), reader.values
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 64, 1 << 16])
+def test_stream_reader_across_chunk_boundaries(chunk_size):
+    # Numbers, escapes and nested values cut anywhere must decode as with json.loads
+    document = {"shapes": [{"x": 12345, "y": -6.5e3, "text": "quote \" slash \\ é 😀"}, [1, [2, {}]], 1e10, 0, None],
+                "arrows": [], "version": 123456789, "diagrams": {"sub": {"shapes": [{"text": "}]"}], "arrows": []}}}
+    for indent in (None, 4):
+        elements, values = read_stream(json.dumps(document, indent=indent), chunk_size)
+        assert elements == [("shapes", element) for element in document["shapes"]]
+        assert values == {"version": 123456789, "diagrams": document["diagrams"]}
+
+
+def test_stream_reader_decodes_long_values_in_few_passes():
+    # A value spanning many chunks is decoded again only after what is buffered of it doubled
+    document = json.dumps({"diagrams": {f"s{number}": {"text": "x" * 100} for number in range(2000)}})
+    reader = JsonStreamReader(io.StringIO(document), 64)
+    attempts = []
+    raw_decode = reader.decoder.raw_decode
+
+    def counted(*args):
+        attempts.append(args)
+        return raw_decode(*args)
+    reader.decoder.raw_decode = counted
+    assert list(reader.iter_arrays()) == []
+    assert len(reader.values["diagrams"]) == 2000
+    assert len(attempts) < 30
+
+
+@pytest.mark.parametrize("text", ['{"shapes": [1, 2', '{"shapes": [1 2]}', '{"shapes" [1]}', '[1]'])
+def test_stream_reader_rejects_broken_documents(text):
+    with pytest.raises(json.JSONDecodeError):
+        read_stream(text, 2)
+
+
+def test_streaming_load_matches_json_load(tmp_path):
+    path = str(tmp_path / "diagram.json")
+    assert Serializer.save_to_file(make_diagram("a", "b", "c"), path)
+    reports = []
+    streamed = Serializer.load_from_file(path, streaming=True, progress=lambda done, total: reports.append((done, total)))
+    assert streamed == Serializer.load_from_file(path)
+    assert reports[-1][0] == reports[-1][1]
+
+
+@pytest.mark.parametrize("text", ['[]', '"shapes"', '3', 'null'])
+@pytest.mark.parametrize("streaming", [False, True])
+def test_load_fails_for_a_document_that_is_not_an_object(tmp_path, text, streaming):
+    path = tmp_path / "diagram.json"
+    path.write_text(text)
+    assert Serializer.load_from_file(str(path), streaming=streaming) is None
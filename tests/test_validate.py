@@ -0,0 +1,52 @@
+import os
+
+from core import ERROR, WARNING, ArrowData, DiagramData, Serializer, ShapeData, Validator
+from validate import validate_file
+
+
+def codes(diagram_data: DiagramData) -> list:
+    return [(diagnostic.severity, diagnostic.code) for diagnostic in Validator().validate(diagram_data)]
+
+
+def test_valid_flow_has_no_diagnostics():
+    shapes = [ShapeData("Terminator", 0, 0, 146, 96, "start", "a"), ShapeData("Process", 0, 200, 146, 96, "work", "b"),
+              ShapeData("Terminator", 0, 400, 146, 96, "end", "c")]
+    assert codes(DiagramData(shapes=shapes, arrows=[ArrowData(0, 2, 1, 0), ArrowData(1, 2, 2, 0)])) == []
+
+
+def test_loop_without_a_way_out():
+    shapes = [ShapeData("Terminator", 0, 0, 146, 96, "start", "a"), ShapeData("Process", 0, 200, 146, 96, "", "b"),
+              ShapeData("Process", 0, 400, 146, 96, "", "c")]
+    result = codes(DiagramData(shapes=shapes, arrows=[ArrowData(0, 2, 1, 0), ArrowData(1, 2, 2, 0), ArrowData(2, 1, 1, 1)]))
+    assert (ERROR, "cycle") in result
+
+
+def test_unreachable_shape_is_a_warning():
+    shapes = [ShapeData("Terminator", 0, 0, 146, 96, "start", "a"), ShapeData("Terminator", 0, 200, 146, 96, "end", "b"),
+              ShapeData("Process", 300, 0, 146, 96, "", "c"), ShapeData("Process", 300, 200, 146, 96, "", "d")]
+    arrows = [ArrowData(0, 2, 1, 0), ArrowData(2, 2, 3, 0), ArrowData(3, 1, 2, 1)]
+    result = codes(DiagramData(shapes=shapes, arrows=arrows))
+    assert (WARNING, "unreachable") in result
+
+
+def test_validator_reports_fields_of_the_wrong_type():
+    diagram_data = DiagramData(
+        shapes=[ShapeData("Terminator", 0, 0, 146, 96, "start", "a"), ShapeData(["Process"], "10", 0, 146, 96, 5, ["b"], 3),
+                ShapeData("Process", 0, 0, 146, 96, "", "c", "#missing")],
+        arrows=[ArrowData("0", 1, 2, 0), ArrowData(0, True, 2, 0), ArrowData(0, 1, 2, 0)])
+    codes = [(diagnostic.severity, diagnostic.code) for diagnostic in Validator().validate(diagram_data)]
+    assert (ERROR, "shape-field-type") in codes
+    assert codes.count((ERROR, "arrow-field-type")) == 2
+    assert (ERROR, "child-section") in codes
+    assert not Serializer.validate(diagram_data)
+
+
+def test_validate_file_reports_a_file_it_cannot_check(tmp_path):
+    path = tmp_path / "list.json"
+    path.write_text("[]")
+    assert validate_file(str(path))[1][0]["code"] == "load-error"
+
+
+def test_example_has_no_errors():
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "example.json")
+    assert [diagnostic["code"] for diagnostic in validate_file(path)[1] if diagnostic["severity"] == ERROR] == []
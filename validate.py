@@ -0,0 +1,68 @@
+import os
+import sys
+import json
+import time
+import argparse
+from dataclasses import asdict
+from typing import List, Optional, Tuple
+
+from core import ERROR, WARNING, Diagnostic, Serializer, Validator
+
+
+def validate_file(path: str) -> Tuple[str, List[dict]]:
+    # Runs in a worker process, returns the path and its diagnostics as dicts. A file the
+    # checks fail on is reported on its own, the other files are still checked
+    try:
+        diagram_data = Serializer.load_from_file(path)
+        if diagram_data is None:
+            return path, [asdict(Diagnostic(ERROR, "load-error", "Could not load diagram"))]
+        return path, [asdict(diagnostic) for diagnostic in Validator().validate(diagram_data)]
+    except Exception as e:
+        return path, [asdict(Diagnostic(ERROR, "check-error", f"Checking failed: {e!r}"))]
+
+
+def collect_files(paths: List[str]) -> List[str]:
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files.extend(os.path.join(root, name) for name in sorted(names) if name.lower().endswith((".json", ".fcb")))
+        else:
+            files.append(path)
+    return files
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Check saved flowcharts for broken arrows, unreachable shapes and endless loops.")
+    parser.add_argument("inputs", nargs="+", help="flowchart files or directories to search for .json/.fcb files")
+    parser.add_argument("-f", "--format", choices=("text", "json"), default="text", help="output format")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1, help="number of worker processes")
+    parser.add_argument("--strict", action="store_true", help="fail on warnings too")
+    args = parser.parse_args(argv)
+
+    start_time = time.perf_counter()
+    files = collect_files(args.inputs)
+    if args.jobs > 1 and len(files) > 1:
+        # Imported only when needed, a single file is checked in a fraction of its import time
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            results = list(executor.map(validate_file, files, chunksize=max(1, len(files) // (args.jobs * 8))))
+    else:
+        results = [validate_file(path) for path in files]
+
+    failed_severities = (ERROR, WARNING) if args.strict else (ERROR,)
+    failed = sum(any(diagnostic["severity"] in failed_severities for diagnostic in diagnostics) for _, diagnostics in results)
+    if args.format == "json":
+        json.dump({path: diagnostics for path, diagnostics in results}, sys.stdout, indent=4)
+        print()
+    else:
+        for path, diagnostics in results:
+            for diagnostic in diagnostics:
+                print(f"{path}: {diagnostic['severity']} {diagnostic['code']}: {diagnostic['message']}")
+        elapsed = time.perf_counter() - start_time
+        print(f"Checked {len(results)} files, {failed} failed in {elapsed:.2f}s", file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())